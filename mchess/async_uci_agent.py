@@ -13,6 +13,8 @@ import asyncio
 import chess
 import chess.engine
 
+import latency_trace as lt
+
 
 class UciEngines:
     """Search for UCI engines and make a list of all available engines
@@ -125,6 +127,72 @@ class UciEngines:
         })
 
 
+class PvRecord:
+    """ Compact, in-place updated state of one multipv line during analysis.
+
+    Moves are kept as `chess.Move` objects and the score as `chess.engine.PovScore`,
+    conversion to UCI strings and display scores is only done in `to_msg()`, once
+    a message actually passes the info throttle.
+    """
+    __slots__ = ('index', 'moves', 'score', 'depth', 'seldepth', 'nps', 'tbhits',
+                 'last_sent', 'dirty')
+
+    def __init__(self, index):
+        self.index = index
+        self.moves = []
+        self.score = None
+        self.depth = None
+        self.seldepth = None
+        self.nps = None
+        self.tbhits = None
+        self.last_sent = 0
+        self.dirty = False
+
+    def update(self, info):
+        # python-chess creates a new pv list for every info, no copy required.
+        self.moves = info['pv']
+        self.score = info.get('score')
+        self.depth = info.get('depth')
+        self.seldepth = info.get('seldepth')
+        self.nps = info.get('nps')
+        self.tbhits = info.get('tbhits')
+        self.dirty = True
+
+    def display_score(self, log=None):
+        if self.score is None:
+            return None
+        try:
+            if self.score.is_mate():
+                return f"#{self.score.relative.mate()}"
+            return self.score.relative.score(mate_score=10000) / 100.0
+        except Exception as e:
+            if log is not None:
+                log.error(f"Score transform failed {self.score}: {e}")
+            return '?'
+
+    def add_stats(self, msg, log=None):
+        sc = self.display_score(log)
+        if sc is not None:
+            msg['score'] = sc
+        if self.depth is not None:
+            msg['depth'] = self.depth
+        if self.seldepth is not None:
+            msg['seldepth'] = self.seldepth
+        if self.nps is not None:
+            msg['nps'] = self.nps
+        if self.tbhits is not None:
+            msg['tbhits'] = self.tbhits
+        return msg
+
+    def to_msg(self, actor, log=None):
+        msg = {'cmd': 'current_move_info',
+               'multipv_index': self.index + 1,
+               'variant': [mv.uci() for mv in self.moves],
+               'actor': actor
+               }
+        return self.add_stats(msg, log)
+
+
 class UciAgent:
     """ Support for single UCI chess engine """
 
@@ -288,19 +356,15 @@ class UciAgent:
             if self.analysisresults is not None:
                 self.analysisresults.stop()
 
-    async def async_go(self, board, mtime, ponder=False, analysis=False):
+    async def async_go(self, board, mtime, ponder=False, analysis=False, move_id=None):
         if mtime != -1:
             mtime = mtime / 1000.0
         if ponder is True:
             self.log.warning("Ponder not implemented!")
-        pv = []
-        last_info = []
         self.log.debug(f"mtime: {mtime}")
         if 'MultiPV' in self.engine_json['uci-options']:
             mpv = self.engine_json['uci-options']['MultiPV']
             for i in range(mpv):
-                pv.append([])
-                last_info.append(0)
                 res = {'cmd': 'current_move_info',
                        'multipv_index': i + 1,
                        'variant': [],
@@ -309,19 +373,17 @@ class UciAgent:
                        }
                 self.que.put(res)  # reset old evals
         else:
-            pv.append([])
             mpv = 1
+        pv = [PvRecord(i) for i in range(mpv)]
         if mtime == -1:
             self.log.debug("Infinite analysis")
             lm = None
         else:
             lm = chess.engine.Limit(time=mtime)
-        rep = None
-        skipped = False
         self.send_agent_state('busy')
         self.log.info(f"Starting UCI {self.name}")
-        info = None
-        best_score = None
+        if analysis is False and move_id is not None:
+            lt.mark(move_id, 'uci_go')
         with await self.engine.analysis(board, lm, multipv=mpv, info=chess.engine.Info.ALL) \
                 as self.analysisresults:
             async for info in self.analysisresults:
@@ -330,74 +392,34 @@ class UciAgent:
                     break
                 self.log.debug(info)
                 if 'pv' in info:
-                    if 'multipv' in info:
-                        ind = info['multipv'] - 1
-                    else:
-                        ind = 0
-                    pv[ind] = []
-                    for mv in info['pv']:
-                        pv[ind].append(mv.uci())
-                    rep = {'cmd': 'current_move_info',
-                           'multipv_index': ind + 1,
-                           'variant': pv[ind],
-                           'actor': self.name
-                           }
-                    if 'score' in info:
-                        try:
-                            # if info['score'].is_mate():
-                            #     sc = str(info['score'])
-                            # else:
-                            #     cp = float(str(info['score']))/100.0
-                            #     sc = '{:.2f}'.format(cp)
-                            if info['score'].is_mate():
-                                sc = f"#{info['score'].relative.mate()}"
-                            else:
-                                sc = info['score'].relative.score(mate_score=10000) / 100.0
-                        except Exception as e:
-                            self.log.error(
-                                f"Score transform failed {info['score']}: {e}")
-                            sc = '?'
-                        rep['score'] = sc
-                        if ind == 0:
-                            best_score = sc
-                    if 'depth' in info:
-                        rep['depth'] = info['depth']
-                    if 'seldepth' in info:
-                        rep['seldepth'] = info['seldepth']
-                    if 'nps' in info:
-                        rep['nps'] = info['nps']
-                    if 'tbhits' in info:
-                        rep['tbhits'] = info['tbhits']
-                    if time.time() - last_info[ind] > self.info_throttle:
-                        self.que.put(rep)
-                        last_info[ind] = time.time()
-                        skipped = False
-                    else:
-                        skipped = True
+                    ind = info.get('multipv', 1) - 1
+                    if ind >= len(pv):
+                        pv += [PvRecord(i) for i in range(len(pv), ind + 1)]
+                    rec = pv[ind]
+                    rec.update(info)
+                    now = time.time()
+                    if now - rec.last_sent > self.info_throttle:
+                        self.que.put(rec.to_msg(self.name, self.log))
+                        rec.last_sent = now
+                        rec.dirty = False
 
         self.analysisresults = None
         self.log.debug("thinking comes to end")
-        if skipped is True and rep is not None:
-            self.que.put(rep)
+        # Flush the latest state of all lines that were held back by the throttle
+        for rec in pv:
+            if rec.dirty is True:
+                self.que.put(rec.to_msg(self.name, self.log))
+                rec.dirty = False
         rep = None
-        if len(pv) > 0 and len(pv[0]) > 0:
+        if len(pv[0].moves) > 0:
             if analysis is False:
-                move = pv[0][0]
+                if move_id is not None:
+                    lt.mark(move_id, 'bestmove')
                 rep = {'cmd': 'move',
-                       'uci': move,
+                       'uci': pv[0].moves[0].uci(),
                        'actor': self.name
                        }
-                if best_score is not None:
-                    rep['score'] = best_score
-                if 'depth' in info:
-                    rep['depth'] = info['depth']
-                if 'seldepth' in info:
-                    rep['seldepth'] = info['seldepth']
-                if 'nps' in info:
-                    rep['nps'] = info['nps']
-                if 'tbhits' in info:
-                    rep['tbhits'] = info['tbhits']
-
+                pv[0].add_stats(rep, self.log)
                 self.log.debug(f"Queing result: {rep}")
                 self.que.put(rep)
             self.log.info('Calc finished.')
@@ -422,7 +444,7 @@ class UciAgent:
         self.thinking = True
         self.stopping = False
         cmd = {'board': board, 'mtime': mtime,
-               'ponder': ponder, 'analysis': analysis}
+               'ponder': ponder, 'analysis': analysis, 'move_id': board.ply()}
         self.cmd_que.put(cmd)
         return True
 
@@ -435,7 +457,7 @@ class UciAgent:
                     cmd = self.cmd_que.get_nowait()
                     self.log.debug("Go!")
                     await self.async_go(cmd['board'], cmd['mtime'], ponder=cmd['ponder'],
-                                        analysis=cmd['analysis'])
+                                        analysis=cmd['analysis'], move_id=cmd['move_id'])
                     self.cmd_que.task_done()
                 except queue.Empty:
                     await asyncio.sleep(0.05)
@@ -1,4 +1,5 @@
 ''' Web interface using aiohttp '''
+import collections
 import logging
 import json
 import threading
@@ -7,10 +8,98 @@ import ssl
 import aiohttp
 from aiohttp import web
 import chess
-import chess.pgn
 import time
 import os
 
+import compact_info
+from incremental_pgn import IncrementalPGN
+from static_assets import StaticAssets
+
+
+class ClientQueue:
+    """
+    Bounded send queue of one websocket client, only used on the web server's event loop.
+
+    Messages without key are state messages (board, valid moves, ...), they are always
+    delivered, in order. Messages with a key are informational: a queued message with the
+    same key is removed, i.e. a slow client only receives the latest one. Informational
+    messages without replacement frame are dropped, oldest first, if more than `max_info`
+    are queued. A client with more than `max_len` queued messages, or with a send that has
+    been blocked since `send_start` for too long, is lagging behind.
+    """
+
+    def __init__(self, ws, request, max_len=64, max_info=16):
+        self.ws = ws
+        self.request = request
+        self.max_len = max_len
+        self.max_info = max_info
+        self.entries = collections.deque()
+        self.info_count = 0
+        self.event = asyncio.Event()
+        self.closed = False
+        self.compact = False
+        self.send_start = None
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, data, key=None, replace=None):
+        """
+        Queue a message.
+
+        :param data: encoded message
+        :param key: None for state messages, otherwise key of informational messages that
+                    replace each other, e.g. engine and variant index.
+        :param replace: encoded message that is sent instead, if a queued message with the
+                        same key is replaced. Messages with `replace` are never dropped.
+        :returns: False, if the client is lagging behind.
+        """
+        if self.closed is True:
+            return True
+        if key is not None:
+            for i, entry in enumerate(self.entries):
+                if entry[0] == key:
+                    del self.entries[i]
+                    self.info_count -= 1
+                    self.coalesced += 1
+                    if replace is not None:
+                        data = replace
+                    break
+            if self.info_count >= self.max_info:
+                for i, entry in enumerate(self.entries):
+                    if entry[0] is not None and entry[2] is None:
+                        del self.entries[i]
+                        self.info_count -= 1
+                        self.dropped += 1
+                        break
+            self.info_count += 1
+        self.entries.append((key, data, replace))
+        self.event.set()
+        return len(self.entries) <= self.max_len
+
+    async def get(self):
+        """
+        Wait for the next message.
+
+        :returns: encoded message, None if the queue has been closed.
+        """
+        while len(self.entries) == 0 and self.closed is False:
+            self.event.clear()
+            await self.event.wait()
+        if self.closed is True:
+            return None
+        key, data, _ = self.entries.popleft()
+        if key is not None:
+            self.info_count -= 1
+        return data
+
+    def close(self):
+        self.closed = True
+        self.entries.clear()
+        self.event.set()
+
 
 class AsyncWebAgent:
     def __init__(self, appque, prefs):
@@ -33,12 +122,45 @@ class AsyncWebAgent:
         self.display_move_cache = {}
         self.valid_moves_cache = {}
         self.game_stats_cache = {}
+        self.game_stats_list = []
+        # Encoded frames of the caches for late joining clients
+        self.display_board_msg = None
+        self.display_board_frame = None
+        self.agent_state_frames = {}
+        self.uci_engines_frame = None
+        self.display_move_frame = None
+        self.valid_moves_frame = None
+        self.game_stats_frame = None
+        self.encode_count = 0
+        self.encode_time = 0.0
+        self.encoded_bytes = 0
+        self.broadcast_count = 0
+        self.send_time = 0.0
+        self.frames_sent = 0
+        self.bytes_sent = 0
         self.max_mpv = 1
-        self.last_board = None
+        self.last_fen = None
         self.last_attribs = None
-        self.last_pgn = None
+        self.pgn = IncrementalPGN()
+        self.pgn_lock = threading.Lock()
+        self.assets = None
         self.socket_thread_active = False
         self.ws_clients = []
+        self.ws_queues = {}
+        self.max_send_queue = 64
+        self.max_info_queue = 16
+        self.send_timeout = 10.0
+        self.close_tasks = set()
+        self.info_coalesced = 0
+        self.info_dropped = 0
+        self.clients_disconnected = 0
+        # Compact encoding of analysis messages for clients that request it
+        self.compact_info_enabled = self.prefs.get('compact_info', True)
+        self.compact_encoder = compact_info.CompactInfoEncoder()
+        self.compact_schema_frame = None
+        # Actor table and schema frame are changed by the dispatcher and read during the
+        # negotiation on the event loop
+        self.compact_lock = threading.Lock()
 
         if 'port' in self.prefs:
             self.port = self.prefs['port']
@@ -95,11 +217,18 @@ class AsyncWebAgent:
         self.socket_thread_active = True
         asyncio.set_event_loop(self.event_loop)
         self.app = web.Application(debug=True)
-        self.app.add_routes([web.static('/node_modules', 'web/node_modules'),
-                             web.static('/images', 'web/images')])
+        self.assets = StaticAssets('web')
+        images = []
+        if os.path.isdir('web/images'):
+            images = ['images/' + name for name in sorted(os.listdir('web/images'))]
+        self.assets.preload(['index.html', 'favicon.ico', 'scripts/mchess.js',
+                             'styles/mchess.css'] + images)
+        self.app.add_routes([web.get('/node_modules/{path:.*}', self.web_node_modules),
+                             web.get('/images/{path:.*}', self.web_images)])
 
         self.app.add_routes([web.get('/', self.web_root),
                              web.get('/favicon.ico', self.web_favicon),
+                             web.get('/game.pgn', self.web_pgn),
                              web.get('/scripts/mchess.js', self.mchess_script),
                              web.get('/styles/mchess.css', self.mchess_style)])
         self.app.add_routes([web.get('/ws', self.websocket_handler)])
@@ -110,7 +239,7 @@ class AsyncWebAgent:
             except Exception as e:
                 self.log.error(f"Cannot create cert chain: {e}, not using TLS")
                 self.tls = False
-        asyncio.run(self.async_web_agent())
+        self.event_loop.run_until_complete(self.async_web_agent())
         while self.active is True:
             time.sleep(0.1)
         self.log.info("Web starter thread stopped")
@@ -133,29 +262,171 @@ class AsyncWebAgent:
             await asyncio.sleep(0.1)
         self.log.info("Web server stopped")
         
-    def web_root(self, request):
-        return web.FileResponse('web/index.html')
+    # The web client's own files are revalidated on each load (answered by 304 if
+    # unchanged), images and npm packages are cached by the browser for a day.
+    async def web_root(self, request):
+        return await self.assets.response(request, 'index.html')
+
+    async def web_favicon(self, request):
+        return await self.assets.response(request, 'favicon.ico', 'public, max-age=86400')
+
+    async def mchess_script(self, request):
+        return await self.assets.response(request, 'scripts/mchess.js')
+
+    async def mchess_style(self, request):
+        return await self.assets.response(request, 'styles/mchess.css')
 
-    def web_favicon(self, request):
-        return web.FileResponse('web/favicon.ico')
+    async def web_images(self, request):
+        return await self.assets.response(request, 'images/' + request.match_info['path'],
+                                          'public, max-age=86400')
 
-    def mchess_script(self, request):
-        return web.FileResponse('web/scripts/mchess.js')
+    async def web_node_modules(self, request):
+        return await self.assets.response(request, 'node_modules/' + request.match_info['path'],
+                                          'public, max-age=86400')
 
-    def mchess_style(self, request):
-        return web.FileResponse('web/styles/mchess.css')
+    def web_pgn(self, request):
+        with self.pgn_lock:
+            text = self.pgn.pgn()
+        return web.Response(text=text, content_type='application/x-chess-pgn',
+                            headers={'Content-Disposition': 'attachment; filename="mchess.pgn"'})
 
-    async def send_out(self, ws, text):
-        await ws.send_str(text)
+    def encode(self, msg, compact=False):
+        """
+        Serialize a message once for all clients.
 
-    def send2ws(self, ws, text):
+        :param msg: message dictionary
+        :param compact: True: no blanks after separators
+        :returns: UTF-8 encoded JSON text frame
+        """
+        t0 = time.perf_counter()
+        if compact is True:
+            data = json.dumps(msg, separators=(',', ':')).encode('utf-8')
+        else:
+            data = json.dumps(msg).encode('utf-8')
+        self.encode_time += time.perf_counter() - t0
+        self.encode_count += 1
+        self.encoded_bytes += len(data)
+        return data
+
+    def broadcast(self, data, what='message', key=None, replace=None, compact=None):
+        """
+        Send a message to all websocket clients. Can be called from any thread: the
+        broadcast is handed over to the web server's event loop and does not wait for
+        the clients.
+
+        :param data: encoded message, see `encode()`
+        :param what: description of the message for log messages
+        :param key: None: state message that is always delivered. Otherwise informational
+                    message that may be coalesced or dropped for slow clients, see
+                    `ClientQueue.put()`.
+        :param replace: encoded message sent instead of coalesced messages with `key`
+        :param compact: encoded message for clients with compact encoding, None: `data`.
+                        Clients are skipped, if the message for their encoding is None.
+        :returns: `concurrent.futures.Future` of the broadcast, or None if the web server
+                  is not running.
+        """
+        if self.event_loop.is_closed() is True or self.event_loop.is_running() is False:
+            self.log.debug(f"Web server not running, {what} not sent")
+            return None
+        return asyncio.run_coroutine_threadsafe(
+            self.async_broadcast(data, what, key, replace, compact), self.event_loop)
+
+    async def async_broadcast(self, data, what='message', key=None, replace=None, compact=None):
+        """
+        Queue a message for all websocket clients, clients that lag behind are disconnected.
+        """
+        self.broadcast_count += 1
+        now = time.perf_counter()
+        for ws, cq in list(self.ws_queues.items()):
+            if ws.closed:
+                self.log.warning(f"Closed websocket encountered: {ws}")
+                self.remove_client(ws)
+            elif cq.send_start is not None and now - cq.send_start > self.send_timeout:
+                self.disconnect(cq, f"send blocked for more than {self.send_timeout} s")
+            else:
+                frame = compact if cq.compact is True and compact is not None else data
+                if frame is not None and cq.put(frame, key, replace) is False:
+                    self.disconnect(cq, f"{len(cq)} messages queued, last: {what}")
+
+    async def send_ws(self, ws, data):
         if ws.closed:
-            self.log.warning(f"Closed websocket encountered: {ws}")
             return False
-        self.log.info(f"Sending {text} to {ws}")
-        asyncio.run(self.send_out(ws, text))
+        await ws.send_frame(data, aiohttp.WSMsgType.TEXT)
         return True
 
+    async def client_writer(self, cq):
+        """
+        Send the queued messages of one client, so that a slow client does not delay the
+        others.
+        """
+        while True:
+            data = await cq.get()
+            if data is None:
+                return
+            cq.send_start = time.perf_counter()
+            try:
+                ok = await self.send_ws(cq.ws, data)
+            except Exception as e:
+                if cq.closed is False:
+                    self.log.warning(f"Sending to WebSocket client {cq.ws} failed with {e}")
+                    self.remove_client(cq.ws)
+                return
+            self.send_time += time.perf_counter() - cq.send_start
+            cq.send_start = None
+            if ok is False:
+                self.log.warning(f"Closed websocket encountered: {cq.ws}")
+                self.remove_client(cq.ws)
+                return
+            self.frames_sent += 1
+            self.bytes_sent += len(data)
+
+    def remove_client(self, ws):
+        if ws in self.ws_clients:
+            self.ws_clients.remove(ws)
+        cq = self.ws_queues.pop(ws, None)
+        if cq is not None:
+            self.info_coalesced += cq.coalesced
+            self.info_dropped += cq.dropped
+            cq.close()
+
+    def disconnect(self, cq, reason):
+        """
+        Disconnect a client that lags behind, the connection is aborted if the close
+        handshake cannot be sent.
+        """
+        self.log.warning(f"Disconnecting slow WebSocket client {cq.ws}: {reason}")
+        self.clients_disconnected += 1
+        self.remove_client(cq.ws)
+
+        async def close():
+            try:
+                await asyncio.wait_for(cq.ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER,
+                                                   message=b'client too slow'), 1.0)
+            except Exception:
+                if cq.request.transport is not None:
+                    cq.request.transport.abort()
+        task = asyncio.ensure_future(close())
+        self.close_tasks.add(task)
+        task.add_done_callback(self.close_tasks.discard)
+
+    def stats(self):
+        """
+        Cost of serializing and sending messages to websocket clients.
+
+        :returns: dictionary with number of encoded messages, total encode time (s) and
+                  encoded bytes, number of broadcasts, total send time (s) on the server's
+                  event loop, frames and bytes sent to clients, informational messages
+                  coalesced and dropped for slow clients, and slow clients disconnected.
+        """
+        queues = list(self.ws_queues.values())
+        return {'encoded': self.encode_count, 'encode_time': self.encode_time,
+                'encoded_bytes': self.encoded_bytes, 'broadcasts': self.broadcast_count,
+                'send_time': self.send_time, 'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent,
+                'coalesced': self.info_coalesced + sum(cq.coalesced for cq in queues),
+                'dropped': self.info_dropped + sum(cq.dropped for cq in queues),
+                'disconnected': self.clients_disconnected}
+
     async def websocket_handler(self, request):
         ws = web.WebSocketResponse()
         thread_log = logging.getLogger("ThrdWeb")
@@ -163,36 +434,21 @@ class AsyncWebAgent:
 
         await ws.prepare(request)
 
+        cq = ClientQueue(ws, request, self.max_send_queue, self.max_info_queue)
         if ws not in self.ws_clients:
             self.ws_clients.append(ws)
+            self.ws_queues[ws] = cq
             thread_log.info(f"New ws client {ws}! (clients: {len(self.ws_clients)})")
         else:
             thread_log.info(f"Client already registered! (clients: {len(self.ws_clients)})")
 
-        if self.last_board is not None and self.last_attribs is not None:
-            msg = {'cmd': 'display_board', 'fen': self.last_board.fen(), 'pgn': self.last_pgn,
-                   'attribs': self.last_attribs}
-            try:
-                await ws.send_str(json.dumps(msg))
-            except Exception as e:
-                thread_log.warning(
-                    "Sending to WebSocket client {} failed with {}".format(ws, e))
-                return
-        for actor in self.agent_state_cache:
-            msg = self.agent_state_cache[actor]
-            try:
-                await ws.send_str(json.dumps(msg))
-            except Exception as e:
-                thread_log.warning(
-                    f"Failed to update agents states to new web-socket client: {e}")
-        if self.uci_engines_cache != {}:
-            await ws.send_str(json.dumps(self.uci_engines_cache))
-        if self.display_move_cache != {}:
-            await ws.send_str(json.dumps(self.display_move_cache))
-        if self.valid_moves_cache != {}:
-            await ws.send_str(json.dumps(self.valid_moves_cache))
-        if self.game_stats_cache != {}:
-            await ws.send_str(json.dumps(self.game_stats_cache))
+        frames = [self.board_frame()] + list(self.agent_state_frames.values()) + \
+            [self.uci_engines_frame, self.display_move_frame, self.valid_moves_frame,
+             self.game_stats_frame]
+        for data in frames:
+            if data is not None:
+                cq.put(data)
+        writer = asyncio.ensure_future(self.client_writer(cq))
 
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
@@ -201,9 +457,28 @@ class AsyncWebAgent:
                     "Client ws_dispatch: ws:{} msg:{}".format(ws, msg.data))
                 try:
                     self.log.info(f"Received: {msg.data}")
-                    self.appque.put(json.loads(msg.data))
+                    cmd = json.loads(msg.data)
                 except Exception as e:
                     thread_log.warning(f"WebClient sent invalid JSON: {msg.data}: {e}")
+                    continue
+                if cmd.get('cmd') == 'pgn_resync':
+                    # Client missed a move delta, answered by the web agent itself
+                    data = self.board_frame()
+                    if data is not None:
+                        cq.put(data)
+                elif cmd.get('cmd') == 'encoding':
+                    # Negotiation of the compact encoding of analysis messages
+                    if self.compact_info_enabled is True and \
+                            cmd.get('compact_info') == compact_info.VERSION:
+                        with self.compact_lock:
+                            if self.compact_schema_frame is None:
+                                self.compact_schema_frame = self.encode(
+                                    self.compact_encoder.schema())
+                            # Schema updates broadcast from now on reach this client
+                            cq.compact = True
+                            cq.put(self.compact_schema_frame)
+                else:
+                    self.appque.put(cmd)
                 # if msg.data == 'close':
                 #     await ws.close()
                 # else:
@@ -215,7 +490,8 @@ class AsyncWebAgent:
                 thread_log.error(f"Unexpected message {msg.data}, of type {msg.type}")
                 break
         thread_log.warning(f"WS-CLOSE: {ws}")
-        self.ws_clients.remove(ws)
+        self.remove_client(ws)
+        writer.cancel()
 
         return ws
 
@@ -224,41 +500,75 @@ class AsyncWebAgent:
 
     def quit(self):
         self.socket_thread_active = False
+        st = self.stats()
+        if st['encoded'] > 0 and st['broadcasts'] > 0:
+            self.log.info(f"Websocket messages: {st['encoded']} encoded, "
+                          f"{st['encode_time'] / st['encoded'] * 1e6:.1f} us per message, "
+                          f"{st['broadcasts']} broadcasts, "
+                          f"{st['send_time'] / st['broadcasts'] * 1000:.2f} ms per broadcast, "
+                          f"{st['frames_sent']} frames, {st['bytes_sent']} bytes sent, "
+                          f"{st['coalesced']} coalesced, {st['dropped']} dropped, "
+                          f"{st['disconnected']} slow clients disconnected")
+        if self.assets is not None:
+            st = self.assets.stats()
+            self.log.info(f"Static files: {st['requests']} requests, {st['not_modified']} not "
+                          f"modified, {st['loads']} loads, {st['bytes_sent']} bytes sent")
 
     def display_board(self, board, attribs={'unicode': True, 'invert': False, 'white_name': 'white', 'black_name': 'black'}):
-        self.last_board = board
-        self.last_attribs = attribs
         self.log.info(f"Display board, clients: {len(self.ws_clients)}")
-        try:
-            game = chess.pgn.Game().from_board(board)
-            game.headers["White"] = attribs["white_name"]
-            game.headers["Black"] = attribs["black_name"]
-            pgntxt = str(game)
-        except Exception as e:
-            self.log.error("Invalid PGN position, {}".format(e))
-            return
-        self.last_pgn = pgntxt
-        # print("pgn: {}".format(pgntxt))
-        msg = {'cmd': 'display_board', 'fen': board.fen(), 'pgn': pgntxt,
-               'attribs': attribs}
-        for ws in self.ws_clients:
+        with self.pgn_lock:
+            full = False
             try:
-                if self.send2ws(ws, json.dumps(msg)) is False:
-                    self.ws_clients.remove(ws)
+                start, san = self.pgn.update(board, white=attribs.get('white_name'),
+                                             black=attribs.get('black_name'))
             except Exception as e:
-                self.log.warning(
-                    "Sending board to WebSocket client {} failed with {}".format(ws, e))
+                self.log.error("Invalid PGN position, {}".format(e))
+                # Keeps the sequence number, clients replace their move list
+                self.pgn.reset()
+                start, san = self.pgn.full()
+                full = True
+            # Snapshot: the board is changed by the dispatcher after this call
+            self.last_fen = board.fen()
+            self.last_attribs = dict(attribs)
+            msg = self.board_message(start, san, full=full)
+            self.display_board_msg = msg if full is True else \
+                self.board_message(*self.pgn.full(), full=True)
+            self.display_board_frame = None
+        self.broadcast(self.encode(msg), 'board')
+
+    def board_message(self, start, san, full):
+        """
+        `display_board` message with the moves as delta to the previous board, called with
+        `pgn_lock` held.
+
+        :param start: number of plies clients keep of their move list
+        :param san: list of SAN moves clients append
+        :param full: True: the delta contains the complete move list, clients accept it
+                     regardless of their sequence number.
+        """
+        return {'cmd': 'display_board', 'fen': self.last_fen, 'attribs': self.last_attribs,
+                'pgn_delta': {'seq': self.pgn.seq, 'start': start, 'moves': san,
+                              'first_ply': self.pgn.first_ply,
+                              'result': self.pgn.headers['Result'], 'full': full}}
+
+    def board_frame(self):
+        """
+        Encoded `display_board` message with the complete move list for new clients and
+        resync requests, encoded once per board update from the snapshot taken by
+        `display_board()`.
+
+        :returns: encoded frame, None if no board has been displayed yet.
+        """
+        with self.pgn_lock:
+            if self.display_board_frame is None and self.display_board_msg is not None:
+                self.display_board_frame = self.encode(self.display_board_msg)
+            return self.display_board_frame
 
     def display_move(self, move_msg):
         self.log.info(f"AWS display move to {len(self.ws_clients)} clients")
         self.display_move_cache = move_msg
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(move_msg)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    f"Sending display_move {move_msg} to WebSocket client {ws} failed with {e}")
+        self.display_move_frame = self.encode(move_msg)
+        self.broadcast(self.display_move_frame, 'display_move')
 
     def set_valid_moves(self, board, vals):
         self.log.info(f"web set valid called, clients: {len(self.ws_clients)}.")
@@ -271,53 +581,47 @@ class AsyncWebAgent:
             for v in vals:
                 self.valid_moves_cache['valid_moves'].append(vals[v])
         self.log.info(f"Valid-moves: {self.valid_moves_cache}")
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(self.valid_moves_cache)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    "Sending valid_moves to WebSocket client {} failed with {}".format(ws, e))
+        self.valid_moves_frame = self.encode(self.valid_moves_cache)
+        self.broadcast(self.valid_moves_frame, 'valid_moves')
 
     def display_info(self, board, info):
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(info)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    "Sending display-info to WebSocket client {} failed with {}".format(ws, e))
+        queues = list(self.ws_queues.values())
+        if len(queues) == 0:
+            return
+        key = f"info:{info.get('actor')}:{info.get('multipv_index')}"
+        data = None
+        compact = None
+        if any(cq.compact is False for cq in queues):
+            data = self.encode(info)
+        if any(cq.compact is True for cq in queues):
+            with self.compact_lock:
+                packed, new_actor = self.compact_encoder.encode(info)
+                if new_actor is True:
+                    self.compact_schema_frame = self.encode(self.compact_encoder.schema())
+                    self.broadcast(None, 'compact_info_schema', compact=self.compact_schema_frame)
+            compact = self.encode(packed, compact=True)
+        self.broadcast(data, 'display_info', key=key, compact=compact)
 
     def engine_list(self, msg):
         for engine in msg["engines"]:
             self.log.info(f"Engine {engine} announced.")
         self.uci_engines_cache = msg
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(msg)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    "Sending uci-info to WebSocket client {} failed with {}".format(ws, e))
+        self.uci_engines_frame = self.encode(msg)
+        self.broadcast(self.uci_engines_frame, 'engine_list')
 
-    def game_stats(self, stats):
-        msg = {'cmd': 'game_stats', 'stats': stats, 'actor': 'AsyncWebAgent'}
-        self.game_stats_cache = msg
+    def game_stats(self, stats, start=0):
+        # stats is a delta: truncate to `start` plies, then append.
+        del self.game_stats_list[start:]
+        self.game_stats_list += stats
+        self.game_stats_cache = {'cmd': 'game_stats', 'start': 0, 'stats': self.game_stats_list,
+                                 'actor': 'AsyncWebAgent'}
+        msg = {'cmd': 'game_stats', 'start': start, 'stats': stats, 'actor': 'AsyncWebAgent'}
         self.log.info(f"Game stats: {msg}")
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(msg)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    "Sending game_stats to WebSocket client {} failed with {}".format(ws, e))
+        self.game_stats_frame = self.encode(self.game_stats_cache)
+        self.broadcast(self.encode(msg), 'game_stats', key='game_stats',
+                       replace=self.game_stats_frame)
 
     def agent_states(self, msg):
         self.agent_state_cache[msg['actor']] = msg
-        for ws in self.ws_clients:
-            try:
-                if self.send2ws(ws, json.dumps(msg)) is False:
-                    self.ws_clients.remove(ws)
-            except Exception as e:
-                self.log.warning(
-                    "Sending agent-state info to WebSocket client {} failed with {}".format(ws, e))
+        self.agent_state_frames[msg['actor']] = self.encode(msg)
+        self.broadcast(self.agent_state_frames[msg['actor']], 'agent_state')
@@ -0,0 +1,204 @@
+''' Broadcast latency of `AsyncWebAgent` with 1, 10 and 100 connected websocket clients
+
+The agent runs its web server on a free local port, the clients run on a separate event loop
+thread. Each broadcast is started from the calling (dispatcher) thread, the delivery latency is
+the time until the last client has received the message. Finally, a client that stops reading
+is added: the other clients should not be delayed, and the stalled client is disconnected.
+
+Run from the `mchess` directory: `python benchmarks/bench_async_web_agent.py`
+'''
+import asyncio
+import base64
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import async_web_agent  # noqa: E402
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web')
+
+
+def web_root():
+    ''' Temporary working directory with the web client, and an empty `node_modules` if the
+    client's npm packages are not installed '''
+    tmp = tempfile.mkdtemp()
+    os.mkdir(os.path.join(tmp, 'web'))
+    for name in os.listdir(WEB_DIR):
+        os.symlink(os.path.join(os.path.abspath(WEB_DIR), name), os.path.join(tmp, 'web', name))
+    if not os.path.exists(os.path.join(tmp, 'web', 'node_modules')):
+        os.mkdir(os.path.join(tmp, 'web', 'node_modules'))
+    return tmp
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Clients:
+    ''' Websocket clients on their own event loop thread, recording receive times '''
+
+    def __init__(self, url):
+        self.url = url
+        self.loop = asyncio.new_event_loop()
+        self.received = {}
+        self.bytes = 0
+        self.cv = threading.Condition()
+        self.sessions = []
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def connect(self, count):
+        asyncio.run_coroutine_threadsafe(self._connect(count), self.loop).result()
+
+    async def _connect(self, count):
+        session = aiohttp.ClientSession()
+        self.sessions.append(session)
+        for _ in range(count):
+            ws = await session.ws_connect(self.url)
+            self.loop.create_task(self._reader(ws))
+
+    async def _reader(self, ws):
+        async for msg in ws:
+            t = time.perf_counter()
+            data = msg.data if msg.type == aiohttp.WSMsgType.TEXT else msg.data.decode('utf-8')
+            obj = json.loads(data)
+            seq = obj.get('seq') if isinstance(obj, dict) else None
+            with self.cv:
+                self.bytes += len(msg.data)
+                if seq is not None:
+                    self.received.setdefault(seq, []).append(t)
+                    self.cv.notify_all()
+
+    def wait(self, seq, count, timeout=10.0):
+        with self.cv:
+            return self.cv.wait_for(lambda: len(self.received.get(seq, [])) >= count, timeout)
+
+    def close(self):
+        async def _close():
+            for session in self.sessions:
+                await session.close()
+        asyncio.run_coroutine_threadsafe(_close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def stalled_client(port):
+    ''' Websocket client that does not read anything after the handshake '''
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('localhost', port))
+    key = base64.b64encode(os.urandom(16)).decode('ascii')
+    sock.sendall(f"GET /ws HTTP/1.1\r\nHost: localhost:{port}\r\nUpgrade: websocket\r\n"
+                 f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                 "Sec-WebSocket-Version: 13\r\n\r\n".encode('ascii'))
+    response = b''
+    while not response.endswith(b'\r\n\r\n'):
+        response += sock.recv(1)
+    return sock
+
+
+def info_message(seq, multipv_index=1):
+    return {'cmd': 'current_move_info', 'seq': seq, 'multipv_index': multipv_index,
+            'score': '0.31',
+            'depth': 20, 'seldepth': 28, 'nps': 1200000, 'tbhits': 0,
+            'variant': ['e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1b5', 'a7a6', 'b5a4', 'g8f6'],
+            'san_variant': ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'Ba4', 'Nf6'],
+            'preview_fen_depth': 6,
+            'preview_fen': 'r1bqkbnr/1ppp1ppp/p1n5/4p3/B3P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 1 4',
+            'actor': 'stockfish'}
+
+
+def broadcast_latency(agent, clients, count, messages=200, seq0=0):
+    st0 = agent.stats()
+    call, first, last = [], [], []
+    for seq in range(seq0, seq0 + messages):
+        msg = info_message(seq)
+        t0 = time.perf_counter()
+        agent.display_info(None, msg)
+        call.append(time.perf_counter() - t0)
+        assert clients.wait(seq, count), f"message {seq} not received by all clients"
+        with clients.cv:
+            times = clients.received[seq]
+            first.append(min(times) - t0)
+            last.append(max(times) - t0)
+    print(f"{count:3d} clients: dispatcher call {percentile(call, 0.5) * 1e6:7.1f} us, "
+          f"first client {percentile(first, 0.5) * 1000:6.2f} ms, "
+          f"last client median {percentile(last, 0.5) * 1000:6.2f} ms, "
+          f"p95 {percentile(last, 0.95) * 1000:6.2f} ms")
+    st = {key: value - st0[key] for key, value in agent.stats().items()}
+    print(f"             encode {st['encode_time'] / st['encoded'] * 1e6:7.1f} us per message "
+          f"(once for all clients), send {st['send_time'] / st['broadcasts'] * 1000:6.2f} ms "
+          f"per broadcast, {st['bytes_sent'] / st['broadcasts']:.0f} bytes")
+
+
+def stalled_client_load(agent, clients, count, port, messages=3000):
+    ''' Analysis with 4 variants and a board update every 20 messages, 4 kB per message '''
+    sock = stalled_client(port)
+    while len(agent.ws_clients) < count + 1:
+        time.sleep(0.01)
+    stalled = agent.ws_clients[-1]
+    st0 = agent.stats()
+    last = []
+    for seq in range(messages):
+        msg = info_message(1000000 + seq, multipv_index=seq % 4 + 1)
+        msg['padding'] = 'x' * 4000
+        t0 = time.perf_counter()
+        agent.display_info(None, msg)
+        if seq % 20 == 0:
+            agent.display_move({'cmd': 'move', 'uci': 'e2e4', 'actor': 'bench', 'seq': None})
+        assert clients.wait(1000000 + seq, count), f"message {seq} not received by all clients"
+        with clients.cv:
+            last.append(max(clients.received[1000000 + seq]) - t0)
+    st = {key: value - st0[key] for key, value in agent.stats().items()}
+    print(f"{count:3d} clients + 1 stalled client: last client median "
+          f"{percentile(last, 0.5) * 1000:6.2f} ms, p95 {percentile(last, 0.95) * 1000:6.2f} ms, "
+          f"stalled client {'disconnected' if stalled not in agent.ws_clients else 'connected'}, "
+          f"{st['coalesced']} coalesced, {st['dropped']} dropped")
+    sock.close()
+
+
+def main():
+    cwd = os.getcwd()
+    os.chdir(web_root())
+    port = free_port()
+    agent = async_web_agent.AsyncWebAgent(queue.Queue(), {'port': port, 'bind_address': 'localhost'})
+    agent.log.setLevel('WARNING')
+    end = time.time() + 5
+    while agent.event_loop.is_running() is False and time.time() < end:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    clients = Clients(f"http://localhost:{port}/ws")
+    connected = 0
+    seq = 0
+    for count in (1, 10, 100):
+        clients.connect(count - connected)
+        connected = count
+        while len(agent.ws_clients) < count:
+            time.sleep(0.01)
+        broadcast_latency(agent, clients, count, seq0=seq)
+        seq += 200
+    stalled_client_load(agent, clients, connected, port)
+    logging.getLogger("ThrdWeb").disabled = True  # one close warning per client
+    clients.close()
+    agent.quit()
+    agent.active = False
+    os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
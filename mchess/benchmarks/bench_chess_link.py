@@ -0,0 +1,77 @@
+''' Micro-benchmarks for ChessLink position decoding and FEN conversion
+
+Run from the `mchess` directory: `python benchmarks/bench_chess_link.py`
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chess_link as cl  # noqa: E402
+
+FIGREP = {"int": [1, 2, 3, 4, 5, 6, 0, -1, -2, -3, -4, -5, -6],
+          "ascii": "PNBRQK.pnbrqk"}
+
+START_RANKS = ["RNBQKBNR", "PPPPPPPP", "........", "........",
+               "........", "........", "pppppppp", "rnbqkbnr"]
+
+
+def raw_frame(ranks):
+    ''' Encode 8 ranks (rank 1 first) as 64 raw board characters, cable right '''
+    raw = ['.'] * 64
+    for y in range(8):
+        for x in range(8):
+            raw[7 - x + y * 8] = ranks[y][x]
+    return "".join(raw)
+
+
+def legacy_decode(rp, orientation):
+    ''' Reference: nested-loop decoder as used up to version 0.4.1 '''
+    position = [[0 for x in range(8)] for y in range(8)]
+    for y in range(8):
+        for x in range(8):
+            c = rp[7 - x + y * 8]
+            i = FIGREP['ascii'].find(c)
+            if i == -1:
+                return None
+            f = FIGREP['int'][i]
+            if orientation is True:
+                position[y][x] = f
+            else:
+                position[7 - y][7 - x] = f
+    return position
+
+
+def legacy_to_position(legacy):
+    ''' Convert a legacy 8x8 int array to a flat `position` '''
+    return "".join(FIGREP['ascii'][FIGREP['int'].index(f)] for row in legacy for f in row).encode('ascii')
+
+
+def bench(name, func, number=20000):
+    t = timeit.timeit(func, number=number)
+    print(f"{name:<45} {t / number * 1e6:8.2f} us/call")
+    return t
+
+
+def main():
+    raw = raw_frame(START_RANKS)
+    for orientation in (True, False):
+        assert cl.decode_raw_position(raw, orientation) == \
+            legacy_to_position(legacy_decode(raw, orientation))
+        t_old = bench(f"legacy decode (orientation={orientation})",
+                      lambda: legacy_decode(raw, orientation))
+        t_new = bench(f"table decode (orientation={orientation})",
+                      lambda: cl.decode_raw_position(raw, orientation))
+        print(f"speedup: {t_old / t_new:.1f}x")
+
+    brd = cl.ChessLink.__new__(cl.ChessLink)
+    pos = cl.decode_raw_position(raw, True)
+    fen = brd.position_to_fen(pos)
+    assert brd.fen_to_position(fen) == pos
+    bench("position_to_fen", lambda: brd.position_to_fen(pos))
+    bench("fen_to_position", lambda: brd.fen_to_position(fen))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+''' Micro-benchmarks for the ChessLink parity and block CRC codec
+
+Run from the `mchess` directory: `python benchmarks/bench_chess_link_protocol.py`
+'''
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chess_link_protocol as clp  # noqa: E402
+
+
+def legacy_add_odd_par(b):
+    ''' Reference: bit loop parity as used up to version 0.4.1 '''
+    byte = ord(b) & 127
+    par = 1
+    for _ in range(7):
+        bit = byte & 1
+        byte = byte >> 1
+        par = par ^ bit
+    if par == 1:
+        byte = ord(b) | 128
+    else:
+        byte = ord(b) & 127
+    return byte
+
+
+def legacy_hex2(num):
+    return "0123456789ABCDEF"[num // 16] + "0123456789ABCDEF"[num % 16]
+
+
+def legacy_encode(msg):
+    ''' Reference: block CRC and parity per character, as in the usb transport '''
+    gpar = 0
+    for b in msg:
+        gpar = gpar ^ ord(b)
+    msg = msg + legacy_hex2(gpar)
+    return bytes([legacy_add_odd_par(c) for c in msg])
+
+
+def legacy_check(msg):
+    gpar = 0
+    for b in msg[:-2]:
+        gpar = gpar ^ ord(b)
+    return msg[-2] + msg[-1] == legacy_hex2(gpar)
+
+
+def round_trip(number=5000):
+    ''' Random messages: encoding is identical to the legacy code, decoding restores the message,
+    every byte has odd parity, and single bit errors are detected by the CRC. '''
+    rnd = random.Random(0)
+    for _ in range(number):
+        msg = bytes(rnd.randrange(128) for _ in range(rnd.randrange(1, 200)))
+        enc = clp.encode_message(msg)
+        assert enc == legacy_encode(msg.decode('ascii'))
+        assert all(bin(b).count('1') % 2 == 1 for b in enc)
+        dec = clp.decode_message(enc)
+        assert dec[:-2] == msg and clp.check_crc(dec)
+        bad = bytearray(dec)
+        bad[rnd.randrange(len(bad))] ^= 1 << rnd.randrange(7)
+        assert clp.check_crc(bytes(bad)) is False
+    print(f"round trip: {number} random messages ok")
+
+
+def parser_stream(chunk_size, frames=1000):
+    ''' Feed an encoded stream of status frames with some garbage to the frame parser '''
+    frame = clp.encode_message(b"s" + b"RNBQKBNRPPPPPPPP" + b"." * 32 + b"pppppppprnbqkbnr")
+    stream = (frame + b"\x00\xff") * frames
+    parser = clp.FrameParser()
+    received = 0
+    for i in range(0, len(stream), chunk_size):
+        received += len(parser.feed(memoryview(stream)[i:i + chunk_size]))
+    assert received == frames
+    return received
+
+
+def bench(name, func, number=20000):
+    t = timeit.timeit(func, number=number)
+    print(f"{name:<45} {t / number * 1e6:8.2f} us/call")
+    return t
+
+
+def main():
+    round_trip()
+    led_cmd = "L20" + "0F" * 81  # 165 bytes, as an 'L' frame
+    led_bytes = led_cmd.encode('ascii')
+    t_old = bench("legacy encode L frame", lambda: legacy_encode(led_cmd))
+    t_new = bench("encode_message L frame", lambda: clp.encode_message(led_bytes))
+    print(f"speedup: {t_old / t_new:.1f}x")
+
+    frame = clp.add_block_crc("s" + "RNBQKBNRPPPPPPPP" + "." * 32 + "pppppppprnbqkbnr")
+    frame_bytes = frame.encode('ascii')
+    raw = clp.encode_message(frame_bytes[:-2])
+    t_old = bench("legacy CRC check s frame", lambda: legacy_check(frame))
+    t_new = bench("check_crc s frame", lambda: clp.check_crc(frame_bytes))
+    print(f"speedup: {t_old / t_new:.1f}x")
+    bench("decode_message s frame", lambda: clp.decode_message(raw))
+    for chunk_size in (1, 20, 4096):
+        t = bench(f"FrameParser, 1000 frames, {chunk_size} byte chunks",
+                  lambda: parser_stream(chunk_size), number=5)
+        print(f"{1000 * 5 / t:.0f} frames/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+''' Bluetooth LE transport `chess_link_pyblue` against a simulated GATT peripheral
+
+Runs without Bluetooth hardware and without `bleak`: command round trips, led command
+coalescing, and reconnect with backoff after connection losses.
+
+Run from the `mchess` directory: `python benchmarks/bench_chess_link_pyblue.py`
+'''
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chess_link_pyblue  # noqa: E402
+import chess_link_sim  # noqa: E402
+
+
+def wait_for(que, prefix, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            msg = que.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if msg.startswith(prefix):
+            return msg
+    return None
+
+
+def round_trips(trans, que, count):
+    t0 = time.perf_counter()
+    for _ in range(count):
+        trans.write_mt("V")
+        assert wait_for(que, 'v') is not None
+    dt = time.perf_counter() - t0
+    print(f"{count} version round trips: {dt / count * 1000:.2f} ms each")
+
+
+def main():
+    peripheral = chess_link_sim.SimulatedPeripheral(mtu=20, ack_latency=0.005)
+    peripheral.board.reset_delay = 0.1
+    que = queue.Queue()
+    trans = chess_link_pyblue.Transport(que, client_factory=peripheral.client)
+    trans.min_backoff = 0.05
+    assert trans.open_mt("sim") is True
+    assert wait_for(que, 'agent-state: online') is not None
+
+    round_trips(trans, que, 200)
+
+    trans.write_mt("S")
+    assert wait_for(que, 's') is not None
+    for i in range(1000):
+        trans.write_mt("L20" + "%02X" % (i % 256) * 81)
+    trans.write_mt("S")
+    assert wait_for(que, 's') is not None
+    print(f"1000 led frames: {peripheral.board.stats['led_commands']} sent to the board")
+
+    peripheral.fail_connects = 3
+    t0 = time.perf_counter()
+    peripheral.drop_connection()
+    assert wait_for(que, 'agent-state: online') is not None
+    print(f"reconnected after 3 failed attempts in {time.perf_counter() - t0:.2f} s")
+    round_trips(trans, que, 20)
+    print(f"transport: {trans.stats()}")
+    trans.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+''' Record a session with the simulated board `chess_link_sim`, and replay it through `ChessLink`
+
+Random games are played on the simulated board with transport recording enabled
+(`record_file` in `chess_link_config.json`), a fraction of the board's replies is corrupted.
+The log is then replayed as fast as possible (`@0`) with the `chess_link_replay` transport,
+which decodes the recorded raw data with the frame parser. Checks that the parser drops the
+same corrupted frames and that ChessLink detects the same moves in the replay, and compares
+the board event latency of both runs.
+
+During the recording, the host registered the legal moves after each detected move, before
+the next move was made on the board. A replay at full speed would deliver the next move before
+the host can react, so the replay transport of this benchmark holds back the status frame that
+completes a recorded move until ChessLink has the legal moves for it. All other frames are
+delivered without delay.
+
+Run from the `mchess` directory: `python benchmarks/bench_chess_link_replay.py`
+'''
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chess  # noqa: E402
+import chess_link as cl  # noqa: E402
+import chess_link_recorder as clr  # noqa: E402
+import chess_link_replay  # noqa: E402
+from bench_chess_link_sim import drain, valid_moves, wait_for  # noqa: E402
+
+LOG_FILE = 'session.clrec'
+
+
+class LockstepQueue:
+    ''' Transport queue that holds back the frames of recorded moves until the host is ready '''
+
+    def __init__(self, que, transport):
+        self.que = que
+        self.transport = transport
+
+    def put(self, msg):
+        self.transport.wait_host(msg)
+        self.que.put(msg)
+
+
+class Transport(chess_link_replay.Transport):
+    ''' Replay transport in lockstep with the host, loaded by ChessLink as `bench_chess_link_replay` '''
+
+    def __init__(self, que, protocol_dbg=False):
+        super().__init__(LockstepQueue(que, self), protocol_dbg)
+        self.host = None
+        self.expected = []
+        self.next_move = 0
+        self.host_ready = threading.Event()
+        self.host_waits = 0
+
+    def wait_host(self, msg, timeout=5.0):
+        self.host_ready.wait(timeout)
+        if self.next_move >= len(self.expected) or msg[0] != 's' or len(msg) != 67:
+            return
+        position = cl.decode_raw_position(msg[1:65], self.host.orientation)
+        if position != self.expected[self.next_move]:
+            return
+        end = time.time() + timeout
+        while time.time() < end:
+            legal_moves = self.host.legal_moves
+            if legal_moves is not None and position in legal_moves:
+                break
+            self.host_waits += 1
+            time.sleep(0.0001)
+        self.next_move += 1
+
+
+def write_config(transport, address, record_file=""):
+    with open('chess_link_config.json', 'w') as f:
+        json.dump({'transport': transport, 'address': address, 'autodetect': False,
+                   'orientation': True, 'protocol_debug': False, 'btle_iface': 0,
+                   'record_file': record_file}, f)
+
+
+def wait_event(brd, appque, cmd, retries=3):
+    ''' Wait for a message, and request the position again if a corrupted frame was dropped '''
+    msg = wait_for(appque, cmd, timeout=0.5)
+    while msg is None and retries > 0:
+        brd.get_position()
+        msg = wait_for(appque, cmd, timeout=0.5)
+        retries -= 1
+    return msg
+
+
+def host_game(brd, appque, moves, sim=None, rnd=None, max_moves=40):
+    ''' Host side of one game: register the legal moves and wait for the move on the board.
+    With `sim`, random moves are played on the simulated board, otherwise `moves` is replayed.
+
+    :returns: list of detected moves
+    '''
+    board = chess.Board()
+    detected = []
+    while not board.is_game_over() and len(detected) < max_moves:
+        if sim is None and len(detected) == len(moves):
+            break
+        brd.move_from(board.fen(), valid_moves(board), brd.WHITE if board.turn else brd.BLACK)
+        if sim is not None:
+            mv = rnd.choice(list(board.legal_moves))
+            # The start position after a move would start a new game
+            board.push(mv)
+            start = board.board_fen() == chess.STARTING_BOARD_FEN
+            board.pop()
+            if start is True:
+                break
+            sim.move(mv.uci())
+        msg = wait_event(brd, appque, 'move')
+        if msg is None:
+            break
+        detected.append(msg['uci'])
+        board.push_uci(msg['uci'])
+    return detected
+
+
+def record(games, rnd, crc_error_rate):
+    write_config('chess_link_sim', 'sim', LOG_FILE)
+    appque = queue.Queue()
+    brd = cl.ChessLink(appque, 'bench')
+    sim = brd.trans.transport
+    sim.crc_error_rate = crc_error_rate
+    brd.get_version()
+    brd.get_position()
+    played = []
+    t0 = time.perf_counter()
+    for i in range(games):
+        if i > 0:
+            sim.set_position(chess.STARTING_FEN)
+        if wait_event(brd, appque, 'new_game') is None:
+            print("no new game detected")
+            break
+        played.append(host_game(brd, appque, None, sim, rnd))
+        sim.wait_idle()
+        drain(appque)
+    dt = time.perf_counter() - t0
+    stats = brd.event_latency_stats()
+    brd.quit()
+    return played, dt, stats, sim.parser.stats()
+
+
+def replay(played):
+    write_config('bench_chess_link_replay', f'{LOG_FILE}@0')
+    appque = queue.Queue()
+    t0 = time.perf_counter()
+    brd = cl.ChessLink(appque, 'bench')
+    trans = brd.trans
+    trans.host = brd
+    board = chess.Board()
+    for moves in played:
+        board.reset()
+        for uci in moves:
+            board.push_uci(uci)
+            trans.expected.append(brd.fen_to_position(board.fen()))
+    trans.host_ready.set()
+    detected = []
+    for moves in played:
+        if wait_event(brd, appque, 'new_game') is None:
+            print("no new game detected")
+            break
+        detected.append(host_game(brd, appque, moves))
+    trans.wait_finished(5.0)
+    dt = time.perf_counter() - t0
+    stats = brd.event_latency_stats()
+    brd.quit()
+    return detected, dt, stats, trans
+
+
+def print_latency(name, dt, stats):
+    print(f"{name:<10} {dt:6.2f} s, {stats['events']:4d} board events, latency "
+          f"median {stats['median_ms']:.3f} ms, p95 {stats['p95_ms']:.3f} ms, "
+          f"max {stats['max_ms']:.3f} ms")
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix='mchess-replay-')
+    os.chdir(tmp)
+    rnd = random.Random(1)
+    # One warning per dropped frame, the drops are compared below
+    logging.getLogger("ChessLinkParser").setLevel(logging.ERROR)
+
+    played, dt, stats, parser_stats = record(3, rnd, crc_error_rate=0.03)
+    records = clr.read_log(LOG_FILE)
+    written = [msg for _, direction, msg in records if direction == clr.WRITTEN]
+    raw = [msg for _, direction, msg in records if direction == clr.RAW]
+    print(f"recorded {sum(len(moves) for moves in played)} moves in {len(played)} games, "
+          f"{len(records)} records ({len(raw)} raw chunks, {sum(len(msg) for msg in raw)} "
+          f"bytes), log {os.path.getsize(LOG_FILE)} bytes")
+    print_latency('recording', dt, stats)
+
+    detected, dt, stats, trans = replay(played)
+    print_latency('replay @0', dt, stats)
+    same = detected == played
+    print(f"replay: {'same moves detected' if same else 'MOVES DIFFER'}, "
+          f"{sum(len(moves) for moves in detected)} moves, "
+          f"{len(trans.written)} commands written (recorded: {len(written)}), "
+          f"{trans.host_waits} waits for the host")
+    print(f"frame parser: recording {parser_stats}, replay {trans.stats()}: "
+          f"{'same' if parser_stats == trans.stats() else 'DIFFERENT'}")
+    if same is False:
+        for i, (a, b) in enumerate(zip(played, detected)):
+            if a != b:
+                print(f"game {i}: recorded {a}, replayed {b}")
+
+
+if __name__ == '__main__':
+    main()
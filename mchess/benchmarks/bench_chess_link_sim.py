@@ -0,0 +1,152 @@
+''' Load test of ChessLink and ChessLinkAgent with the simulated board `chess_link_sim`
+
+Run from the `mchess` directory: `python benchmarks/bench_chess_link_sim.py`
+'''
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chess  # noqa: E402
+import chess_link_agent  # noqa: E402
+import latency_trace as lt  # noqa: E402
+
+PREFS = {'ply_vis_delay': 80, 'max_plies_board': 3}
+
+
+def valid_moves(board):
+    ''' Legal moves as `TurquoiseDispatcher.valid_moves()` sends them to the agents '''
+    vals = {}
+    for mv in board.legal_moves:
+        board.push(mv)
+        vals[board.fen().split(' ')[0]] = mv.uci()
+        board.pop()
+    return vals
+
+
+def wait_for(appque, cmd, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            msg = appque.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if msg['cmd'] == cmd:
+            return msg
+    return None
+
+
+def drain(appque):
+    n = 0
+    while True:
+        try:
+            appque.get_nowait()
+            n += 1
+        except queue.Empty:
+            return n
+
+
+def frame_throughput(agent, sim, appque, count):
+    ''' Status frames at maximum rate, until all have been decoded by ChessLink '''
+    drain(appque)
+    t0 = time.perf_counter()
+    sim.frame_burst(count)
+    received = 0
+    while received < count:
+        msg = appque.get(timeout=5.0)
+        if msg['cmd'] == 'raw_board_position':
+            received += 1
+    dt = time.perf_counter() - t0
+    print(f"{count} status frames in {dt:.3f} s: {count / dt:.0f} events/s")
+
+
+def variant_display(agent, count):
+    ''' Cost of engine info display (`show_deltas`) for the calling (dispatcher) thread '''
+    board = chess.Board()
+    variants = [["e2e4", "e7e5", "g1f3", "b8c6"], ["d2d4", "d7d5", "c2c4", "e7e6"]]
+    t0 = time.perf_counter()
+    for i in range(count):
+        agent.visualize_variant(board, variants[i % 2], plies=3)
+    dt = time.perf_counter() - t0
+    print(f"{count} variant displays: {dt / count * 1e6:.1f} us/call")
+
+
+def play_games(agent, sim, appque, games, partial_every, rnd):
+    ''' Random games played on the simulated board, each move is detected by ChessLink '''
+    move_latency = []
+    moves = 0
+    missed = 0
+    for _ in range(games):
+        board = chess.Board()
+        lt.tracer.new_game()
+        sim.set_position(board.fen())
+        sim.wait_idle()
+        drain(appque)
+        while not board.is_game_over() and board.fullmove_number < 60:
+            mv = rnd.choice(list(board.legal_moves))
+            agent.set_valid_moves(board, valid_moves(board))
+            t0 = time.perf_counter()
+            # An aborted move in the start position would restore it and start a new game
+            if partial_every > 0 and moves % partial_every == 0 and board.ply() > 0:
+                sim.move(mv.uci(), partial=True)
+            sim.move(mv.uci())
+            msg = wait_for(appque, 'move', timeout=0.5)
+            retries = 0
+            while msg is None and retries < 3:
+                # Frame lost by crc error, request the current position as the host would
+                agent.cl_brd.get_position()
+                msg = wait_for(appque, 'move', timeout=0.5)
+                retries += 1
+            if msg is None or msg['uci'] != mv.uci():
+                missed += 1
+                break
+            move_latency.append(time.perf_counter() - t0)
+            lt.mark(board.ply(), 'dispatcher_move')
+            board.push(mv)
+            moves += 1
+    move_latency.sort()
+    if len(move_latency) > 0:
+        print(f"{moves} moves detected, {missed} missed, move latency: "
+              f"median {move_latency[len(move_latency) // 2] * 1000:.2f} ms, "
+              f"p95 {move_latency[int(len(move_latency) * 0.95)] * 1000:.2f} ms")
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix='mchess-sim-')
+    os.chdir(tmp)
+    with open('chess_link_config.json', 'w') as f:
+        json.dump({'transport': 'chess_link_sim', 'address': 'sim', 'autodetect': False,
+                   'orientation': True, 'protocol_debug': False, 'btle_iface': 0,
+                   'record_file': ""}, f)
+    appque = queue.Queue()
+    agent = chess_link_agent.ChessLinkAgent(appque, PREFS, timeout=5)
+    if agent.agent_ready() is False:
+        print("Simulated board not ready")
+        return
+    brd = agent.cl_brd
+    sim = brd.trans
+    rnd = random.Random(1)
+
+    frame_throughput(agent, sim, appque, 20000)
+    print(f"event latency: {brd.event_latency_stats()}")
+    variant_display(agent, 1000)
+
+    play_games(agent, sim, appque, 5, 0, rnd)
+    print("with aborted moves, jitter 1 ms and 5% crc errors:")
+    sim.jitter = 0.001
+    sim.crc_error_rate = 0.05
+    play_games(agent, sim, appque, 5, 3, rnd)
+    for stage, s in lt.tracer.summary().items():
+        print(f"{stage:<18} median {s['median_ms']:6.2f} ms, p95 {s['p95_ms']:6.2f} ms")
+    print(f"simulator: {sim.stats}")
+    print(f"leds: {brd.led_stats()}")
+    agent.quit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+''' Compact encoding of `current_move_info` vs. JSON
+
+Analysis messages of two engines with 4 variants each, generated from random positions in the
+format of the dispatcher. Checks that decoding restores the messages, compares message size and
+encode time, and measures the bytes per second received by a JSON client and by a client with
+compact encoding from `AsyncWebAgent`.
+
+Run from the `mchess` directory: `python benchmarks/bench_compact_info.py`
+'''
+import json
+import os
+import queue
+import random
+import sys
+import time
+import timeit
+
+import aiohttp
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import async_web_agent  # noqa: E402
+import compact_info  # noqa: E402
+from bench_async_web_agent import Clients, free_port, web_root  # noqa: E402
+
+
+def san_variant(board, variant):
+    ''' SAN variant as generated by `TurquoiseDispatcher.update_display_info()` '''
+    board = board.copy()
+    ml = []
+    mv = ''
+    if board.turn is False:
+        mv = (board.fullmove_number, '..')
+    for move in variant:
+        if board.turn is True:
+            mv = (board.fullmove_number,)
+        mv += (board.san(chess.Move.from_uci(move)),)
+        if board.turn is False:
+            ml.append(mv)
+            mv = ''
+        board.push(chess.Move.from_uci(move))
+    if mv != '' and len(mv) == 2:
+        ml.append(mv)
+    return ml
+
+
+def analysis_messages(count, seed=0):
+    rnd = random.Random(seed)
+    board = chess.Board()
+    msgs = []
+    while len(msgs) < count:
+        if board.is_game_over() or board.ply() > 120:
+            board = chess.Board()
+        board.push(rnd.choice(list(board.legal_moves)))
+        for actor in ('stockfish', 'lc0'):
+            for index in range(1, 5):
+                preview = board.copy()
+                variant = []
+                for ply in range(rnd.randrange(0, 16)):
+                    if preview.is_game_over():
+                        break
+                    move = rnd.choice(list(preview.legal_moves))
+                    variant.append(move.uci())
+                    preview.push(move)
+                msg = {'cmd': 'current_move_info', 'multipv_index': index, 'variant': variant,
+                       'actor': actor, 'score': round(rnd.uniform(-3, 3), 2),
+                       'depth': rnd.randrange(10, 30), 'seldepth': rnd.randrange(20, 45),
+                       'nps': rnd.randrange(100000, 3000000), 'tbhits': 0,
+                       'san_variant': san_variant(board, variant),
+                       'preview_fen': preview.fen()}
+                msgs.append(json.loads(json.dumps(msg)))
+    return msgs[:count]
+
+
+def round_trip(msgs):
+    encoder = compact_info.CompactInfoEncoder()
+    for msg in msgs:
+        packed, _ = encoder.encode(msg)
+        packed = json.loads(json.dumps(packed))
+        assert compact_info.decode(packed, encoder.schema()) == msg, msg
+    print(f"round trip: {len(msgs)} messages ok")
+
+
+def sizes(msgs):
+    encoder = compact_info.CompactInfoEncoder()
+    json_bytes = sum(len(json.dumps(msg).encode('utf-8')) for msg in msgs)
+    compact_bytes = sum(len(json.dumps(encoder.encode(msg)[0], separators=(',', ':')).encode('utf-8'))
+                        for msg in msgs)
+    t_json = timeit.timeit(lambda: [json.dumps(msg).encode('utf-8') for msg in msgs], number=5)
+    t_compact = timeit.timeit(lambda: [json.dumps(encoder.encode(msg)[0], separators=(',', ':'))
+                                       .encode('utf-8') for msg in msgs], number=5)
+    n = len(msgs) * 5
+    print(f"JSON    {json_bytes / len(msgs):6.0f} bytes per message, encode {t_json / n * 1e6:5.1f} us")
+    print(f"compact {compact_bytes / len(msgs):6.0f} bytes per message, encode "
+          f"{t_compact / n * 1e6:5.1f} us, {compact_bytes / json_bytes * 100:.0f}% of JSON")
+
+
+class CompactClients(Clients):
+    ''' Clients that negotiate the compact encoding '''
+
+    async def _connect(self, count):
+        session = aiohttp.ClientSession()
+        self.sessions.append(session)
+        for _ in range(count):
+            ws = await session.ws_connect(self.url)
+            await ws.send_str(json.dumps({'cmd': 'encoding', 'compact_info': 1,
+                                          'actor': 'bench'}))
+            self.loop.create_task(self._reader(ws))
+
+
+def live(msgs, rate=80, duration=3.0):
+    ''' Analysis traffic at `rate` messages per second to a JSON and a compact client '''
+    cwd = os.getcwd()
+    os.chdir(web_root())
+    port = free_port()
+    agent = async_web_agent.AsyncWebAgent(queue.Queue(), {'port': port, 'bind_address': 'localhost'})
+    agent.log.setLevel('WARNING')
+    while agent.event_loop.is_running() is False:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    json_client = Clients(f"http://localhost:{port}/ws")
+    compact_client = CompactClients(f"http://localhost:{port}/ws")
+    json_client.connect(1)
+    compact_client.connect(1)
+    while len(agent.ws_clients) < 2 or not any(cq.compact for cq in agent.ws_queues.values()):
+        time.sleep(0.01)
+    json_client.bytes = 0
+    compact_client.bytes = 0
+    t0 = time.perf_counter()
+    n = int(rate * duration)
+    for i in range(n):
+        agent.display_info(None, msgs[i % len(msgs)])
+        time.sleep(max(0.0, t0 + (i + 1) / rate - time.perf_counter()))
+    time.sleep(0.2)
+    dt = time.perf_counter() - t0
+    print(f"{rate} messages/s: JSON client {json_client.bytes / dt:8.0f} bytes/s, compact client "
+          f"{compact_client.bytes / dt:8.0f} bytes/s")
+    json_client.close()
+    compact_client.close()
+    agent.active = False
+    os.chdir(cwd)
+
+
+def main():
+    msgs = analysis_messages(2000)
+    round_trip(msgs)
+    sizes(msgs)
+    live(msgs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+''' Page load of the web client: in-memory precompressed assets vs. files served from disk
+
+Fetches the files of a page load (index, script, style, favicon, images and an npm package) from
+`AsyncWebAgent` and from a plain aiohttp server with `FileResponse` and `web.static`, as the web
+agent served them before. Reports bytes transferred and time for cold loads, and for reloads
+with `If-None-Match` revalidation.
+
+Run from the `mchess` directory: `python benchmarks/bench_static_assets.py`
+'''
+import asyncio
+import os
+import queue
+import sys
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import async_web_agent  # noqa: E402
+from bench_async_web_agent import free_port, web_root  # noqa: E402
+
+NPM_FILE = 'node_modules/cm-chessboard/src/cm-chessboard/Chessboard.js'
+
+
+def page_files():
+    files = ['', 'scripts/mchess.js', 'styles/mchess.css', 'favicon.ico', NPM_FILE]
+    files += ['images/' + name for name in sorted(os.listdir('web/images'))]
+    return files
+
+
+def file_server(port):
+    ''' The web agent's static file routes up to version 0.4 '''
+    app = web.Application()
+    app.add_routes([web.static('/node_modules', 'web/node_modules'),
+                    web.static('/images', 'web/images'),
+                    web.get('/', lambda request: web.FileResponse('web/index.html')),
+                    web.get('/favicon.ico', lambda request: web.FileResponse('web/favicon.ico')),
+                    web.get('/scripts/mchess.js',
+                            lambda request: web.FileResponse('web/scripts/mchess.js')),
+                    web.get('/styles/mchess.css',
+                            lambda request: web.FileResponse('web/styles/mchess.css'))])
+    loop = asyncio.new_event_loop()
+
+    async def start():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, 'localhost', port).start()
+    loop.run_until_complete(start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+async def page_load(port, etags=None, rounds=20):
+    ''' Fetch all files of a page, `etags` from a previous load are sent as If-None-Match '''
+    headers = {'Accept-Encoding': 'gzip, deflate, br'}
+    new_etags = {}
+    transferred = 0
+    statuses = {}
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession(auto_decompress=False) as session:
+        for _ in range(rounds):
+            for path in page_files():
+                h = dict(headers)
+                if etags is not None and etags.get(path) is not None:
+                    h['If-None-Match'] = etags[path]
+                async with session.get(f"http://localhost:{port}/{path}", headers=h) as resp:
+                    body = await resp.read()
+                    transferred += len(body)
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                    new_etags[path] = resp.headers.get('ETag')
+    dt = (time.perf_counter() - t0) / rounds
+    return dt, transferred // rounds, new_etags, statuses
+
+
+def report(name, port):
+    dt, size, etags, statuses = asyncio.run(page_load(port))
+    print(f"{name:<22} cold load {dt * 1000:7.2f} ms, {size:8d} bytes, status {statuses}")
+    dt, size, _, statuses = asyncio.run(page_load(port, etags))
+    print(f"{name:<22} reload    {dt * 1000:7.2f} ms, {size:8d} bytes, status {statuses}")
+
+
+def main():
+    cwd = os.getcwd()
+    os.chdir(web_root())
+    npm_file = os.path.join('web', NPM_FILE)
+    if not os.path.exists(npm_file):
+        # Stand-in for the npm package: about the size of cm-chessboard and chart.js
+        os.makedirs(os.path.dirname(npm_file))
+        with open(os.path.join(cwd, 'web/scripts/mchess.js'), 'rb') as f:
+            script = f.read()
+        with open(npm_file, 'wb') as f:
+            f.write(script * (300000 // len(script)))
+    file_port = free_port()
+    file_server(file_port)
+    report('FileResponse (disk)', file_port)
+
+    port = free_port()
+    agent = async_web_agent.AsyncWebAgent(queue.Queue(), {'port': port, 'bind_address': 'localhost'})
+    while agent.event_loop.is_running() is False:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    report('StaticAssets (memory)', port)
+
+    _, _, etags, _ = asyncio.run(page_load(port, rounds=1))
+    with open('web/styles/mchess.css', 'rb') as f:
+        style = f.read()
+    os.unlink('web/styles')
+    os.makedirs('web/styles')
+    with open('web/styles/mchess.css', 'wb') as f:
+        f.write(style + b'\n/* changed */\n')
+    time.sleep(agent.assets.check_interval + 0.1)
+    _, _, _, statuses = asyncio.run(page_load(port, etags, rounds=1))
+    print(f"reload after changing mchess.css: status {statuses}, {agent.assets.stats()}")
+    agent.active = False
+    os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
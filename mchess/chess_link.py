@@ -17,14 +17,67 @@ import threading
 import queue
 import json
 import importlib
-import copy
+import operator
+import collections
+import re
 
 import chess_link_protocol as clp
+import chess_link_recorder as clr
+import latency_trace as lt
 
 # See document:
 # `magic-board.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>_
 # for details on the Chess Link protocol.
 
+# `position` byte values
+EMPTY = ord('.')
+_PIECES = frozenset("PNBRQK.pnbrqk")
+# Index permutations raw frame -> `position` for both orientations, the raw frame
+# lists the board ranks 1..8 with files h..a when the cable is on the right side.
+_RAW_ORDER = {True: operator.itemgetter(*[7 - x + y * 8 for y in range(8) for x in range(8)]),
+              False: operator.itemgetter(*[x + (7 - y) * 8 for y in range(8) for x in range(8)])}
+_FEN_EXPAND = str.maketrans({str(n): '.' * n for n in range(1, 9)})
+_FEN_EMPTY_RUN = re.compile(r'\.+')
+START_POSITION = b"RNBQKBNR" + b"P" * 8 + b"." * 32 + b"p" * 8 + b"rnbqkbnr"
+# Start position as seen by a board with wrong orientation setting
+START_POSITION_INVERTED = START_POSITION[::-1]
+# The board has a 9x9 led grid at the corners of the squares. Indices of the four leds
+# of each square in the row-major 81 led list of an 'L' command, for both orientations.
+_LED_CORNERS = {True: [((7 - x) * 9 + y, (8 - x) * 9 + y, (7 - x) * 9 + y + 1, (8 - x) * 9 + y + 1)
+                       for y in range(8) for x in range(8)],
+                False: [(x * 9 + 7 - y, (x + 1) * 9 + 7 - y, x * 9 + 8 - y, (x + 1) * 9 + 8 - y)
+                        for y in range(8) for x in range(8)]}
+
+
+def decode_raw_position(raw, orientation):
+    """
+    Decode the 64 board characters of a ChessLink 's' frame into a `position`.
+
+    :param raw: string with 64 characters (frame without 's' and CRC).
+    :param orientation: True: cable right, False: cable left.
+    :returns: `position` bytes, None if raw contains invalid characters.
+    """
+    if not _PIECES.issuperset(raw):
+        return None
+    return "".join(_RAW_ORDER[orientation](raw)).encode('ascii')
+
+
+class TimedQueue(queue.Queue):
+    """
+    Transport event queue that records the time each event is put.
+
+    Transports use `put()` as for any `queue.Queue`, `get()` returns a tuple
+    (time.perf_counter() at put, event). If `recorder` is set, agent-state events (and
+    optionally all other events) are also written to the transport log, see
+    `chess_link_recorder`.
+    """
+    recorder = None
+
+    def _put(self, item):
+        self.queue.append((time.perf_counter(), item))
+        if self.recorder is not None and item is not None:
+            self.recorder.record_message(item)
+
 
 class ChessLink:
     """
@@ -34,11 +87,12 @@ class ChessLink:
     For the details of the Chess Link protocol, please refer to:
     `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
 
-    `position` array
+    `position`
 
-    This class refers to chess boards using the `position` 8x8 array. Field values: 1: white pawn,
-    2: w-knight, 3: w-bishop, 4: w-rook, 5: w-queen, 6: w-king, 0: empty square, -1; black pawn,
-    -2: b-knight, -3: b-bishop, -4: b-rook, -5: b-queen, -6: b-king.
+    This class refers to chess boards using `position`, a 64 byte `bytes` object. Index is the
+    square number (a1=0, b1=1, .. h8=63, same as python-chess), values are the FEN piece
+    characters `PNBRQKpnbrqk` and `.` (`EMPTY`) for an empty square. Positions are immutable
+    and hashable, they can be compared and used as dictionary keys directly.
 
     Communcation with the Chess Link board is asynchronous. Replies from the board are written
     to the python queue (`appqueue`) that is provided during instantiation.
@@ -88,10 +142,8 @@ class ChessLink:
         self.version = "0.3.0"
         self.board_version = "---"
         self.name = name
-        self.figrep = {"int": [1, 2, 3, 4, 5, 6, 0, -1, -2, -3, -4, -5, -6],
-                       "ascii": "PNBRQK.pnbrqk"}
-        self.transports = {'Darwin': ['chess_link_usb'], 'Linux': [
-            'chess_link_bluepy', 'chess_link_usb'], 'Windows': ['chess_link_usb']}
+        self.transports = {'Darwin': ['chess_link_usb', 'chess_link_pyblue'], 'Linux': [
+            'chess_link_bluepy', 'chess_link_usb'], 'Windows': ['chess_link_usb', 'chess_link_pyblue']}
 
         self.log = logging.getLogger('ChessLink')
         self.log.debug("Chess Link starting")
@@ -116,13 +168,31 @@ class ChessLink:
         self.board_mutex = threading.Lock()
         self.is_new_game = False
         self.trans = None
-        self.trque = queue.Queue()  # asyncio.Queue()
+        self.trque = TimedQueue()
+        self.event_latencies = collections.deque(maxlen=1000)
         self.mill_config = None
         self.connected = False
         self.position = None
         self.reference_position = None
         self.orientation = True
         self.legal_moves = None
+        self.lifted_frames = None
+        self.move_id = None
+        # LED frame cache: encoded 'L' commands by (delta pattern, freq, ontimes, orientation),
+        # and the last LED command sent, identical frames are not sent again.
+        self.led_frame_cache = {}
+        self.led_frame_cache_size = 256
+        self.last_led_cmd = None
+        self.led_writes = 0
+        self.led_writes_saved = 0
+        # LED scheduler: callers set the desired led frame, the led worker thread sends
+        # the latest one, at most one frame per led_min_interval seconds.
+        self.led_cv = threading.Condition()
+        self.led_pending = None
+        self.led_min_interval = 0.05
+        self.led_last_write = 0.0
+        self.led_frames_merged = 0
+        self.led_trace_id = None
         found_board = False
 
         self.thread_active = True
@@ -130,6 +200,9 @@ class ChessLink:
             target=self._event_worker_thread, args=(self.trque, self.board_mutex))
         self.event_thread.setDaemon(True)
         self.event_thread.start()
+        self.led_thread = threading.Thread(target=self._led_worker_thread)
+        self.led_thread.setDaemon(True)
+        self.led_thread.start()
 
         self.mill_config = None
         try:
@@ -144,6 +217,12 @@ class ChessLink:
                 if 'btle_iface' not in self.mill_config:
                     self.mill_config['btle_iface'] = 0
                     self.write_configuration()
+                if 'record_file' not in self.mill_config:
+                    self.mill_config['record_file'] = ""
+                    self.write_configuration()
+                if 'record_messages' not in self.mill_config:
+                    self.mill_config['record_messages'] = False
+                    self.write_configuration()
                 if 'transport' in self.mill_config and 'address' in self.mill_config:
                     self.log.debug("Checking default configuration for board via "
                                    f"{self.mill_config['transport']} "
@@ -152,6 +231,7 @@ class ChessLink:
                     trans = self._open_transport(self.mill_config['transport'],
                                                  self.mill_config['protocol_debug'])
                     if trans is not None:
+                        self._init_handle_cache(trans)
                         if trans.test_board(self.mill_config['address']) is not None:
                             self.log.debug('Default board config used.')
                             found_board = True
@@ -194,8 +274,12 @@ class ChessLink:
                             if tr.is_init() is True:
                                 self.log.debug(
                                     f"Transport {tr.get_name()} loaded.")
+                                handles = None
                                 if self.mill_config is not None:
                                     btle = self.mill_config['btle_iface']
+                                    # Transports with cached handles can skip the scan
+                                    self._init_handle_cache(tr)
+                                    handles = self.mill_config.get('ble_handles')
                                 else:
                                     btle = 0
                                 address = tr.search_board(btle)
@@ -204,7 +288,10 @@ class ChessLink:
                                                    "at address {address}")
                                     self.mill_config = {
                                         'transport': tr.get_name(), 'address': address}
+                                    if handles is not None and handles.get('address') == address:
+                                        self.mill_config['ble_handles'] = handles
                                     self.trans = tr
+                                    self._init_handle_cache(tr)
                                     self.write_configuration()
                                     break
                             else:
@@ -230,6 +317,7 @@ class ChessLink:
                             'Do not run as root, once intial BLE scan is done.')
                 self.log.debug(f"Connecting to Chess Link via {self.mill_config['transport']} "
                                "at {self.mill_config['address']}")
+                self._start_recording()
                 self.connected = self.trans.open_mt(
                     self.mill_config['address'])
                 if self.connected is True:
@@ -255,6 +343,52 @@ class ChessLink:
         if self.trans is not None:
             self.trans.quit()
         self.thread_active = False
+        self.trque.put(None)
+        with self.led_cv:
+            self.led_cv.notify()
+        st = self.event_latency_stats()
+        if st is not None:
+            self.log.info(f"Board event latency: {st['events']} events, min {st['min_ms']:.2f} ms, "
+                          f"median {st['median_ms']:.2f} ms, p95 {st['p95_ms']:.2f} ms, "
+                          f"max {st['max_ms']:.2f} ms")
+        st = self.led_stats()
+        self.log.info(f"Leds: {st['led_writes']} writes, {st['led_writes_saved']} identical "
+                      f"frames skipped, {st['led_frames_merged']} frames merged, "
+                      f"{st['cached_frames']} cached frames")
+
+    def _init_handle_cache(self, trans):
+        """
+        Bluetooth LE transports that support it get the cached GATT handles from
+        'chess_link_config.json' (`ble_handles`), and store newly discovered handles there.
+        """
+        set_cache = getattr(trans, "set_handle_cache", None)
+        if callable(set_cache):
+            set_cache(self.mill_config.get('ble_handles'), self._store_handle_cache)
+
+    def _store_handle_cache(self, cache):
+        self.log.debug(f"Storing Bluetooth LE handles {cache}")
+        self.mill_config['ble_handles'] = cache
+        self.write_configuration()
+
+    def _start_recording(self):
+        """
+        Record all transport traffic to a log file, if `record_file` is configured in
+        'chess_link_config.json'. `record_messages: true` additionally records the decoded
+        board replies. See `chess_link_recorder` and `chess_link_replay`.
+
+        The log is opened once, connection retries continue to record into the same log.
+        """
+        record_file = self.mill_config.get('record_file', "")
+        if record_file == "" or isinstance(self.trans, clr.RecordingTransport):
+            return
+        if self.trque.recorder is None:
+            try:
+                self.trque.recorder = clr.Recorder(
+                    record_file, self.mill_config.get('record_messages', False))
+            except Exception as e:
+                self.log.error(f"Cannot record transport traffic to {record_file}: {e}")
+                return
+        self.trans = clr.RecordingTransport(self.trans, self.trque.recorder)
 
     def position_initialized(self):
         """
@@ -283,6 +417,8 @@ class ChessLink:
             self.mill_config['btle_iface'] = 0
         if 'autodetect' not in self.mill_config:
             self.mill_config['autodetect'] = True
+        if 'record_file' not in self.mill_config:
+            self.mill_config['record_file'] = ""
         try:
             with open("chess_link_config.json", "w") as f:
                 json.dump(self.mill_config, f, indent=4)
@@ -297,146 +433,160 @@ class ChessLink:
         This background thread is started on creation of a ChessLink object.
         It decodes chess link encoded messages and sends json messages to the application.
 
+        The thread blocks on the transport queue `que` and is woken up only by board events,
+        `quit()` terminates it by sending `None`.
+
         The event worker thread is automatically started during __init__.
         """
         self.log.debug('Chess Link worker thread started.')
         while self.thread_active:
-            if self.trque.empty() is False:
-                msg = self.trque.get()
-                token = 'agent-state: '
-                if msg[:len(token)] == token:
-                    toks = msg[len(token):]
-                    i = toks.find(' ')
-                    if i != -1:
-                        state = toks[:i]
-                        emsg = toks[i + 1:]
-                    else:
-                        state = toks
-                        emsg = ''
-                    self.log.info(
-                        f"Agent state of {self.name} changed to {state}, {emsg}")
-                    if state == 'offline':
-                        self.error_condition = True
-                    else:
-                        self.error_condition = False
-                    self.appque.put({'cmd': 'agent_state', 'state': state, 'message': emsg, 'version': f"{self.version} ChessLink: {self.board_version}",
-                                     'class': 'board', 'actor': self.name})
-                    continue
+            t_event, msg = que.get()
+            if msg is None:
+                break
+            self._handle_event(msg, mutex, t_event)
+            if len(msg) > 0 and msg[0] == 's':
+                self.event_latencies.append(time.perf_counter() - t_event)
+        self.log.debug('Chess Link worker thread stopped.')
 
-                if len(msg) > 0:
-                    if msg[0] == 's':
-                        if len(msg) == 67:
-                            rp = msg[1:65]
-                            val_pos = True
-                            position = [
-                                [0 for x in range(8)] for y in range(8)]
-                            if len(rp) == 64:
-                                for y in range(8):
-                                    for x in range(8):
-                                        c = rp[7 - x + y * 8]
-                                        i = self.figrep['ascii'].find(c)
-                                        if i == -1:
-                                            self.log.warning(
-                                                f"Invalid char in raw position: {c}")
-                                            val_pos = False
-                                            continue
-                                        else:
-                                            f = self.figrep['int'][i]
-                                            if self.orientation is True:
-                                                position[y][x] = f
-                                            else:
-                                                position[7 - y][7 - x] = f
-                            else:
-                                val_pos = False
-                                self.log.warning(
-                                    f"Error in board position, received {len(rp)}")
-                                continue
-                        else:
-                            val_pos = False
-                            self.log.error(f'Incomplete board position, {msg}')
-                        if val_pos is True:
-                            fen = self.position_to_fen(position)
-                            sfen = self.short_fen(fen)
-                            if sfen == "RNBKQBNR/PPPPPPPP/8/8/8/8/pppppppp/rnbkqbnr":
-                                if self.orientation is True:
-                                    self.log.debug(
-                                        "Cable-left board detected.")
-                                    self.orientation = False
-                                    self.write_configuration()
-                                    position_inv = copy.deepcopy(position)
-                                    for x in range(8):
-                                        for y in range(8):
-                                            position[x][y] = position_inv[7 - x][7 - y]
-                                else:
-                                    self.log.debug(
-                                        "Cable-right board detected.")
-                                    self.orientation = True
-                                    self.write_configuration()
-                                    position_inv = copy.deepcopy(position)
-                                    for x in range(8):
-                                        for y in range(8):
-                                            position[x][y] = position_inv[7 - x][7 - y]
-                            fen = self.position_to_fen(position)
-                            sfen = self.short_fen(fen)
-
-                            if sfen == "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR":
-                                if self.is_new_game is False:
-                                    self.is_new_game = True   # XXX changed on cleanup
-                                    cmd = {'cmd': 'new_game', 'actor': self.name,
-                                           'orientation': self.orientation}  # XXX: orientation?!
-                                    self.new_game(position)
-                                    self.appque.put(cmd)
-                            else:
-                                self.is_new_game = False
-
-                            with mutex:
-                                self.position = copy.deepcopy(position)
-                                if self.reference_position is None:
-                                    self.reference_position = copy.deepcopy(
-                                        position)
-                                self.show_delta(
-                                    self.reference_position, self.position)
-                            # self.print_position_ascii(position)
-                            self.appque.put(
-                                {'cmd': 'raw_board_position', 'fen': fen, 'actor': self.name})
-                            self._check_move(position)
-                    if msg[0] == 'v':
-                        self.log.debug('got version reply')
-                        if len(msg) == 7:
-                            version = '{}.{}'.format(
-                                msg[1] + msg[2], msg[3] + msg[4])
-                            self.board_version = version
-                            # self.appque.put(
-                            #     {'version': version, 'actor': self.name})
-                        else:
-                            self.log.warning(
-                                f"Bad length of version-reply: {len(version)}")
-
-                    if msg[0] == 'l':
-                        self.log.debug('got led-set reply')
-                    if msg[0] == 'x':
-                        self.log.debug('got led-off reply')
-                    if msg[0] == 'w':
-                        self.log.debug('got write-register reply')
-                        if len(msg) == 7:
-                            reg_cont = '{}->{}'.format(
-                                msg[1] + msg[2], msg[3] + msg[4])
-                            self.log.debug(f'Register written: {reg_cont}')
+    def _handle_event(self, msg, mutex, t_event=None):
+        """
+        Decode a single chess link message received from the transport.
+
+        :param msg: message
+        :param t_event: `time.perf_counter()` time the transport received the message
+        """
+        token = 'agent-state: '
+        if msg[:len(token)] == token:
+            toks = msg[len(token):]
+            i = toks.find(' ')
+            if i != -1:
+                state = toks[:i]
+                emsg = toks[i + 1:]
+            else:
+                state = toks
+                emsg = ''
+            self.log.info(
+                f"Agent state of {self.name} changed to {state}, {emsg}")
+            if state == 'offline':
+                self.error_condition = True
+            else:
+                self.error_condition = False
+            # Board led state is unknown after connection changes
+            with self.led_cv:
+                self.last_led_cmd = None
+            self.appque.put({'cmd': 'agent_state', 'state': state, 'message': emsg, 'version': f"{self.version} ChessLink: {self.board_version}",
+                             'class': 'board', 'actor': self.name})
+            return
+
+        if len(msg) > 0:
+            if msg[0] == 's':
+                if len(msg) == 67:
+                    rp = msg[1:65]
+                    val_pos = True
+                    position = decode_raw_position(rp, self.orientation)
+                    t_decoded = time.perf_counter()
+                    if position is None:
+                        val_pos = False
+                        self.log.warning(f"Invalid char in raw position: {rp}")
+                else:
+                    val_pos = False
+                    self.log.error(f'Incomplete board position, {msg}')
+                if val_pos is True:
+                    if position == START_POSITION_INVERTED:
+                        if self.orientation is True:
+                            self.log.debug(
+                                "Cable-left board detected.")
+                            self.orientation = False
                         else:
-                            self.log.warning(
-                                f'Invalid length {len(msg)} for write-register reply')
-                    if msg[0] == 'r':
-                        self.log.debug('got read-register reply')
-                        if len(msg) == 7:
-                            reg_cont = '{}->{}'.format(
-                                msg[1] + msg[2], msg[3] + msg[4])
-                            self.log.debug(f'Register content: {reg_cont}')
+                            self.log.debug(
+                                "Cable-right board detected.")
+                            self.orientation = True
+                        with mutex:
+                            # Precomputed led frames are only valid for the old orientation
+                            self.lifted_frames = None
+                        self.write_configuration()
+                        position = position[::-1]
+
+                    if position == START_POSITION:
+                        if self.is_new_game is False:
+                            self.is_new_game = True   # XXX changed on cleanup
+                            cmd = {'cmd': 'new_game', 'actor': self.name,
+                                   'orientation': self.orientation}  # XXX: orientation?!
+                            self.new_game(position)
+                            self.appque.put(cmd)
+                    else:
+                        self.is_new_game = False
+
+                    with mutex:
+                        self.position = position
+                        if self.reference_position is None:
+                            self.reference_position = position
+                        lifted_frame = None
+                        if self.lifted_frames is not None:
+                            lifted_frame = self.lifted_frames.get(position)
+                        if lifted_frame is not None:
+                            # A piece with legal moves has been lifted, show its targets
+                            self._write_led(lifted_frame)
                         else:
-                            self.log.warning(
-                                f'Invalid length {len(msg)} for read-register reply')
+                            self.show_delta(
+                                self.reference_position, self.position)
+                    # self.print_position_ascii(position)
+                    self.appque.put(
+                        {'cmd': 'raw_board_position', 'fen': self.position_to_fen(position),
+                         'actor': self.name})
+                    self._check_move(position, t_event, t_decoded)
+            if msg[0] == 'v':
+                self.log.debug('got version reply')
+                if len(msg) == 7:
+                    version = '{}.{}'.format(
+                        msg[1] + msg[2], msg[3] + msg[4])
+                    self.board_version = version
+                    # self.appque.put(
+                    #     {'version': version, 'actor': self.name})
+                else:
+                    self.log.warning(
+                        f"Bad length of version-reply: {len(version)}")
+
+            if msg[0] == 'l':
+                self.log.debug('got led-set reply')
+            if msg[0] == 'x':
+                self.log.debug('got led-off reply')
+            if msg[0] == 'w':
+                self.log.debug('got write-register reply')
+                if len(msg) == 7:
+                    reg_cont = '{}->{}'.format(
+                        msg[1] + msg[2], msg[3] + msg[4])
+                    self.log.debug(f'Register written: {reg_cont}')
+                else:
+                    self.log.warning(
+                        f'Invalid length {len(msg)} for write-register reply')
+            if msg[0] == 'r':
+                self.log.debug('got read-register reply')
+                if len(msg) == 7:
+                    reg_cont = '{}->{}'.format(
+                        msg[1] + msg[2], msg[3] + msg[4])
+                    self.log.debug(f'Register content: {reg_cont}')
+                else:
+                    self.log.warning(
+                        f'Invalid length {len(msg)} for read-register reply')
 
-            else:
-                time.sleep(0.01)
+    def event_latency_stats(self):
+        """
+        Latency statistics for board position events, measured from the transport putting
+        the raw event into the transport queue until all resulting messages have been sent
+        to `appque`, over the last (max. 1000) events.
+
+        :returns: dictionary with number of events and min, median, 95th percentile and max
+                  latency in ms, None if no events have been received.
+        """
+        lat = sorted(self.event_latencies)
+        if len(lat) == 0:
+            return None
+        return {'events': len(lat),
+                'min_ms': lat[0] * 1000.0,
+                'median_ms': lat[len(lat) // 2] * 1000.0,
+                'p95_ms': lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000.0,
+                'max_ms': lat[-1] * 1000.0}
 
     def new_game(self, pos):
         """
@@ -449,18 +599,28 @@ class ChessLink:
         self.reference_position = pos
         self.set_led_off()
         self.legal_moves = None
+        self.lifted_frames = None
 
-    def _check_move(self, pos):
+    def _check_move(self, pos, t_event=None, t_decoded=None):
         """
         Check, if current change on board is a legal move. If yes, put move into queue
         `appqueue`. This function is called by the background thread. In order for
         it to be called, `move_from` needs to have been called before.
+
+        :param pos: `position` on board
+        :param t_event: time the position was received, for latency tracing
+        :param t_decoded: time the position was decoded, for latency tracing
         """
-        fen = self.short_fen(self.position_to_fen(pos))
-        if self.legal_moves is not None and fen in self.legal_moves:
+        legal_moves = self.legal_moves
+        if legal_moves is not None and pos in legal_moves:
+            if self.move_id is not None and t_event is not None:
+                lt.mark(self.move_id, 'transport_receive', t_event)
+                lt.mark(self.move_id, 'decode', t_decoded)
+                lt.mark(self.move_id, 'check_move')
             self.appque.put(
-                {'cmd': 'move', 'uci': self.legal_moves[fen], 'actor': self.name})
+                {'cmd': 'move', 'uci': legal_moves[pos], 'actor': self.name})
             self.legal_moves = None
+            self.lifted_frames = None
             self.reference_position = pos
             self.set_led_off()
             return True
@@ -473,6 +633,8 @@ class ChessLink:
         move using the python queue `appqueue` given during initialization.
 
         Non-legal changes or incomplete moves will cause the affected fields to blink continously.
+        Lifting a piece that has legal moves lights its square and all its legal target squares
+        instead, the positions and led frames for this are precomputed here.
 
         :param fen: current position
         :param legal_moves: dictionary of key:fen value: uci_move (e.g. e2e4). python_chess
@@ -482,9 +644,15 @@ class ChessLink:
         """
         if self.connected is True:
             if eval_only is False:
-                self.legal_moves = legal_moves
                 self.turn = color
+                self.move_id = lt.fen_ply(fen)
+                if self.move_id is not None and self.move_id > 0:
+                    # The next led frame shows the last move
+                    self.led_trace_id = self.move_id - 1
                 self.reference_position = self.fen_to_position(fen)
+                self.lifted_frames = self._lifted_frames(self.reference_position, legal_moves)
+                self.legal_moves = {self.fen_to_position(mv_fen): uci
+                                    for mv_fen, uci in legal_moves.items()}
                 with self.board_mutex:
                     self.show_delta(self.reference_position, self.position)
             else:
@@ -496,6 +664,35 @@ class ChessLink:
             self.log.warning(
                 "Not connected to Chess Link.")
 
+    def _lifted_frames(self, position, legal_moves):
+        """
+        Precompute the board positions that occur when a piece with legal moves is lifted
+        (its square empty), and the led frame that shows the piece's origin and all its
+        legal target squares.
+
+        :param position: `position` before the move.
+        :param legal_moves: dictionary of key:fen value: uci_move, see `move_from()`.
+        :returns: dictionary `position` with lifted piece: encoded led command.
+        """
+        if position is None:
+            return None
+        targets = {}
+        for uci in legal_moves.values():
+            if len(uci) < 4 or uci == '0000':
+                continue
+            from_sq = (ord(uci[1]) - ord('1')) * 8 + ord(uci[0]) - ord('a')
+            to_sq = (ord(uci[3]) - ord('1')) * 8 + ord(uci[2]) - ord('a')
+            targets.setdefault(from_sq, set()).add(to_sq)
+        frames = {}
+        for from_sq, to_sqs in targets.items():
+            lifted = position[:from_sq] + b'.' + position[from_sq + 1:]
+            dpos = [0] * 64
+            dpos[from_sq] = 1
+            for to_sq in to_sqs:
+                dpos[to_sq] = 2
+            frames[lifted] = self._encode_led_frame(dpos, 0x20, 0x0f, 0xf0)
+        return frames
+
     def show_deltas(self, positions, freq):
         """
         Signal leds to show difference between current position on board, and intended position.
@@ -503,7 +700,7 @@ class ChessLink:
 
         Up to four half-moves can be indicated at sequence of up to 5 positions.
 
-        :param positions: array of `position` arrays. Max length is 5 (4 half-moves incl. start
+        :param positions: list of `position`. Max length is 5 (4 half-moves incl. start
                           position)
         :param freq: Blink frequency
         """
@@ -512,71 +709,58 @@ class ChessLink:
                 npos = 5
             else:
                 npos = len(positions)
-            dpos = [[0 for x in range(8)] for y in range(8)]
+            dpos = [0] * 64
             for ply in range(npos - 1):
                 frame = ply * 2
-                for y in range(8):
-                    for x in range(8):
-                        if positions[ply + 1][y][x] != positions[ply][y][x]:
-                            if positions[ply][y][x] != 0:
-                                dpos[y][x] |= 1 << (7 - frame)
-                            else:
-                                dpos[y][x] |= 1 << (7 - (frame + 1))
+                from_bit = 1 << (7 - frame)
+                to_bit = 1 << (7 - (frame + 1))
+                for sq, (f1, f2) in enumerate(zip(positions[ply], positions[ply + 1])):
+                    if f1 != f2:
+                        if f1 != EMPTY:
+                            dpos[sq] |= from_bit
+                        else:
+                            dpos[sq] |= to_bit
             self._set_mv_led(dpos, freq)
-            time.sleep(0.05)
         else:
             self.log.warning(
                 "Not connected to Chess Link.")
 
     def _set_mv_led(self, pos, freq):
         """
-        Set the leds on board according to pos array, used by `show_deltas`.
+        Set the leds on board according to pos, a list of 64 led bit patterns per square,
+        used by `show_deltas`.
         """
         if self.connected is True:
-            leds = [[0 for x in range(9)] for y in range(9)]
-            cmd = "L" + clp.hex2(freq)
-            for y in range(8):
-                for x in range(8):
-                    if pos[y][x] != 0:
-                        if self.orientation is True:
-                            leds[7 - x][y] |= pos[y][x]
-                            leds[7 - x + 1][y] |= pos[y][x]
-                            leds[7 - x][y + 1] |= pos[y][x]
-                            leds[7 - x + 1][y + 1] |= pos[y][x]
-                        else:
-                            leds[x][7 - y] |= pos[y][x]
-                            leds[x + 1][7 - y] |= pos[y][x]
-                            leds[x][7 - y + 1] |= pos[y][x]
-                            leds[x + 1][7 - y + 1] |= pos[y][x]
-
-            for y in range(9):
-                for x in range(9):
-                    cmd = cmd + clp.hex2(leds[y][x])
-            self.trans.write_mt(cmd)
+            key = ('M', bytes(pos), freq, self.orientation)
+            cmd = self.led_frame_cache.get(key)
+            if cmd is None:
+                leds = [0] * 81
+                corners = _LED_CORNERS[self.orientation]
+                for sq in range(64):
+                    if pos[sq] != 0:
+                        for led in corners[sq]:
+                            leds[led] |= pos[sq]
+                cmd = "L" + clp.hex2(freq) + "".join(clp.hex2(led) for led in leds)
+                self._cache_led_frame(key, cmd)
+            self._write_led(cmd)
         else:
             self.log.warning(
                 "Not connected to Chess Link.")
 
     def show_delta(self, pos1, pos2, freq=0x20, ontime1=0x0f, ontime2=0xf0):
         """
-        Indicate difference between two `position` arrays using the board's leds.
+        Indicate difference between two `position` using the board's leds.
 
-        :param pos1: `position` array of the start position
-        :param pos2: `position` array of the target position
+        :param pos1: `position` of the start position
+        :param pos2: `position` of the target position
         :param freq: blink frequency, see
         `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
         :param ontime1: 8-bit value, bits indicate cycles led is on.
         :param ontime2: 8-bit value, bits indicate cycles led is off.
         """
         if self.connected is True:
-            dpos = [[0 for x in range(8)] for y in range(8)]
-            for y in range(8):
-                for x in range(8):
-                    if pos2[y][x] != pos1[y][x]:
-                        if pos1[y][x] != 0:
-                            dpos[y][x] = 1
-                        else:
-                            dpos[y][x] = 2
+            dpos = [0 if f1 == f2 else (1 if f1 != EMPTY else 2)
+                    for f1, f2 in zip(pos1, pos2)]
             self.set_led(dpos, freq, ontime1, ontime2)
         else:
             self.log.warning(
@@ -584,51 +768,113 @@ class ChessLink:
 
     def set_led(self, pos, freq, ontime1, ontime2):
         """
-        Static blinking leds according to `position`.
+        Static blinking leds according to `pos`.
 
-        :param pos: `position` array, field != 0 indicates a led that should blink.
+        :param pos: list of 64 values, one per square (a1=0), field != 0 indicates a led that
+                    should blink: 1: with ontime1, 2: with ontime2.
         :param freq: blink frequency, see
         `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
         :param ontime1: 8-bit value, bits indicate cycles led is on.
         :param ontime2: 8-bit value, bits indicate cycles led is off.
         """
         if self.connected is True:
-            leds = [[0 for x in range(9)] for y in range(9)]
-            cmd = "L" + clp.hex2(freq)
-            for y in range(8):
-                for x in range(8):
-                    if pos[y][x] != 0:
-                        if self.orientation is True:
-                            leds[7 - x][y] = pos[y][x]
-                            leds[7 - x + 1][y] = pos[y][x]
-                            leds[7 - x][y + 1] = pos[y][x]
-                            leds[7 - x + 1][y + 1] = pos[y][x]
-                        else:
-                            leds[x][7 - y] = pos[y][x]
-                            leds[x + 1][7 - y] = pos[y][x]
-                            leds[x][7 - y + 1] = pos[y][x]
-                            leds[x + 1][7 - y + 1] = pos[y][x]
-
-            for y in range(9):
-                for x in range(9):
-                    if leds[y][x] == 0:
-                        cmd = cmd + "00"
-                    elif leds[y][x] == 1:
-                        cmd = cmd + clp.hex2(ontime1)
-                    else:
-                        cmd = cmd + clp.hex2(ontime2)
-
-            self.trans.write_mt(cmd)
+            self._write_led(self._encode_led_frame(pos, freq, ontime1, ontime2))
         else:
             self.log.warning(
                 "Not connected to Chess Link.")
 
+    def _encode_led_frame(self, pos, freq, ontime1, ontime2):
+        """
+        Encode (or get from the led frame cache) the 'L' command for `set_led()`.
+        """
+        key = ('S', bytes(pos), freq, ontime1, ontime2, self.orientation)
+        cmd = self.led_frame_cache.get(key)
+        if cmd is None:
+            leds = [0] * 81
+            corners = _LED_CORNERS[self.orientation]
+            for sq in range(64):
+                if pos[sq] != 0:
+                    for led in corners[sq]:
+                        leds[led] = pos[sq]
+            codes = ("00", clp.hex2(ontime1), clp.hex2(ontime2))
+            cmd = "L" + clp.hex2(freq) + "".join(codes[led] for led in leds)
+            self._cache_led_frame(key, cmd)
+        return cmd
+
+    def _cache_led_frame(self, key, cmd):
+        """
+        Store an encoded led command in the led frame cache.
+        """
+        if len(self.led_frame_cache) >= self.led_frame_cache_size:
+            self.led_frame_cache.clear()
+        self.led_frame_cache[key] = cmd
+
+    def _write_led(self, cmd):
+        """
+        Set the desired led command ('L' or 'X') and return immediately. The led worker
+        thread sends it, a command that is replaced before it has been sent is dropped.
+        """
+        with self.led_cv:
+            if self.led_pending is not None:
+                self.led_frames_merged += 1
+            self.led_pending = cmd
+            self.led_cv.notify()
+
+    def _led_worker_thread(self):
+        """
+        Background thread that owns the board's leds: it sends the latest desired led
+        command, at most one every `led_min_interval` seconds (an 'L' command needs about
+        45 ms on a 38400 baud connection), and skips commands identical to the led state
+        of the board.
+        """
+        self.log.debug('Chess Link led thread started.')
+        while True:
+            with self.led_cv:
+                while self.thread_active is True:
+                    if self.led_pending is None:
+                        self.led_cv.wait()
+                        continue
+                    delay = self.led_last_write + self.led_min_interval - time.perf_counter()
+                    if delay <= 0:
+                        break
+                    self.led_cv.wait(delay)
+                if self.thread_active is False:
+                    break
+                cmd = self.led_pending
+                self.led_pending = None
+                trace_id = self.led_trace_id
+                self.led_trace_id = None
+                if cmd == self.last_led_cmd:
+                    self.led_writes_saved += 1
+                    if trace_id is not None:
+                        lt.mark(trace_id, 'led_write')
+                    continue
+                self.last_led_cmd = cmd
+                self.led_writes += 1
+                self.led_last_write = time.perf_counter()
+            self.trans.write_mt(cmd)
+            if trace_id is not None:
+                lt.mark(trace_id, 'led_write')
+        self.log.debug('Chess Link led thread stopped.')
+
+    def led_stats(self):
+        """
+        Statistics of the led frame cache and the led scheduler.
+
+        :returns: dictionary with number of led commands written, writes saved by skipping
+                  frames identical to the last one sent, frames replaced by a newer frame
+                  before they were sent, and number of cached frames.
+        """
+        return {'led_writes': self.led_writes, 'led_writes_saved': self.led_writes_saved,
+                'led_frames_merged': self.led_frames_merged,
+                'cached_frames': len(self.led_frame_cache)}
+
     def set_led_off(self):
         """
         Switch off all leds.
         """
         if self.connected is True:
-            self.trans.write_mt("X")
+            self._write_led("X")
         else:
             self.log.warning(
                 "Not connected to Chess Link.")
@@ -766,50 +1012,31 @@ class ChessLink:
 
     def position_to_fen(self, position):
         """
-        Convert a 8x8 `position` array to a fen position. Typically, an 8x8 `position` is generated
+        Convert a `position` to a fen position. Typically, a `position` is generated
         by the Chess Link board, which has no information about the current move, side to move, or
         castling status.
 
         The returned FEN has always ending `w KQkq - 0 1` after the actual position (only
         rudimentary checks for castling are done)
 
-        :returns: FEN string derived from postion-array
-        """
-        fen = ""
-        blanks = 0
-        for y in range(8):
-            for x in range(8):
-                f = position[7 - y][x]
-                c = '?'
-                for i in range(len(self.figrep['int'])):
-                    if self.figrep['int'][i] == f:
-                        c = self.figrep['ascii'][i]
-                        break
-                if c == '?':
-                    self.log.error(
-                        f"Internal FEN error, could not translation {c} at {y}{x}")
-                    return ""
-                if c == '.':
-                    blanks = blanks + 1
-                else:
-                    if blanks > 0:
-                        fen += str(blanks)
-                        blanks = 0
-                    fen += c
-            if blanks > 0:
-                fen += str(blanks)
-                blanks = 0
-            if y < 7:
-                fen += '/'
+        :returns: FEN string derived from position
+        """
+        try:
+            ranks = position.decode('ascii')
+        except (AttributeError, UnicodeDecodeError) as e:
+            self.log.error(f"Internal FEN error, invalid position {position}: {e}")
+            return ""
+        fen = "/".join(_FEN_EMPTY_RUN.sub(lambda m: str(len(m.group())), ranks[r:r + 8])
+                       for r in range(56, -1, -8))
         fen += ' w '
         castle = ''
-        if position[0][4] == 6 and position[0][7] == 4:
+        if ranks[4] == 'K' and ranks[7] == 'R':
             castle += "K"
-        if position[0][4] == 6 and position[0][0] == 4:
+        if ranks[4] == 'K' and ranks[0] == 'R':
             castle += "Q"
-        if position[7][4] == -6 and position[7][7] == -4:
+        if ranks[60] == 'k' and ranks[63] == 'r':
             castle += "k"
-        if position[7][4] == -6 and position[7][0] == -4:
+        if ranks[60] == 'k' and ranks[56] == 'r':
             castle += "q"
         if castle == '':
             castle = '-'
@@ -818,41 +1045,20 @@ class ChessLink:
 
     def fen_to_position(self, fen):
         """
-        Convert a FEN position into an 8x8 `position` array.
+        Convert a FEN position into a `position`.
 
-        Note that the current implementation of `position` arrays does not maintain move-counts,
+        Note that the current implementation of `position` does not maintain move-counts,
         castling stati or any history data.
 
-        :returns: 8x8 `position` array.
-        """
-        position = [[0 for x in range(8)] for y in range(8)]
-        fenp = self.short_fen(fen)
-        fi = 0
-        for y in range(8):
-            x = 0
-            while x < 8:
-                c = fenp[fi]
-                fi += 1
-                if c >= '1' and c <= '8':
-                    x += int(c)
-                    continue
-                ci = -99
-                for i in range(len(self.figrep['ascii'])):
-                    if self.figrep['ascii'][i] == c:
-                        ci = self.figrep['int'][i]
-                        break
-                if ci == -99:
-                    self.log.error(
-                        f"Internal FEN2 error decoding {c} at {y}{x}")
-                    return []
-                position[7 - y][x] = ci
-                x += 1
-            if y < 7 and fenp[fi] != '/':
-                self.log.error(
-                    f"Illegal fen: missing '/' {y}{x}: {fenp[fi]}[{fi}]")
-                return []
-            fi += 1
-        return position
+        :param fen: FEN, either complete or position-only part (see `short_fen()`)
+        :returns: `position`, None on invalid FEN.
+        """
+        ranks = fen.split(' ', 1)[0].translate(_FEN_EXPAND).split('/')
+        if len(ranks) != 8 or any(len(rank) != 8 for rank in ranks) or \
+           not _PIECES.issuperset("".join(ranks)):
+            self.log.error(f"Illegal fen: {fen}")
+            return None
+        return "".join(reversed(ranks)).encode('ascii')
 
     def _open_transport(self, transport, protocol_debug):
         """
@@ -879,7 +1085,9 @@ class ChessLink:
         Reset Chess Link module.
         """
         if self.connected is True:
-            self.trans.write_mt("T")
+            with self.led_cv:
+                self.trans.write_mt("T")
+                self.last_led_cmd = None
             self.log.warning(
                 "Chess Link reset initiated, will take 3 secs.")
         else:
@@ -928,11 +1136,10 @@ class ChessLink:
             self.orientation = orientation
             self.log.info("Swapping board position")
             with self.board_mutex:
-                pos = copy.deepcopy(self.position)
-                for y in range(8):
-                    for x in range(8):
-                        pos[y][x] = self.position[7 - y][7 - x]
-                self.position = pos
+                if self.position is not None:
+                    self.position = self.position[::-1]
+                # Precomputed led frames are only valid for the old orientation
+                self.lifted_frames = None
         self.write_configuration()
 
     def get_orientation(self):
@@ -1,7 +1,6 @@
 ''' Agent for Millennium chess board Chess Genius Exclusive '''
 import logging
 import time
-import copy
 
 import chess
 import chess_link as cl
@@ -61,19 +60,17 @@ class ChessLinkAgent:
         return self.cl_brd.position_to_fen(self.cl_brd.position)
 
     def variant_to_positions(self, _board, moves, plies):
-        board = copy.deepcopy(_board)
+        board = _board.copy(stack=False)
         pos = []
         mvs = len(moves)
         if mvs > plies:
             mvs = plies
 
         try:
-            pos.append(self.cl_brd.fen_to_position(board.fen()))
+            pos.append(self.cl_brd.fen_to_position(board.board_fen()))
             for i in range(mvs):
                 board.push(chess.Move.from_uci(moves[i]))
-                pos.append(self.cl_brd.fen_to_position(board.fen()))
-            for i in range(mvs):
-                board.pop()
+                pos.append(self.cl_brd.fen_to_position(board.board_fen()))
         except Exception as e:
             self.log.warning(f"Data corruption in variant_to_positions: {e}")
             return None
@@ -95,8 +92,7 @@ class ChessLinkAgent:
         if pos is not None:
             self.cl_brd.show_deltas(pos, freq)
 
-    def display_info(self, _board, info):
-        board = copy.deepcopy(_board)
+    def display_info(self, board, info):
 #        if info['actor'] == self.prefs['computer_player_name']:
         if 'multipv_index' in info:
             if info['multipv_index'] == 1:  # Main variant only
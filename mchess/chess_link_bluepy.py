@@ -3,11 +3,11 @@ ChessLink transport implementation for Bluetooth LE connections using `bluepy`.
 """
 import logging
 import threading
-import queue
 import time
 import os
 
 import chess_link_protocol as clp
+import chess_link_recorder as clr
 try:
     import bluepy
     from bluepy.btle import Scanner, DefaultDelegate, Peripheral
@@ -15,6 +15,9 @@ try:
 except ImportError:
     bluepy_ble_support = False
 
+RX_UUID = "49535343-1e4d-4bd9-ba61-23c647249616"
+TX_UUID = "49535343-8841-43f4-a8d4-ecbe34729bb3"
+
 
 class Transport():
     """
@@ -25,10 +28,13 @@ class Transport():
 
     This transport uses an asynchronous background thread for hardware communcation.
     All replies are written to the python queue `que` given during initialization.
+    If `recorder` is set, all received notifications are written to the transport log, see
+    `chess_link_recorder`.
 
     For the details of the Chess Link protocol, please refer to:
     `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
     """
+    recorder = None
 
     def __init__(self, que, protocol_dbg=False):
         """
@@ -42,7 +48,7 @@ class Transport():
         if bluepy_ble_support is False:
             self.init = False
             return
-        self.wrque = queue.Queue()
+        self.wrque = clp.CommandQueue()
         self.log = logging.getLogger("ChessLinkBluePy")
         self.que = que  # asyncio.Queue()
         self.init = True
@@ -52,6 +58,15 @@ class Transport():
         self.worker_thread_active = False
         self.worker_threader = None
         self.conn_state = None
+        # Pacing of writes: the pause after a write is a fraction of the smoothed time the
+        # board needs to acknowledge a write, between min_write_delta and max_write_delta.
+        self.ack_latency = 0.1
+        self.pacing_factor = 0.5
+        self.min_write_delta = 0.005
+        self.max_write_delta = 0.1
+        self.writes = 0
+        self.handle_cache = None
+        self.handle_cache_callback = None
 
         self.bp_path = os.path.dirname(os.path.abspath(bluepy.__file__))
         self.bp_helper = os.path.join(self.bp_path, 'bluepy-helper')
@@ -64,14 +79,57 @@ class Transport():
         Initiate worker-thread stop
         """
         self.worker_thread_active = False
+        if self.init is True:
+            self.log.info(f"Bluetooth LE write statistics: {self.stats()}")
+
+    def set_handle_cache(self, cache, callback=None):
+        """
+        Set the cached GATT handles of the board, which allow to (re-)connect without
+        service discovery.
+
+        :param cache: dictionary with 'address', 'rx' (notifying characteristic),
+                      'cccd' (its client characteristic configuration descriptor) and 'tx'
+                      (characteristic for commands) handles, or None.
+        :param callback: function that is called with the new cache dictionary after a
+                         service discovery, to store the handles, e.g. in
+                         'chess_link_config.json'.
+        """
+        self.handle_cache = cache
+        self.handle_cache_callback = callback
+
+    def write_delta(self):
+        """
+        :returns: pause in seconds between two writes, adapted to the measured acknowledge
+                  latency of the board.
+        """
+        return min(max(self.ack_latency * self.pacing_factor, self.min_write_delta),
+                   self.max_write_delta)
+
+    def stats(self):
+        """
+        :returns: dictionary with number of writes, smoothed write acknowledge latency and
+                  current pause between writes in ms, led commands replaced in the write
+                  queue, and current and max. write queue depth.
+        """
+        return {'writes': self.writes, 'ack_latency_ms': self.ack_latency * 1000.0,
+                'write_delta_ms': self.write_delta() * 1000.0,
+                'led_coalesced': self.wrque.coalesced, 'write_queue_depth': len(self.wrque),
+                'max_write_queue_depth': self.wrque.max_depth}
 
     def search_board(self, iface=0):
         """
         Search for ChessLink connections using Bluetooth LE.
 
+        If GATT handles of a board are cached (see `set_handle_cache()`), the cached address
+        is returned without scanning.
+
         :param iface: interface number of bluetooth adapter, default 1.
         :returns: Bluetooth address of ChessLink board, or None on failure.
         """
+        if self.handle_cache is not None and self.handle_cache.get('address') is not None:
+            self.log.info(f"Using cached Bluetooth LE address {self.handle_cache['address']}, "
+                          "skipping scan")
+            return self.handle_cache['address']
         self.log.debug("bluepy_ble: searching for boards")
 
         class ScanDelegate(DefaultDelegate):
@@ -150,7 +208,8 @@ class Transport():
 
     def write_mt(self, msg):
         """
-        Encode and asynchronously write a message to ChessLink.
+        Encode and asynchronously write a message to ChessLink. A led command replaces a
+        led command that has not yet been sent.
 
         :param msg: Message string. Parity will be added, and block CRC appended.
         """
@@ -182,39 +241,72 @@ class Transport():
         class PeriDelegate(DefaultDelegate):
             ''' peripheral delegate class '''
 
-            def __init__(self, log, que):
+            def __init__(self, log, que, recorder):
                 self.log = log
                 self.que = que
+                self.recorder = recorder
                 self.log.debug("Init delegate for peri")
-                self.chunks = ""
+                self.parser = clp.FrameParser()
+                if self.recorder is not None:
+                    # Data of a previous connection is not part of the new parser's frames
+                    self.recorder.record(clr.RAW, b'')
                 DefaultDelegate.__init__(self)
 
             def handleNotification(self, cHandle, data):
                 self.log.debug(
                     "BLE: Handle: {}, data: {}".format(cHandle, data))
-                rcv = ""
-                for b in data:
-                    rcv += chr(b & 127)
-                self.log.debug('BLE received [{}]'.format(rcv))
-                self.chunks += rcv
-                if self.chunks[0] not in clp.protocol_replies:
-                    self.log.warning(
-                        "Illegal reply start '{}' received, discarding".format(self.chunks[0]))
-                    while len(self.chunks) > 0 and self.chunks[0] not in clp.protocol_replies:
-                        self.chunks = self.chunks[1:]
-                if len(self.chunks) > 0:
-                    mlen = clp.protocol_replies[self.chunks[0]]
-                    if len(self.chunks) >= mlen:
-                        valmsg = self.chunks[:mlen]
-                        self.log.debug(
-                            'bluepy_ble received complete msg: {}'.format(valmsg))
-                        if clp.check_block_crc(valmsg):
-                            que.put(valmsg)
-                        self.chunks = self.chunks[mlen:]
-
-        rx = None
-        tx = None
+                if self.recorder is not None:
+                    self.recorder.record(clr.RAW, data)
+                for valmsg in self.parser.feed(data):
+                    self.log.debug(
+                        'bluepy_ble received complete msg: {}'.format(valmsg))
+                    que.put(valmsg)
+
+        rxh = None
+        txh = None
         log.debug('Peripheral generated {}'.format(address))
+        cache = self.handle_cache
+        if cache is not None and cache.get('address') == address:
+            try:
+                # One request per characteristic declaration instead of a full discovery
+                for name, uuid in (('rx', RX_UUID), ('tx', TX_UUID)):
+                    chars = mil.getCharacteristics(startHnd=cache[name] - 1, endHnd=cache[name])
+                    if not any(chri.uuid == uuid and chri.getHandle() == cache[name]
+                               for chri in chars):
+                        raise ValueError(f"no {name} characteristic at handle {cache[name]}")
+                log.debug('Enabling notifications with cached handles')
+                mil.writeCharacteristic(cache['cccd'], (1).to_bytes(2, byteorder='little'))
+                rxh = cache['rx']
+                txh = cache['tx']
+            except Exception as e:
+                log.warning(f"Cached handles for {address} not valid, discovering services: {e}")
+                self.handle_cache = None
+        if rxh is None:
+            rxh, txh = self.discover_handles(address, mil, que, log)
+            if rxh is None or txh is None:
+                return None, None
+        try:
+            log.debug('Installing peripheral delegate')
+            delegate = PeriDelegate(log, que, self.recorder)
+            mil.withDelegate(delegate)
+        except Exception as e:
+            emsg = 'Bluetooth LE: Failed to install peripheral delegate! {}'.format(
+                e)
+            log.error(emsg)
+            self.agent_state(que, 'offline', emsg)
+            return None, None
+        self.agent_state(que, 'online', 'Connected to ChessLink board via BLE')
+        return (rxh, txh)
+
+    def discover_handles(self, address, mil, que, log):
+        """
+        Enumerate services and characteristics of the board, enable notifications, and
+        store the handles in the handle cache.
+
+        :returns: tuple of rx and tx handles, (None, None) on failure.
+        """
+        rxh = None
+        txh = None
         try:
             services = mil.getServices()
         except Exception as e:
@@ -228,35 +320,25 @@ class Transport():
             log.debug('Service: {}'.format(ser))
             chrs = ser.getCharacteristics()
             for chri in chrs:
-                if chri.uuid == "49535343-1e4d-4bd9-ba61-23c647249616":  # TX char, rx for us
-                    rx = chri
+                if chri.uuid == RX_UUID:  # TX char, rx for us
                     rxh = chri.getHandle()
                     # Enable notification magic:
                     log.debug('Enabling notifications')
                     mil.writeCharacteristic(
                         rxh + 1, (1).to_bytes(2, byteorder='little'))
-                if chri.uuid == "49535343-8841-43f4-a8d4-ecbe34729bb3":  # RX char, tx for us
-                    tx = chri
-                    # txh = chri.getHandle()
+                if chri.uuid == TX_UUID:  # RX char, tx for us
+                    txh = chri.getHandle()
                 if chri.supportsRead():
                     log.debug(f"  {chri} UUID={chri.uuid} {chri.propertiesToString()} -> "
                               "{chri.read()}")
                 else:
                     log.debug(
                         f"  {chri} UUID={chri.uuid}{chri.propertiesToString()}")
-
-        try:
-            log.debug('Installing peripheral delegate')
-            delegate = PeriDelegate(log, que)
-            mil.withDelegate(delegate)
-        except Exception as e:
-            emsg = 'Bluetooth LE: Failed to install peripheral delegate! {}'.format(
-                e)
-            log.error(emsg)
-            self.agent_state(que, 'offline', emsg)
-            return None, None
-        self.agent_state(que, 'online', 'Connected to ChessLink board via BLE')
-        return (rx, tx)
+        if rxh is not None and txh is not None:
+            self.handle_cache = {'address': address, 'rx': rxh, 'cccd': rxh + 1, 'tx': txh}
+            if self.handle_cache_callback is not None:
+                self.handle_cache_callback(self.handle_cache)
+        return rxh, txh
 
     def worker_thread(self, log, address, wrque, que):
         """
@@ -264,10 +346,9 @@ class Transport():
         bluetooth to the queue `que`.
         """
         mil = None
-        message_delta_time = 0.1  # least 0.1 sec between outgoing btle messages
 
-        rx = None
-        tx = None
+        rxh = None
+        txh = None
         log.debug("bluepy_ble open_mt {}".format(address))
         # time.sleep(0.1)
         try:
@@ -281,13 +362,18 @@ class Transport():
             log.error(emsg)
             self.agent_state(que, 'offline', '{}'.format(e))
             self.conn_state = False
+            if self.handle_cache is not None and self.handle_cache.get('address') == address:
+                # The cached board may be gone, scan again on the next attempt
+                self.handle_cache = None
+                if self.handle_cache_callback is not None:
+                    self.handle_cache_callback(None)
             return
 
-        rx, tx = self.mil_open(address, mil, que, log)
+        rxh, txh = self.mil_open(address, mil, que, log)
 
         time_last_out = time.time() + 0.2
 
-        if rx is None or tx is None:
+        if rxh is None or txh is None:
             bt_error = True
             self.conn_state = False
         else:
@@ -309,38 +395,40 @@ class Transport():
                     bt_error = True
                 if bt_error is False:
                     self.log.info(f"Bluetooth reconnected to {address}")
-                    rx, tx = self.mil_open(address, mil, que, log)
+                    rxh, txh = self.mil_open(address, mil, que, log)
                     time_last_out = time.time() + 0.2
                     self.init = True
 
-            if wrque.empty() is False and time.time() - time_last_out > message_delta_time:
-                msg = wrque.get()
-                gpar = 0
-                for b in msg:
-                    gpar = gpar ^ ord(b)
-                msg = msg + clp.hex2(gpar)
+            write_wait = time_last_out + self.write_delta() - time.time()
+            if len(wrque) > 0 and write_wait <= 0:
+                _, msg = wrque.get()
                 if self.protocol_debug is True:
                     log.debug("blue_ble write: <{}>".format(msg))
-                bts = ""
-                for c in msg:
-                    bo = chr(clp.add_odd_par(c))
-                    bts += bo
-                    btsx = bts.encode('latin1')
+                btsx = clp.encode_message(msg.encode('ascii'))
                 if self.protocol_debug is True:
                     log.debug("Sending: <{}>".format(btsx))
                 try:
-                    tx.write(btsx, withResponse=True)
+                    t_write = time.time()
+                    mil.writeCharacteristic(txh, btsx, withResponse=True)
                     time_last_out = time.time()
+                    # Smoothed latency of the write acknowledge
+                    self.ack_latency = 0.8 * self.ack_latency + 0.2 * (time_last_out - t_write)
+                    self.writes += 1
                 except Exception as e:
                     log.error(f"bluepy_ble: failed to write {msg}: {e}")
                     bt_error = True
                     self.agent_state(
                         que, 'offline', f'Connected to Bluetooth peripheral lost: {e}')
-                wrque.task_done()
+                write_wait = self.write_delta()
 
+            if len(wrque) > 0:
+                # Wake up in time for the next write
+                notification_timeout = min(max(write_wait, 0.001), 0.05)
+            else:
+                notification_timeout = 0.05
             try:
-                rx.read()
-                mil.waitForNotifications(0.05)
+                mil.readCharacteristic(rxh)
+                mil.waitForNotifications(notification_timeout)
                 # time.sleep(0.1)
             except Exception as e:
                 self.log.warning(f"Bluetooth error {e}")
@@ -8,11 +8,42 @@ odd-parity-bit. Each block of ASCII+odd-parity bytes gets an additional block pa
 
 Details of the Chess Link protocol are documented in
 `magic-board.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
+
+Transports use the `bytes` codec `encode_message()`, `decode_message()`, `block_crc()` and
+`check_crc()`, which works with lookup tables for parity and hex digits. The string functions
+`add_odd_par()`, `hex2()`, `add_block_crc()` and `check_block_crc()` are kept for messages
+that are handled as strings.
 """
 
+import collections
 import logging
+import re
+import threading
+import time
 
 protocol_replies = {'v': 7, 's': 67, 'l': 3, 'x': 3, 'w': 7, 'r': 7}
+# Valid characters of the reply payloads (between reply type and CRC): piece characters
+# of the 64 squares for 's', two 2-digit hex numbers for 'v', 'w' and 'r'
+protocol_reply_payloads = {'v': '[0-9A-Fa-f]', 's': '[PNBRQKpnbrqk.]', 'l': '', 'x': '',
+                           'w': '[0-9A-Fa-f]', 'r': '[0-9A-Fa-f]'}
+
+
+def _odd_parity_byte(byte):
+    byte &= 127
+    if bin(byte).count('1') % 2 == 0:
+        byte |= 128
+    return byte
+
+
+#: 7-bit ASCII code with odd parity bit, for the 128 ASCII codes
+ODD_PARITY = bytes(_odd_parity_byte(b) for b in range(128))
+# bytes.translate() tables: add odd parity (ignoring bit 7 of the input), strip parity bit
+_ADD_PARITY_TABLE = ODD_PARITY * 2
+_STRIP_PARITY_TABLE = bytes(range(128)) * 2
+_HEX2_BYTES = [b'%02X' % i for i in range(256)]
+_HEX2_STR = ['%02X' % i for i in range(256)]
+# Masks of the lower n bytes of an integer, for block_crc()
+_FOLD_MASKS = [(1 << (8 * n)) - 1 for n in range(256)]
 
 
 def add_odd_par(b):
@@ -22,17 +53,7 @@ def add_odd_par(b):
     :param b: an ASCII character (0..127)
     :returns: a byte (0..255) with odd parity in most significant bit.
     """
-    byte = ord(b) & 127
-    par = 1
-    for _ in range(7):
-        bit = byte & 1
-        byte = byte >> 1
-        par = par ^ bit
-    if par == 1:
-        byte = ord(b) | 128
-    else:
-        byte = ord(b) & 127
-    return byte
+    return ODD_PARITY[ord(b) & 127]
 
 
 def hexd(digit):
@@ -56,10 +77,7 @@ def hex2(num):
     :param num: uint_8 integer 0..255
     :returns: Returns a 2-digit hex code '00'..'FF'
     """
-    d1 = num // 16
-    d2 = num % 16
-    s = hexd(d1) + hexd(d2)
-    return s
+    return _HEX2_STR[num]
 
 
 def check_block_crc(msg):
@@ -72,9 +90,7 @@ def check_block_crc(msg):
     :returns: True, if the last two bytes of msg contain a correct CRC, False otherwise.
     """
     if len(msg) > 2:
-        gpar = 0
-        for b in msg[:-2]:
-            gpar = gpar ^ ord(b)
+        gpar = block_crc("".join(msg[:-2]).encode('latin1'))
         if msg[-2] + msg[-1] != hex2(gpar):
             logging.warning(f"CRC error rep={msg} CRCs: {ord(msg[-2])}!={hex2(gpar)}")
             return False
@@ -93,8 +109,231 @@ def add_block_crc(msg):
     :param msg: byte array with a message (incl. odd-parity bits set already)
     :return: two byte longer message that includes 2 CRC bytes.
     """
-    gpar = 0
-    for b in msg:
-        gpar = gpar ^ ord(b)
-    msg = msg + hex2(gpar)
-    return msg
+    return msg + hex2(block_crc(msg.encode('latin1')))
+
+
+def block_crc(data):
+    """
+    Block parity of a message: XOR of all bytes.
+
+    The XOR is computed on the message as one integer, folding the upper half onto the lower
+    half until a single byte is left, which needs log2(len(data)) integer operations instead
+    of one per byte.
+
+    :param data: `bytes` message (without parity bits)
+    :returns: integer 0..255
+    """
+    n = len(data)
+    x = int.from_bytes(data, 'little')
+    while n > 8:
+        half = (n + 1) >> 1
+        if half < len(_FOLD_MASKS):
+            mask = _FOLD_MASKS[half]
+        else:
+            mask = (1 << (8 * half)) - 1
+        x = (x >> (half << 3)) ^ (x & mask)
+        n = half
+    x ^= x >> 32
+    x ^= x >> 16
+    x ^= x >> 8
+    return x & 255
+
+
+def check_crc(frame):
+    """
+    Check the block parity of a received frame.
+
+    :param frame: `bytes` or `bytearray` frame without parity bits, the last two bytes are
+                  the block CRC as hex digits.
+    :returns: True, if the CRC is valid.
+    """
+    if len(frame) <= 2:
+        return False
+    return _HEX2_BYTES[block_crc(frame[:-2])] == frame[-2:]
+
+
+def encode_message(msg):
+    """
+    Encode a command for the board: append block CRC and set the odd parity bit of all bytes.
+
+    :param msg: `bytes` message, 7-bit ASCII
+    :returns: `bytes` ready to be written to the board
+    """
+    return (msg + _HEX2_BYTES[block_crc(msg)]).translate(_ADD_PARITY_TABLE)
+
+
+def decode_message(data):
+    """
+    Remove the parity bits of data received from the board.
+
+    :param data: `bytes` with parity
+    :returns: `bytes`, 7-bit ASCII
+    """
+    return bytes(data).translate(_STRIP_PARITY_TABLE)
+
+
+class FrameParser:
+    """
+    Incremental parser for replies of the board, shared by all transports.
+
+    Received data is fed in chunks of arbitrary size, `feed()` returns all frames that have
+    been completed by the chunk. Parity bits are removed, bytes that cannot start a reply are
+    skipped, and frames with invalid block CRC are dropped, parsing continues with the byte
+    after the invalid frame's start, so that the parser resynchronizes on the next valid
+    frame. Frames with characters that are not valid for the reply type are dropped the same
+    way: after a resync, a reply type character inside another frame's payload may start a
+    bogus frame with a valid CRC by chance.
+    """
+
+    _REPLY_START = re.compile(b'[' + "".join(protocol_replies).encode('ascii') + b']')
+    _REPLY_LENGTH = {ord(c): n for c, n in protocol_replies.items()}
+    _REPLY_FRAME = {ord(c): re.compile(re.escape(c).encode('ascii') +
+                                       (f"{chars}{{{protocol_replies[c] - 3}}}" if chars != ''
+                                        else '').encode('ascii') + b'[0-9A-F]{2}')
+                    for c, chars in protocol_reply_payloads.items()}
+
+    def __init__(self):
+        self.log = logging.getLogger("ChessLinkParser")
+        self.buf = bytearray()
+        self.pos = 0
+        self.frames = 0
+        self.crc_errors = 0
+        self.invalid_frames = 0
+        self.skipped = 0
+
+    def reset(self):
+        """
+        Discard a partially received frame, e.g. after a read timeout.
+        """
+        self.skipped += len(self.buf) - self.pos
+        self.buf = bytearray()
+        self.pos = 0
+
+    def pending(self):
+        """
+        :returns: number of received bytes that are not yet part of a complete frame.
+        """
+        return len(self.buf) - self.pos
+
+    def feed(self, data):
+        """
+        Add received data.
+
+        :param data: `bytes`, `bytearray` or `memoryview` as received from the board (with
+                     parity bits)
+        :returns: list of complete frames with valid CRC, as strings (e.g. 'l' + CRC)
+        """
+        buf = self.buf
+        buf += bytes(data).translate(_STRIP_PARITY_TABLE)
+        frames = []
+        pos = self.pos
+        end = len(buf)
+        while pos < end:
+            m = self._REPLY_START.search(buf, pos)
+            if m is None:
+                self.skipped += end - pos
+                pos = end
+                break
+            start = m.start()
+            if start > pos:
+                self.skipped += start - pos
+                pos = start
+            length = self._REPLY_LENGTH[buf[pos]]
+            if pos + length > end:
+                break
+            frame = buf[pos:pos + length]
+            if self._REPLY_FRAME[buf[pos]].fullmatch(frame) is None:
+                self.log.warning(f"Invalid characters in frame '{frame.decode('latin1')}', "
+                                 "resynchronizing")
+                self.invalid_frames += 1
+                self.skipped += 1
+                pos += 1
+            elif check_crc(frame):
+                frames.append(frame.decode('ascii'))
+                self.frames += 1
+                pos += length
+            else:
+                self.log.warning(f"CRC error in frame '{frame.decode('latin1')}', resynchronizing")
+                self.crc_errors += 1
+                self.skipped += 1
+                pos += 1
+        # Drop consumed data once it's more than half of the buffer: amortized O(n)
+        if pos > 0 and pos * 2 >= len(buf):
+            del buf[:pos]
+            pos = 0
+        self.pos = pos
+        return frames
+
+    def stats(self):
+        """
+        :returns: dictionary with number of frames, CRC errors, frames with invalid
+                  characters and skipped bytes.
+        """
+        return {'frames': self.frames, 'crc_errors': self.crc_errors,
+                'invalid_frames': self.invalid_frames, 'skipped': self.skipped}
+
+
+class CommandQueue:
+    """
+    Thread-safe queue of commands for the board, shared by the transports' writers.
+
+    Led commands ('L', 'X') describe the complete led state, a new led command therefore
+    replaces a led command that is still waiting in the queue (at that command's place), so
+    that outdated led frames are never sent. All other commands keep their order.
+    """
+
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.que = collections.deque()
+        self.coalesced = 0
+        self.max_depth = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self.que)
+
+    def put(self, msg):
+        """
+        Queue a command.
+
+        :param msg: command string without CRC
+        """
+        with self.cv:
+            if msg[:1] in ('L', 'X'):
+                for entry in self.que:
+                    if entry[1][:1] in ('L', 'X'):
+                        entry[1] = msg
+                        self.coalesced += 1
+                        return
+            self.que.append([time.perf_counter(), msg])
+            if len(self.que) > self.max_depth:
+                self.max_depth = len(self.que)
+            self.cv.notify()
+
+    def get(self, timeout=None):
+        """
+        Get the next command, wait up to `timeout` seconds (None: until a command is queued
+        or `close()` is called).
+
+        :returns: tuple (`time.perf_counter()` time the command was queued, command), or None
+                  on timeout and once the queue is closed and empty.
+        """
+        with self.cv:
+            if timeout is None:
+                while len(self.que) == 0 and self.closed is False:
+                    self.cv.wait()
+            elif len(self.que) == 0 and self.closed is False:
+                self.cv.wait(timeout)
+            if len(self.que) == 0:
+                return None
+            t_queued, msg = self.que.popleft()
+            return t_queued, msg
+
+    def close(self):
+        """
+        Close the queue: threads waiting in `get()` wake up, `get()` returns None instead of
+        waiting once the queue is empty, so that writer threads can terminate.
+        """
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
@@ -1,37 +1,284 @@
-''' implementation framework for additional bluetooth module, not functional '''
+"""
+ChessLink transport implementation for Bluetooth LE connections using `bleak` and asyncio.
+"""
+import asyncio
 import logging
+import threading
 
-# import chess_link_protocol as clp
+import chess_link_protocol as clp
+import chess_link_recorder as clr
+try:
+    from bleak import BleakClient, BleakScanner
+    bleak_support = True
+except ImportError:
+    bleak_support = False
 
-# TODO: expand empty framework with actual functionality!
+# Transparent UART service of the board's Bluetooth module
+RX_CHARACTERISTIC = "49535343-1e4d-4bd9-ba61-23c647249616"  # TX char of the board, rx for us
+TX_CHARACTERISTIC = "49535343-8841-43f4-a8d4-ecbe34729bb3"  # RX char of the board, tx for us
 
 
 class Transport():
-    ''' non-functional frame '''
-    def __init__(self, que):
+    """
+    ChessLink transport implementation for Bluetooth LE connections using `bleak`, which
+    supports Linux, macOS and Windows.
+
+    All Bluetooth communication runs on an asyncio event loop in a background thread:
+    notifications are decoded by `chess_link_protocol.FrameParser` and written to the python
+    queue `que` given during initialization, commands from `write_mt()` wake up the writer
+    coroutine. A lost connection is re-established with exponential backoff. If `recorder`
+    is set, all received notifications are written to the transport log, see
+    `chess_link_recorder`.
+
+    For tests without hardware, `client_factory` can be set to
+    `chess_link_sim.SimulatedPeripheral().client`.
+    """
+    recorder = None
+
+    def __init__(self, que, protocol_dbg=False, client_factory=None):
+        """
+        Initialize with python queue for event handling.
+        Events are strings conforming to the ChessLink protocol as documented in
+        `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_.
+
+        :param que: Python queue that will receive events from chess board.
+        :param protocol_dbg: True: byte-level ChessLink protocol debug messages
+        :param client_factory: class or function that creates a client connection,
+                               default `bleak.BleakClient`.
+        """
         self.log = logging.getLogger("ChessLinkPyBlue")
-        self.que = que  # asyncio.Queue()
+        if client_factory is None:
+            if bleak_support is False:
+                self.log.debug("bleak not installed, transport not available")
+                self.init = False
+                return
+            client_factory = BleakClient
+        self.client_factory = client_factory
+        self.que = que
         self.init = True
-        self.is_open = False
-        self.log.debug("init ok")
+        self.protocol_debug = protocol_dbg
+        self.scan_timeout = 10
+        self.min_backoff = 0.5
+        self.max_backoff = 30.0
+        self.wrque = clp.CommandQueue()
+        self.parser = clp.FrameParser()
+        self.loop = None
+        self.write_event = None
+        self.worker_thread_active = False
+        self.worker_threader = None
+        self.connected = threading.Event()
+        self.conn_state = None
+        self.conn_state_event = threading.Event()
+        self.reconnects = 0
+        self.writes = 0
+        self.log.debug("bleak init ok")
+
+    def quit(self):
+        """
+        Initiate worker-thread stop
+        """
+        self.worker_thread_active = False
+        self._wake_writer()
+
+    def search_board(self, iface=None):
+        """
+        Search for ChessLink connections using Bluetooth LE.
 
-    def search_board(self):
-        self.log.debug("searching for boards")
+        :param iface: not used.
+        :returns: Bluetooth address of ChessLink board, or None on failure.
+        """
+        if bleak_support is False:
+            return None
+        self.log.debug("bleak: searching for boards")
 
-        return None
+        def is_millennium(device, adv):
+            name = adv.local_name or device.name or ""
+            return "MILLENNIUM CHESS" in name
+
+        try:
+            device = asyncio.run(BleakScanner.find_device_by_filter(
+                is_millennium, timeout=self.scan_timeout))
+        except Exception as e:
+            self.log.error(f"BLE scanning failed. {e}")
+            return None
+        if device is None:
+            return None
+        self.log.info("Autodetected Millennium Chess Link board at "
+                      f"Bluetooth LE address: {device.address}")
+        return device.address
 
     def test_board(self, address):
-        return None
+        """
+        Test dummy, the connection is tested by `open_mt()`.
+
+        :returns: Version string "1.0" always.
+        """
+        self.log.debug(f"test_board address {address} not implemented.")
+        return "1.0"
 
     def open_mt(self, address):
-        self.log.debug(f"open_mt {address}")
-        return False
+        """
+        Open a bluetooth LE connection to ChessLink board.
+
+        :param address: bluetooth address
+        :returns: True on success.
+        """
+        self.log.debug('Starting event loop thread for bleak')
+        self.worker_thread_active = True
+        self.conn_state = None
+        self.conn_state_event.clear()
+        self.worker_threader = threading.Thread(
+            target=self.worker_thread, args=(address,))
+        self.worker_threader.setDaemon(True)
+        self.worker_threader.start()
+        self.conn_state_event.wait(self.scan_timeout)
+        if self.conn_state is not True:
+            self.worker_thread_active = False
+            self._wake_writer()
+            return False
+        return True
 
     def write_mt(self, msg):
-        return False
+        """
+        Encode and asynchronously write a message to ChessLink. A led command replaces a
+        led command that has not yet been sent.
+
+        :param msg: Message string. Parity will be added, and block CRC appended.
+        """
+        if self.protocol_debug is True:
+            self.log.debug(f'write-que-entry {msg}')
+        self.wrque.put(msg)
+        self._wake_writer()
+
+    def _wake_writer(self):
+        if self.loop is not None and self.write_event is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.write_event.set)
+            except RuntimeError:
+                pass  # loop already closed
 
     def get_name(self):
+        """
+        Get name of this transport.
+
+        :returns: 'chess_link_pyblue'
+        """
         return "chess_link_pyblue"
 
     def is_init(self):
+        """
+        Check, if transport is available.
+
+        :returns: True on success.
+        """
         return self.init
+
+    def stats(self):
+        """
+        :returns: dictionary with number of writes, reconnects, led commands replaced in the
+                  write queue, and frames, CRC errors and skipped bytes of the parser.
+        """
+        stats = {'writes': self.writes, 'reconnects': self.reconnects,
+                 'led_coalesced': self.wrque.coalesced}
+        stats.update(self.parser.stats())
+        return stats
+
+    def agent_state(self, state, msg):
+        self.que.put('agent-state: ' + state + ' ' + msg)
+
+    def worker_thread(self, address):
+        """
+        Background thread that runs the asyncio event loop for the connection.
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.connection_loop(address))
+        finally:
+            self.loop.close()
+        self.log.debug('bleak worker thread stopped')
+
+    def _set_conn_state(self, state):
+        if self.conn_state is None:
+            self.conn_state = state
+            self.conn_state_event.set()
+
+    def _on_notification(self, sender, data):
+        if self.protocol_debug is True:
+            self.log.debug(f"BLE received: {data}")
+        if self.recorder is not None:
+            self.recorder.record(clr.RAW, data)
+        for msg in self.parser.feed(data):
+            if self.protocol_debug is True:
+                self.log.debug(f"bleak received complete msg: {msg}")
+            self.que.put(msg)
+
+    def _on_disconnect(self, client):
+        self.log.warning(f"Bluetooth LE connection to {client.address} lost")
+        self.connected.clear()
+        self.write_event.set()
+
+    async def connection_loop(self, address):
+        """
+        Connect, and reconnect with exponential backoff after connection losses, until
+        `quit()` is called. If the first connection attempt fails, `open_mt()` fails.
+        """
+        self.write_event = asyncio.Event()
+        backoff = self.min_backoff
+        reported = False
+        while self.worker_thread_active is True:
+            client = self.client_factory(address, disconnected_callback=self._on_disconnect)
+            try:
+                await client.connect()
+                await client.start_notify(RX_CHARACTERISTIC, self._on_notification)
+            except Exception as e:
+                if self.conn_state is None:
+                    self.log.error(f"Failed to connect to {address}: {e}")
+                    self.agent_state('offline', f'{e}')
+                    self._set_conn_state(False)
+                    return
+                if reported is False:
+                    self.log.warning(f"Reconnect to {address} failed: {e}")
+                    self.agent_state('offline', f'Connection to Bluetooth peripheral lost: {e}')
+                    reported = True
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if self.conn_state is not None:
+                self.reconnects += 1
+                self.log.info(f"Bluetooth reconnected to {address}")
+            self.connected.set()
+            if self.recorder is not None and self.parser.pending() > 0:
+                self.recorder.record(clr.RAW, b'')
+            self.parser.reset()
+            backoff = self.min_backoff
+            reported = False
+            self.agent_state('online', 'Connected to ChessLink board via BLE')
+            self._set_conn_state(True)
+            await self.writer(client)
+            try:
+                await client.disconnect()
+            except Exception as e:
+                self.log.debug(f"Disconnect failed: {e}")
+
+    async def writer(self, client):
+        """
+        Write queued commands until the connection is lost or `quit()` is called.
+        """
+        while self.worker_thread_active is True and client.is_connected is True:
+            await self.write_event.wait()
+            self.write_event.clear()
+            while len(self.wrque) > 0 and client.is_connected is True:
+                entry = self.wrque.get(timeout=0)
+                if entry is None:
+                    break
+                msg = entry[1]
+                data = clp.encode_message(msg.encode('ascii'))
+                if self.protocol_debug is True:
+                    self.log.debug(f"bleak write: <{msg}> as <{data}>")
+                try:
+                    await client.write_gatt_char(TX_CHARACTERISTIC, data, response=True)
+                    self.writes += 1
+                except Exception as e:
+                    self.log.error(f"bleak: failed to write {msg}: {e}")
+                    self.connected.clear()
+                    return
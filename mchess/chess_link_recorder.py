@@ -0,0 +1,138 @@
+"""
+Recording of ChessLink transport traffic.
+
+The raw data a transport receives from the board (with parity bits, before frame parsing and
+CRC check), all commands written with `write_mt()` and the agent-state events are written to
+a binary log file with timestamps. Optionally, the decoded messages a
+transport delivers to `ChessLink` are recorded, too. Logs can be fed back with the
+`chess_link_replay` transport, which allows to reproduce hardware problems, including
+corrupted or misaligned data, and to benchmark `ChessLink` and the dispatcher without a board.
+
+Log format: the header `MCLREC1\\n` followed by records. Each record is a little-endian
+struct `<dcH` (seconds since start of recording, record type, payload length) followed by
+the payload. Record types:
+
+- `B`: raw data received from the board. An empty chunk marks a point where the transport
+  discarded a partially received frame (read timeout, reconnect).
+- `R`: message delivered to `ChessLink`: agent-state events, and decoded board replies if
+  recording of messages is enabled. Latin-1 encoded.
+- `W`: command written to the board, latin-1 encoded.
+"""
+import logging
+import struct
+import threading
+import time
+
+LOG_MAGIC = b'MCLREC1\n'
+RECORD_HEADER = struct.Struct('<dcH')
+RAW = b'B'
+RECEIVED = b'R'
+WRITTEN = b'W'
+AGENT_STATE = 'agent-state: '
+
+
+class Recorder:
+    """
+    Thread-safe writer for ChessLink transport logs.
+    """
+
+    def __init__(self, path, messages=False):
+        """
+        :param path: log file name, `time.strftime` format codes are expanded,
+                     e.g. `chesslink-%Y%m%d-%H%M%S.clrec`.
+        :param messages: True: record decoded board replies in addition to the raw data.
+        """
+        self.log = logging.getLogger("ChessLinkRecorder")
+        self.path = time.strftime(path)
+        self.mutex = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.messages = messages
+        self.records = 0
+        self.file = open(self.path, 'wb')
+        self.file.write(LOG_MAGIC)
+        self.log.info(f"Recording ChessLink transport traffic to {self.path}")
+
+    def record(self, direction, msg):
+        """
+        Append a message to the log.
+
+        :param direction: `RAW`, `RECEIVED` or `WRITTEN`
+        :param msg: `bytes` for `RAW`, message string otherwise
+        """
+        if direction == RAW:
+            payload = bytes(msg)
+        else:
+            payload = msg.encode('latin1')
+        with self.mutex:
+            if self.file is None:
+                return
+            self.file.write(RECORD_HEADER.pack(time.perf_counter() - self.t0, direction,
+                                               len(payload)))
+            self.file.write(payload)
+            self.records += 1
+
+    def record_message(self, msg):
+        """
+        Append a message delivered to `ChessLink`: agent-state events are always recorded,
+        decoded board replies only if recording of messages is enabled.
+        """
+        if self.messages is True or msg.startswith(AGENT_STATE):
+            self.record(RECEIVED, msg)
+
+    def close(self):
+        with self.mutex:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.log.info(f"{self.records} records written to {self.path}")
+
+
+class RecordingTransport:
+    """
+    Wrapper for a ChessLink transport that records all `write_mt()` commands, all other
+    methods and attributes are those of the wrapped transport. The wrapped transport
+    records the raw received data with its `recorder` attribute.
+    """
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+        transport.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def write_mt(self, msg):
+        self.recorder.record(WRITTEN, msg)
+        return self.transport.write_mt(msg)
+
+    def quit(self):
+        self.transport.quit()
+        self.recorder.close()
+
+
+def read_log(path):
+    """
+    Read a ChessLink transport log.
+
+    :param path: log file name
+    :returns: list of tuples (timestamp, record type, payload), payload is `bytes` for `RAW`
+              records and a string otherwise.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(LOG_MAGIC)] != LOG_MAGIC:
+        raise ValueError(f"{path} is not a ChessLink transport log")
+    pos = len(LOG_MAGIC)
+    while pos + RECORD_HEADER.size <= len(data):
+        timestamp, direction, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if pos + length > len(data):
+            break  # truncated last record, e.g. recording was interrupted
+        payload = data[pos:pos + length]
+        if direction != RAW:
+            payload = payload.decode('latin1')
+        records.append((timestamp, direction, payload))
+        pos += length
+    return records
@@ -0,0 +1,194 @@
+"""
+ChessLink transport that replays a transport log written by `chess_link_recorder`.
+"""
+import logging
+import os
+import threading
+import time
+
+import chess_link_protocol as clp
+import chess_link_recorder as clr
+
+
+class Transport():
+    """
+    ChessLink transport implementation that replays recorded board traffic.
+
+    The address of this transport is the file name of the log, optionally followed by
+    `@<speed>`: `@1` (default) replays in real time, `@2` twice as fast, and `@0` as fast
+    as possible. To use it, set `"transport": "chess_link_replay"`,
+    `"address": "<logfile>[@speed]"` and `"autodetect": false` in `chess_link_config.json`.
+
+    The raw data of the log is decoded by `chess_link_protocol.FrameParser`, as the hardware
+    transports do, so that corrupted or misaligned data, CRC errors and resynchronization are
+    reproduced. The frames and the recorded agent-state events are written to the python
+    queue `que` given during initialization. Logs without raw data are replayed with their
+    recorded messages instead. Commands written by `write_mt()` are not sent anywhere, they are kept
+    in `written` (tuples of time since start of replay and message) for comparison with
+    the recorded commands.
+    """
+
+    def __init__(self, que, protocol_dbg=False):
+        """
+        Initialize with python queue for event handling.
+
+        :param que: Python queue that will receive events from the replayed log.
+        :param protocol_dbg: True: byte-level ChessLink protocol debug messages
+        """
+        self.log = logging.getLogger("ChessLinkReplay")
+        self.que = que
+        self.init = True
+        self.protocol_debug = protocol_dbg
+        self.thread_active = False
+        self.event_thread = None
+        self.records = []
+        self.raw = False
+        self.parser = clp.FrameParser()
+        self.speed = 1.0
+        self.t0 = None
+        self.written = []
+        self.finished = threading.Event()
+
+    def quit(self):
+        """
+        Initiate worker-thread stop
+        """
+        self.thread_active = False
+
+    def _parse_address(self, address):
+        path = address
+        speed = 1.0
+        i = address.rfind('@')
+        if i != -1:
+            try:
+                speed = float(address[i + 1:])
+                path = address[:i]
+            except ValueError:
+                pass
+        return path, speed
+
+    def search_board(self, iface=None):
+        """
+        Replay logs cannot be autodetected.
+
+        :returns: None
+        """
+        return None
+
+    def test_board(self, address):
+        """
+        Check that address refers to a valid transport log.
+
+        :returns: "replay" on success, None on failure.
+        """
+        path, _ = self._parse_address(address)
+        if not os.path.exists(path):
+            self.log.error(f"Replay log {path} does not exist")
+            return None
+        try:
+            self.records = clr.read_log(path)
+        except Exception as e:
+            self.log.error(f"Cannot read replay log {path}: {e}")
+            return None
+        self.raw = any(direction == clr.RAW for _, direction, _ in self.records)
+        return "replay"
+
+    def open_mt(self, address):
+        """
+        Start replaying the log.
+
+        :param address: log file name, optionally followed by `@<speed>`.
+        :returns: True on success.
+        """
+        path, self.speed = self._parse_address(address)
+        if self.test_board(address) is None:
+            return False
+        self.log.info(f"Replaying {len(self.records)} records from {path} at speed {self.speed}")
+        self.finished.clear()
+        self.thread_active = True
+        self.event_thread = threading.Thread(
+            target=self.event_worker_thread, args=(self.que,))
+        self.event_thread.setDaemon(True)
+        self.event_thread.start()
+        return True
+
+    def event_worker_thread(self, que):
+        """
+        Background thread that sends the frames decoded from the raw data of the log and
+        the recorded agent-state events to the queue `que`.
+        """
+        self.t0 = time.perf_counter()
+        for timestamp, direction, msg in self.records:
+            if self.thread_active is False:
+                break
+            if direction == clr.WRITTEN:
+                continue
+            # With raw data, recorded board replies are only there for inspection
+            if self.raw is True and direction == clr.RECEIVED and \
+                    not msg.startswith(clr.AGENT_STATE):
+                continue
+            if self.speed > 0:
+                delay = self.t0 + timestamp / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if direction == clr.RAW:
+                if len(msg) == 0:
+                    # The transport discarded a partially received frame here
+                    self.parser.reset()
+                    continue
+                if self.protocol_debug is True:
+                    self.log.debug(f"Replay received data: {msg}")
+                for frame in self.parser.feed(msg):
+                    que.put(frame)
+                continue
+            if self.protocol_debug is True:
+                self.log.debug(f"Replay received cmd: {msg}")
+            que.put(msg)
+        self.log.debug("Replay finished")
+        self.finished.set()
+
+    def stats(self):
+        """
+        :returns: dictionary with frames, CRC errors, frames with invalid characters and
+                  skipped bytes of the frame parser.
+        """
+        return self.parser.stats()
+
+    def wait_finished(self, timeout=None):
+        """
+        Wait until all received messages of the log have been replayed.
+
+        :returns: True, if replay has finished.
+        """
+        return self.finished.wait(timeout)
+
+    def write_mt(self, msg):
+        """
+        Record a message written to the (virtual) board.
+
+        :param msg: Message string.
+        """
+        if self.t0 is None:
+            t = 0.0
+        else:
+            t = time.perf_counter() - self.t0
+        self.written.append((t, msg))
+        if self.protocol_debug is True:
+            self.log.debug(f"Replay write '{msg}'")
+        return True
+
+    def get_name(self):
+        """
+        Get name of this transport.
+
+        :returns: 'chess_link_replay'
+        """
+        return "chess_link_replay"
+
+    def is_init(self):
+        """
+        Check, if transport is available.
+
+        :returns: True on success.
+        """
+        return self.init
@@ -0,0 +1,514 @@
+"""
+Simulated ChessLink board for load and latency tests without hardware.
+"""
+import asyncio
+import heapq
+import logging
+import queue
+import random
+import threading
+import time
+
+import chess_link_protocol as clp
+import chess_link_recorder as clr
+
+
+class Transport():
+    """
+    ChessLink transport implementation that simulates a Millennium board.
+
+    The simulation implements the protocol as documented in
+    `magic-link.md <https://github.com/domschl/python-mchess/blob/master/mchess/magic-board.md>`_:
+    version, E2ROM registers (scan time, automatic reports, debounce, led brightness), status
+    's' frames, 'L'/'X' led commands and reset. The simulated board has its cable on the right
+    side.
+
+    The board is scripted with `move()`, `lift()`, `place()`, `set_position()` and `wait()`. All
+    script actions are put on a time line and executed by a background thread, which allows to
+    generate thousands of board events per second. `jitter` adds a random delay to each event,
+    `crc_error_rate` flips a bit in a fraction of all replies. Replies are encoded as on the
+    wire and decoded by `chess_link_protocol.FrameParser` as with the hardware transports,
+    which discards corrupted frames. If `recorder` is set, the encoded replies are written to
+    the transport log as raw data, see `chess_link_recorder`.
+
+    To use it instead of a hardware board, set `"transport": "chess_link_sim"`,
+    `"address": "sim"` and `"autodetect": false` in `chess_link_config.json`.
+    """
+    recorder = None
+
+    START_RANKS = ["RNBQKBNR", "PPPPPPPP", "........", "........",
+                   "........", "........", "pppppppp", "rnbqkbnr"]
+
+    def __init__(self, que, protocol_dbg=False):
+        """
+        Initialize with python queue for event handling.
+
+        :param que: Python queue that will receive events from the simulated board.
+        :param protocol_dbg: True: byte-level ChessLink protocol debug messages
+        """
+        self.log = logging.getLogger("ChessLinkSim")
+        self.que = que
+        self.init = True
+        self.protocol_debug = protocol_dbg
+        self.version = (1, 4)
+        self.reply_delay = 0.0
+        self.reset_delay = 3.0
+        self.jitter = 0.0
+        self.crc_error_rate = 0.0
+        self.random = random.Random(0)
+        self.registers = {}
+        self.leds = None
+        self.led_slot_time = 0
+        self.board = None
+        self.reset_board()
+        self.parser = clp.FrameParser()
+
+        self.stats = {'frames': 0, 'replies': 0, 'crc_errors': 0, 'commands': 0,
+                      'led_commands': 0}
+        self.thread_active = False
+        self.event_thread = None
+        self.timeline = []
+        self.timeline_seq = 0
+        self.timeline_cv = threading.Condition()
+        self.last_event_time = 0.0
+        self.online = False
+
+    def reset_board(self):
+        """
+        Reset registers and leds to the power-on state, and set up the start position.
+        """
+        self.registers = {0: 0, 1: 20, 2: 0, 3: 0, 4: 15}
+        self.leds = ["00"] * 81
+        self.led_slot_time = 0
+        self.board = ['.'] * 64
+        for y in range(8):
+            for x in range(8):
+                self.board[y * 8 + x] = self.START_RANKS[y][x]
+
+    def quit(self):
+        """
+        Initiate worker-thread stop
+        """
+        with self.timeline_cv:
+            self.thread_active = False
+            self.timeline_cv.notify()
+
+    def search_board(self, iface=None):
+        """
+        Simulated boards are not autodetected.
+
+        :returns: None
+        """
+        return None
+
+    def test_board(self, address):
+        """
+        :returns: version string of the simulated board.
+        """
+        return f"{self.version[0]:02d}.{self.version[1]:02d}"
+
+    def open_mt(self, address):
+        """
+        Start the simulated board.
+
+        :param address: not used.
+        :returns: True
+        """
+        self.start()
+        self.que.put('agent-state: online Connected to simulated board')
+        return True
+
+    def start(self):
+        """
+        Start the time line thread of the simulated board.
+        """
+        if self.thread_active is True:
+            return
+        self.thread_active = True
+        self.online = True
+        self.event_thread = threading.Thread(
+            target=self.event_worker_thread, args=(self.que,))
+        self.event_thread.setDaemon(True)
+        self.event_thread.start()
+
+    def get_name(self):
+        """
+        Get name of this transport.
+
+        :returns: 'chess_link_sim'
+        """
+        return "chess_link_sim"
+
+    def is_init(self):
+        """
+        Check, if transport is available.
+
+        :returns: True
+        """
+        return self.init
+
+    def _schedule(self, delay, action, *args):
+        """
+        Put an action on the time line, `delay` seconds after the previous scripted event
+        (script actions) or after now (replies).
+        """
+        with self.timeline_cv:
+            now = time.perf_counter()
+            t = max(now, self.last_event_time) + delay
+            if self.jitter > 0:
+                t += self.random.uniform(0, self.jitter)
+            self.last_event_time = t
+            heapq.heappush(self.timeline, (t, self.timeline_seq, action, args))
+            self.timeline_seq += 1
+            self.timeline_cv.notify()
+
+    def event_worker_thread(self, que):
+        """
+        Background thread that executes the time line of scripted board events and replies.
+        """
+        self.log.debug('Simulation worker thread started.')
+        while True:
+            with self.timeline_cv:
+                while self.thread_active is True:
+                    if len(self.timeline) == 0:
+                        self.timeline_cv.wait()
+                        continue
+                    delay = self.timeline[0][0] - time.perf_counter()
+                    if delay <= 0:
+                        break
+                    self.timeline_cv.wait(delay)
+                if self.thread_active is False:
+                    break
+                _, _, action, args = heapq.heappop(self.timeline)
+            action(*args)
+        self.log.debug('Simulation worker thread stopped.')
+
+    def wait_idle(self, timeout=None):
+        """
+        Wait until all scripted events have been executed.
+
+        :returns: True, if the time line is empty.
+        """
+        start = time.time()
+        while len(self.timeline) > 0:
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _reply(self, msg):
+        """
+        Encode a reply with parity and block CRC, optionally corrupt it, and send the frames
+        decoded by the frame parser (as the hardware transports do).
+        """
+        if self.online is False:
+            return
+        data = clp.encode_message(msg.encode('ascii'))
+        if self.crc_error_rate > 0 and self.random.random() < self.crc_error_rate:
+            data = bytearray(data)
+            data[self.random.randrange(1, len(data))] ^= 1 << self.random.randrange(7)
+            self.stats['crc_errors'] += 1
+        if self.protocol_debug is True:
+            self.log.debug(f"Simulated board sends: {data}")
+        self.send_wire(data)
+
+    def send_wire(self, data):
+        """
+        Deliver encoded data sent by the board: decode it like a hardware transport.
+        `SimulatedPeripheral` replaces this to send Bluetooth LE notifications instead.
+        """
+        if self.recorder is not None:
+            self.recorder.record(clr.RAW, data)
+        for frame in self.parser.feed(data):
+            self.stats['replies'] += 1
+            self.que.put(frame)
+
+    def _raw_position(self):
+        """
+        Board state as 64 characters in the order of an 's' frame.
+        """
+        return "".join(self.board[7 - x + y * 8] for y in range(8) for x in range(8))
+
+    def _send_status(self):
+        self.stats['frames'] += 1
+        self._reply('s' + self._raw_position())
+
+    def _board_changed(self):
+        # Register 2: 1: automatic reports disabled, all other modes report changes
+        if self.registers.get(2, 0) & 7 != 1:
+            self._send_status()
+
+    def write_mt(self, msg):
+        """
+        Receive a command for the simulated board.
+
+        :param msg: Message string without parity and CRC.
+        """
+        self.stats['commands'] += 1
+        if self.protocol_debug is True:
+            self.log.debug(f"Simulated board received: {msg}")
+        if len(msg) == 0 or self.online is False:
+            return False
+        cmd = msg[0]
+        if cmd == 'V':
+            self._schedule_reply('v' + clp.hex2(self.version[0]) + clp.hex2(self.version[1]))
+        elif cmd == 'S':
+            self._schedule_reply_action(self._send_status)
+        elif cmd == 'L':
+            if len(msg) != 3 + 81 * 2:
+                self.log.warning(f"Invalid led command length {len(msg)}")
+                return False
+            self.stats['led_commands'] += 1
+            self.led_slot_time = int(msg[1:3], 16)
+            self.leds = [msg[3 + i * 2:5 + i * 2] for i in range(81)]
+            self._schedule_reply('l')
+        elif cmd == 'X':
+            self.stats['led_commands'] += 1
+            self.leds = ["00"] * 81
+            self._schedule_reply('x')
+        elif cmd == 'W':
+            addr = int(msg[1:3], 16)
+            self.registers[addr] = int(msg[3:5], 16)
+            self._schedule_reply('w' + msg[1:5])
+        elif cmd == 'R':
+            addr = int(msg[1:3], 16)
+            self._schedule_reply('r' + msg[1:3] + clp.hex2(self.registers.get(addr, 0)))
+        elif cmd == 'T':
+            self.online = False
+            self._schedule_reply_action(self._reset_done, self.reset_delay)
+        else:
+            self.log.warning(f"Unknown command {msg}")
+            return False
+        return True
+
+    def _schedule_reply(self, reply):
+        self._schedule_reply_action(self._reply, self.reply_delay, reply)
+
+    def _schedule_reply_action(self, action, delay=None, *args):
+        if delay is None:
+            delay = self.reply_delay
+        with self.timeline_cv:
+            t = time.perf_counter() + delay
+            heapq.heappush(self.timeline, (t, self.timeline_seq, action, args))
+            self.timeline_seq += 1
+            self.timeline_cv.notify()
+
+    def _reset_done(self):
+        self.reset_board()
+        self.online = True
+        self._board_changed()
+
+    # Scripting interface
+
+    def _square(self, name):
+        return (ord(name[1]) - ord('1')) * 8 + ord(name[0]) - ord('a')
+
+    def _set_square(self, sq, piece):
+        self.board[sq] = piece
+        self._board_changed()
+
+    def set_position(self, fen, delay=0.0):
+        """
+        Script: set up a position (position part of a FEN) in one board event.
+        """
+        board = ['.'] * 64
+        ranks = fen.split(' ')[0].split('/')
+        for y, rank in enumerate(reversed(ranks)):
+            x = 0
+            for c in rank:
+                if c.isdigit():
+                    x += int(c)
+                else:
+                    board[y * 8 + x] = c
+                    x += 1
+
+        def _set():
+            self.board = board
+            self._board_changed()
+        self._schedule(delay, _set)
+
+    def lift(self, square, delay=0.0):
+        """
+        Script: lift the piece on `square` (e.g. 'e2').
+        """
+        self._schedule(delay, self._set_square, self._square(square), '.')
+
+    def place(self, square, piece, delay=0.0):
+        """
+        Script: put `piece` (FEN character) on `square`.
+        """
+        self._schedule(delay, self._set_square, self._square(square), piece)
+
+    def wait(self, delay):
+        """
+        Script: pause before the next scripted event.
+        """
+        self._schedule(delay, lambda: None)
+
+    def move(self, uci, delay=0.0, partial=False):
+        """
+        Script: play a move in uci notation (e2e4, e7e8q) as a human would: captured piece
+        is removed first, then the piece is lifted and put down. Castling moves king, then
+        rook, en passant removes the captured pawn.
+
+        :param uci: move
+        :param delay: delay before the move and between its single board events
+        :param partial: True: the piece is lifted and put back on its start square
+                        (aborted move), no move is made.
+        """
+        self._schedule(delay, self._play_move, uci, delay, partial)
+
+    def play(self, moves, interval=0.0, partial_every=0):
+        """
+        Script: play a sequence of uci moves.
+
+        :param moves: list of uci moves.
+        :param interval: delay between board events
+        :param partial_every: if > 0, every n-th move is preceded by an aborted attempt.
+        """
+        for i, uci in enumerate(moves):
+            if partial_every > 0 and i % partial_every == 0:
+                self.move(uci, interval, partial=True)
+            self.move(uci, interval)
+
+    def _play_move(self, uci, delay, partial):
+        # Executed on the time line: split a move into its single board events.
+        fr = self._square(uci[0:2])
+        to = self._square(uci[2:4])
+        piece = self.board[fr]
+        if partial is True:
+            self._schedule(0.0, self._set_square, fr, '.')
+            self._schedule(delay, self._set_square, fr, piece)
+            return
+        if len(uci) > 4:
+            promo = uci[4]
+            piece = promo.upper() if piece.isupper() else promo.lower()
+        if self.board[to] != '.':
+            self._schedule(0.0, self._set_square, to, '.')
+        elif piece in 'Pp' and fr % 8 != to % 8:
+            # en passant
+            self._schedule(0.0, self._set_square, (fr // 8) * 8 + to % 8, '.')
+        self._schedule(delay, self._set_square, fr, '.')
+        self._schedule(delay, self._set_square, to, piece)
+        if piece in 'Kk' and abs(fr - to) == 2:
+            if to > fr:
+                rfr, rto = fr + 3, fr + 1
+            else:
+                rfr, rto = fr - 4, fr - 1
+            rook = self.board[rfr]
+            self._schedule(delay, self._set_square, rfr, '.')
+            self._schedule(delay, self._set_square, rto, rook)
+
+    def frame_burst(self, count, interval=0.0):
+        """
+        Script: send `count` status frames of the current position (e.g. a board with automatic
+        reports on every scan), for throughput tests.
+        """
+        for _ in range(count):
+            self._schedule(interval, self._send_status)
+
+
+class SimulatedPeripheral:
+    """
+    Bluetooth LE GATT peripheral of a simulated ChessLink board, for testing Bluetooth LE
+    transports without hardware.
+
+    `client()` creates client objects with the subset of the `bleak.BleakClient` interface
+    used by `chess_link_pyblue`: `connect()`, `disconnect()`, `is_connected`,
+    `start_notify()` and `write_gatt_char()`. Replies of the board are sent as notifications
+    in chunks of `mtu` bytes. `fail_connects` lets the next connection attempts fail, and
+    `drop_connection()` simulates a lost connection.
+    """
+
+    def __init__(self, board=None, mtu=20, ack_latency=0.005):
+        """
+        :param board: simulated board (`Transport`), a new one is created by default.
+        :param mtu: max. size of a notification
+        :param ack_latency: time the peripheral needs to acknowledge a write
+        """
+        if board is None:
+            board = Transport(queue.Queue())
+        self.board = board
+        self.board.send_wire = self._notify
+        self.mtu = mtu
+        self.ack_latency = ack_latency
+        self.fail_connects = 0
+        self.connects = 0
+        self.active_client = None
+
+    def client(self, address, disconnected_callback=None):
+        """
+        Factory for client connections, use instead of `bleak.BleakClient`.
+        """
+        return SimulatedGattClient(self, address, disconnected_callback)
+
+    def _notify(self, data):
+        client = self.active_client
+        if client is None or client.is_connected is False:
+            return
+        for i in range(0, len(data), self.mtu):
+            client.notify(data[i:i + self.mtu])
+
+    def drop_connection(self):
+        """
+        Simulate the loss of the connection to the client.
+        """
+        if self.active_client is not None:
+            self.active_client.lost()
+
+
+class SimulatedGattClient:
+    """
+    Client connection to a `SimulatedPeripheral`.
+    """
+
+    def __init__(self, peripheral, address, disconnected_callback=None):
+        self.peripheral = peripheral
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.connected = False
+        self.loop = None
+        self.callbacks = {}
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        if self.peripheral.fail_connects > 0:
+            self.peripheral.fail_connects -= 1
+            raise ConnectionError(f"Simulated connection failure to {self.address}")
+        self.connected = True
+        self.peripheral.connects += 1
+        self.peripheral.active_client = self
+        self.peripheral.board.start()
+        return True
+
+    async def disconnect(self):
+        self.connected = False
+        return True
+
+    async def start_notify(self, char, callback):
+        self.callbacks[char] = callback
+
+    async def write_gatt_char(self, char, data, response=False):
+        if self.connected is False:
+            raise ConnectionError("Not connected")
+        if response is True:
+            await asyncio.sleep(self.peripheral.ack_latency)
+        frame = clp.decode_message(data)
+        if clp.check_crc(frame):
+            self.peripheral.board.write_mt(frame[:-2].decode('ascii'))
+
+    def notify(self, data):
+        """
+        Send a notification to the client (called from the board's thread).
+        """
+        for char, callback in list(self.callbacks.items()):
+            self.loop.call_soon_threadsafe(callback, char, bytearray(data))
+
+    def lost(self):
+        self.connected = False
+        if self.disconnected_callback is not None:
+            self.loop.call_soon_threadsafe(self.disconnected_callback, self)
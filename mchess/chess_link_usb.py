@@ -1,11 +1,14 @@
 """
 ChessLink transport implementation for USB connections.
 """
+import collections
+import concurrent.futures
 import logging
 import threading
 import time
 
 import chess_link_protocol as clp
+import chess_link_recorder as clr
 
 try:
     import serial
@@ -14,6 +17,9 @@ try:
 except ImportError:
     usb_support = False
 
+# Deadline for the version handshake when probing a port
+PROBE_TIMEOUT = 0.5
+
 
 class Transport():
     """
@@ -24,7 +30,10 @@ class Transport():
 
     This transport uses an asynchronous background thread for hardware communcation.
     All replies are written to the python queue `que` given during initialization.
+    If `recorder` is set, all received data is written to the transport log, see
+    `chess_link_recorder`.
     """
+    recorder = None
 
     def __init__(self, que, protocol_dbg=False):
         """
@@ -51,12 +60,48 @@ class Transport():
         self.event_thread = None
         self.usb_dev = None
         self.uport = None
+        self.rx_start = None
+        self.rx_bytes = 0
+        self.rx_reads = 0
+        self.rx_frames = 0
+        # Outbound queue, written by the writer thread
+        self.wrque = clp.CommandQueue()
+        self.writer_thread = None
+        self.wr_latencies = collections.deque(maxlen=1000)
+        self.wr_count = 0
 
     def quit(self):
         """
         Initiate worker-thread stop
         """
         self.thread_active = False
+        self.wrque.close()
+        if self.rx_start is not None:
+            self.log.info(f"USB statistics: {self.stats()}")
+
+    def stats(self):
+        """
+        Receive and write statistics since the port was opened.
+
+        :returns: dictionary with received bytes, reads, frames, bytes/s and frames/s,
+                  number of writes, led commands replaced in the write queue, current and
+                  max. write queue depth, and median, 95th percentile and max write latency
+                  (from `write_mt()` until written) in ms. None if the port has not been opened.
+        """
+        if self.rx_start is None:
+            return None
+        dt = max(time.time() - self.rx_start, 1e-6)
+        stats = {'bytes': self.rx_bytes, 'reads': self.rx_reads, 'frames': self.rx_frames,
+                 'bytes_per_s': self.rx_bytes / dt, 'frames_per_s': self.rx_frames / dt,
+                 'writes': self.wr_count, 'led_coalesced': self.wrque.coalesced,
+                 'write_queue_depth': len(self.wrque),
+                 'max_write_queue_depth': self.wrque.max_depth}
+        lat = sorted(self.wr_latencies)
+        if len(lat) > 0:
+            stats['write_median_ms'] = lat[len(lat) // 2] * 1000.0
+            stats['write_p95_ms'] = lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000.0
+            stats['write_max_ms'] = lat[-1] * 1000.0
+        return stats
 
     def search_board(self, iface=None):
         """
@@ -83,76 +128,107 @@ class Transport():
 
         :returns: Version string on ok, None on failure.
         """
-        self.log.debug(f"Testing port: {port}")
-        try:
-            self.usb_dev = serial.Serial(port, 38400, timeout=2)
-            self.usb_dev.dtr = 0
-            self.write_mt("V")
-            version = self.usb_read_synchr(self.usb_dev, 'v', 7)
-            if len(version) != 7:
-                self.usb_dev.close()
-                self.log.debug(f"Message length {len(version)} instead of 7")
-                return None
-            if version[0] != 'v':
-                self.log.debug(f"Unexpected reply {version}")
-                self.usb_dev.close()
-                return None
-            verstring = f'{version[1]+version[2]}.{version[3]+version[4]}'
-            self.log.debug(f"Millennium {verstring} at {port}")
-            self.usb_dev.close()
-            return verstring
-        except (OSError, serial.SerialException) as e:
-            self.log.debug(f'Board detection on {port} resulted in error {e}')
-        try:
-            self.usb_dev.close()
-        except Exception:
-            pass
-        return None
+        return self.probe_port(port)
 
-    def usb_port_check(self, port):
+    def probe_port(self, port, timeout=PROBE_TIMEOUT):
         """
-        Check usb port for valid ChessLink connection
+        Open an usb port, send a version request and wait for the reply of a ChessLink board.
+        The port is closed again.
 
-        :returns: True on success, False on failure.
+        :param port: usb port name
+        :param timeout: deadline in seconds for the whole handshake. A board answers within
+                        a few milliseconds.
+        :returns: Version string on ok, None on failure.
         """
         self.log.debug(f"Testing port: {port}")
+        dev = None
         try:
-            s = serial.Serial(port, 38400)
-            s.close()
-            return True
-        except (OSError, serial.SerialException) as e:
-            self.log.debug(f"Can't open port {port}, {e}")
-            return False
+            deadline = time.time() + timeout
+            dev = serial.Serial(port, 38400, timeout=timeout, write_timeout=timeout)
+            dev.dtr = 0
+            dev.write(clp.encode_message(b"V"))
+            parser = clp.FrameParser()
+            while time.time() < deadline:
+                dev.timeout = max(deadline - time.time(), 0.001)
+                data = dev.read(max(1, dev.in_waiting))
+                for frame in parser.feed(data):
+                    if frame[0] == 'v':
+                        verstring = f'{frame[1:3]}.{frame[3:5]}'
+                        self.log.debug(f"Millennium {verstring} at {port}")
+                        return verstring
+            self.log.debug(f"No version reply from {port} within {timeout} s")
+        except (OSError, ValueError, serial.SerialException) as e:
+            self.log.debug(f'Board detection on {port} resulted in error {e}')
+        finally:
+            if dev is not None:
+                try:
+                    dev.close()
+                except Exception:
+                    pass
+        return None
 
     def usb_port_search(self):
         """
         Get a list of all usb ports that have a connected ChessLink board.
 
+        All ports are probed in parallel, each with a deadline of `PROBE_TIMEOUT`, the search
+        ends with the first board found.
+
         :returns: array of usb port names with valid ChessLink boards, an empty array
                   if none is found.
         """
         ports = list([port.device for port in serial.tools.list_ports.comports(True)])
         vports = []
-        for port in ports:
-            if self.usb_port_check(port):
-                version = self.test_board(port)
-                if version is not None:
+        if len(ports) == 0:
+            return vports
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ports), 16))
+        probes = {pool.submit(self.probe_port, port): port for port in ports}
+        try:
+            for probe in concurrent.futures.as_completed(probes):
+                if probe.result() is not None:
+                    port = probes[probe]
                     self.log.debug(f"Found board at: {port}")
                     vports.append(port)
                     break  # only one port necessary
+        finally:
+            # Remaining probes end at their deadline and close their ports
+            pool.shutdown(wait=False)
         return vports
 
     def write_mt(self, msg):
         """
-        Encode and write a message to ChessLink.
+        Queue a message for writing to ChessLink, and return immediately.
+
+        Led commands ('L', 'X') replace a led command that is still waiting in the queue,
+        all other commands are written in order.
 
         :param msg: Message string. Parity will be added, and block CRC appended.
+        :returns: True
+        """
+        self.wrque.put(msg)
+        return True
+
+    def writer_thread_worker(self):
+        """
+        Background thread that writes the messages queued by `write_mt()`.
+        """
+        self.log.debug('USB writer thread started.')
+        while self.thread_active is True:
+            # Blocks until a command is queued, or quit() closes the queue
+            entry = self.wrque.get()
+            if entry is None:
+                break
+            t_queued, msg = entry
+            self._write(msg)
+            self.wr_count += 1
+            self.wr_latencies.append(time.perf_counter() - t_queued)
+        self.log.debug('USB writer thread stopped.')
+
+    def _write(self, msg):
+        """
+        Encode and write a message to ChessLink.
         """
-        msg = clp.add_block_crc(msg)
-        bts = []
-        for c in msg:
-            bo = clp.add_odd_par(c)
-            bts.append(bo)
+        bts = clp.encode_message(msg.encode('ascii'))
         try:
             if self.protocol_debug is True:
                 self.log.debug(f'Trying write <{bts}>')
@@ -166,32 +242,6 @@ class Transport():
             self.log.debug(f"Written '{msg}' as < {bts} > ok")
         return True
 
-    def usb_read_synchr(self, usbdev, cmd, num):
-        """
-        Synchronous reads for initial hardware detection.
-        """
-        rep = []
-        start = False
-        while start is False:
-            try:
-                b = chr(ord(usbdev.read()) & 127)
-            except Exception as e:
-                self.log.debug(f"USB read failed: {e}")
-                return []
-            if b == cmd:
-                rep.append(b)
-                start = True
-        for _ in range(num - 1):
-            try:
-                b = chr(ord(usbdev.read()) & 127)
-                rep.append(b)
-            except (Exception) as e:
-                self.log.error(f"Read error {e}")
-                break
-        if clp.check_block_crc(rep) is False:
-            return []
-        return rep
-
     def agent_state(self, que, state, msg):
         if state != self.last_agent_state:
             self.last_agent_state = state
@@ -218,6 +268,9 @@ class Transport():
             target=self.event_worker_thread, args=(self.que,))
         self.event_thread.setDaemon(True)
         self.event_thread.start()
+        self.writer_thread = threading.Thread(target=self.writer_thread_worker)
+        self.writer_thread.setDaemon(True)
+        self.writer_thread.start()
         return True
 
     def event_worker_thread(self, que):
@@ -225,9 +278,8 @@ class Transport():
         Background thread that sends data received via usb to the queue `que`.
         """
         self.log.debug('USB worker thread started.')
-        cmd_started = False
-        cmd_size = 0
-        cmd = ""
+        parser = clp.FrameParser()
+        self.rx_start = time.time()
         self.agent_state(self.que, 'online', f'Connected to {self.uport}')
         self.error_state = False
         posted = False
@@ -253,44 +305,37 @@ class Transport():
                         self.agent_state(self.que, 'offline', emsg)
                         posted = True
 
-            b = ""
             try:
-                if cmd_started is False:
-                    self.usb_dev.timeout = None
-                else:
-                    self.usb_dev.timeout = 0.2
-                by = self.usb_dev.read()
-                if len(by) > 0:
-                    b = chr(ord(by) & 127)
-                else:
-                    continue
+                # Block (with timeout) for the first byte, then take everything available
+                by = self.usb_dev.read(max(1, self.usb_dev.in_waiting))
+                if len(by) > 0 and self.usb_dev.in_waiting > 0:
+                    by += self.usb_dev.read(self.usb_dev.in_waiting)
             except Exception as e:
-                if len(cmd) > 0:
-                    self.log.debug(f"USB command '{cmd[0]}' interrupted: {e}")
+                if parser.pending() > 0:
+                    self.log.debug(f"USB command interrupted: {e}")
+                    if self.recorder is not None:
+                        self.recorder.record(clr.RAW, b'')
                 time.sleep(0.1)
-                cmd_started = False
-                cmd_size = 0
-                cmd = ""
+                parser.reset()
                 self.error_state = True
                 continue
-            if len(b) > 0:
-                if cmd_started is False:
-                    if b in clp.protocol_replies:
-                        cmd_started = True
-                        cmd_size = clp.protocol_replies[b]
-                        cmd = b
-                        cmd_size -= 1
-                else:
-                    cmd += b
-                    cmd_size -= 1
-                    if cmd_size == 0:
-                        cmd_started = False
-                        cmd_size = 0
-                        if self.protocol_debug is True:
-                            self.log.debug(f"USB received cmd: {cmd}")
-                        if clp.check_block_crc(cmd):
-                            que.put(cmd)
-                        cmd = ""
+            if len(by) == 0:
+                # Read timeout: the rest of a partially received frame will not arrive
+                if parser.pending() > 0:
+                    self.log.debug(f"Discarding {parser.pending()} bytes of incomplete frame")
+                    if self.recorder is not None:
+                        self.recorder.record(clr.RAW, b'')
+                    parser.reset()
+                continue
+            if self.recorder is not None:
+                self.recorder.record(clr.RAW, by)
+            self.rx_reads += 1
+            self.rx_bytes += len(by)
+            for cmd in parser.feed(by):
+                self.rx_frames += 1
+                if self.protocol_debug is True:
+                    self.log.debug(f"USB received cmd: {cmd}")
+                que.put(cmd)
 
     def get_name(self):
         """
@@ -0,0 +1,124 @@
+''' Compact websocket encoding of `current_move_info` messages '''
+
+VERSION = 1
+FIELDS = ['actor', 'multipv_index', 'score', 'depth', 'seldepth', 'nps', 'tbhits', 'variant',
+          'san_variant', 'preview_fen']
+TAG = 'i'
+
+
+class CompactInfoEncoder:
+    """
+    Encodes `current_move_info` messages as JSON arrays without keys, for web clients that
+    negotiated the compact encoding.
+
+    The array is `['i', <values of FIELDS>]`, optionally followed by an object with fields
+    that are not part of the schema. Missing fields are `null`. Actor names are interned:
+    the array contains the index into the actor table of the schema message, which is sent
+    again whenever a new actor appears. Moves are packed:
+
+    - `variant`: UCI moves concatenated to one string, e.g. `"e2e4e7e5"`
+    - `san_variant`: `[first_move_number, black_starts, "SAN moves separated by blanks"]`
+    """
+
+    def __init__(self):
+        self.actors = []
+        self.actor_index = {}
+
+    def schema(self):
+        """
+        Schema message that clients need to decode compact messages.
+        """
+        return {'cmd': 'compact_info_schema', 'version': VERSION, 'fields': FIELDS,
+                'actors': list(self.actors)}
+
+    def encode(self, info):
+        """
+        :param info: `current_move_info` message
+        :returns: tuple (array, new_actor): new_actor is True, if the actor table changed
+                  and the schema message needs to be resent.
+        """
+        new_actor = False
+        actor = info.get('actor')
+        if actor not in self.actor_index:
+            self.actor_index[actor] = len(self.actors)
+            self.actors.append(actor)
+            new_actor = True
+        packed = [TAG, self.actor_index[actor]]
+        for field in FIELDS[1:]:
+            value = info.get(field)
+            if value is not None:
+                if field == 'variant':
+                    value = ''.join(value)
+                elif field == 'san_variant':
+                    value = pack_san_variant(value)
+            packed.append(value)
+        extra = {key: value for key, value in info.items()
+                 if key not in FIELDS and key != 'cmd'}
+        if len(extra) > 0:
+            packed.append(extra)
+        return packed, new_actor
+
+
+def pack_san_variant(san_variant):
+    if len(san_variant) == 0:
+        return [0, 0, '']
+    black_starts = 1 if san_variant[0][1] == '..' else 0
+    moves = [mv for entry in san_variant for mv in entry[1:] if mv != '..']
+    return [san_variant[0][0], black_starts, ' '.join(moves)]
+
+
+def unpack_san_variant(packed):
+    if packed is None:
+        return []
+    move_number, black_starts, text = packed
+    moves = text.split(' ') if text != '' else []
+    san_variant = []
+    i = 0
+    if black_starts == 1:
+        san_variant.append([move_number, '..'] + moves[:1])
+        move_number += 1
+        i = 1
+    while i < len(moves):
+        san_variant.append([move_number] + moves[i:i + 2])
+        move_number += 1
+        i += 2
+    return san_variant
+
+
+def unpack_variant(packed):
+    # UCI moves are 4 characters, promotions 5 (e.g. e7e8q). A move starts with file and
+    # rank, so a piece letter is a promotion if it is not followed by a rank.
+    moves = []
+    i = 0
+    while i < len(packed):
+        n = 4
+        if i + 4 < len(packed) and packed[i + 4] in 'qrbn' and \
+                (i + 5 == len(packed) or not packed[i + 5].isdigit()):
+            n = 5
+        moves.append(packed[i:i + n])
+        i += n
+    return moves
+
+
+def decode(packed, schema):
+    """
+    Reference decoder, the web client implements the same in `mchess.js`.
+
+    :param packed: array as generated by `CompactInfoEncoder.encode()`
+    :param schema: schema message
+    :returns: `current_move_info` message
+    """
+    info = {'cmd': 'current_move_info'}
+    for field, value in zip(schema['fields'], packed[1:]):
+        if value is None:
+            continue
+        if field == 'actor':
+            value = schema['actors'][value]
+        elif field == 'variant':
+            value = unpack_variant(value)
+        elif field == 'san_variant':
+            value = unpack_san_variant(value)
+        info[field] = value
+    if len(packed) > len(schema['fields']) + 1:
+        info.update(packed[-1])
+    return info
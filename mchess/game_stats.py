@@ -0,0 +1,164 @@
+''' Per-ply evaluation time series for game statistics '''
+import math
+from array import array
+
+
+class GameStats:
+    """
+    Columnar store for per-ply engine statistics (score, depth, seldepth, nps, tbhits,
+    time used) of a game.
+
+    Each column is a python `array`, so appending a ply is O(1) and export or
+    downsampling for charts does not need to walk a list of dicts. Missing values are
+    stored as NaN (float columns) or -1 (integer columns) and are omitted again when
+    records are exported.
+
+    Agents are not sent the complete series on every change. The store tracks the
+    lowest index that changed since the last call to `delta()`, a delta consists of
+    that start index and all records from there on: receivers truncate their copy
+    to `start` entries and append the records.
+    """
+
+    def __init__(self):
+        self.ply = array('l')
+        self.score = array('d')
+        self.mate = array('l')
+        self.depth = array('l')
+        self.seldepth = array('l')
+        self.nps = array('q')
+        self.tbhits = array('q')
+        self.time_used = array('d')
+        self.players = []
+        self._columns = (self.ply, self.score, self.mate, self.depth, self.seldepth,
+                         self.nps, self.tbhits, self.time_used, self.players)
+        self.dirty_from = 0
+
+    def __len__(self):
+        return len(self.ply)
+
+    def clear(self):
+        for col in self._columns:
+            del col[:]
+        self.dirty_from = 0
+
+    def append(self, stat):
+        """
+        Append statistics of one ply.
+
+        :param stat: dictionary as generated by `record()`, requires `ply`, all other
+                     fields are optional. `score` is either a float (pawns) or a
+                     mate announcement string `#n`.
+        """
+        self.dirty_from = min(self.dirty_from, len(self))
+        self.ply.append(stat['ply'])
+        score = stat.get('score')
+        mate = 0
+        if isinstance(score, str):
+            if score.startswith('#'):
+                try:
+                    mate = int(score[1:])
+                except ValueError:
+                    mate = 0
+            score = math.nan
+        elif score is None:
+            score = math.nan
+        self.score.append(score)
+        self.mate.append(mate)
+        self.depth.append(stat.get('depth', -1))
+        self.seldepth.append(stat.get('seldepth', -1))
+        self.nps.append(stat.get('nps', -1))
+        self.tbhits.append(stat.get('tbhits', -1))
+        time_used = stat.get('time')
+        self.time_used.append(math.nan if time_used is None else time_used)
+        self.players.append(stat.get('player', ''))
+
+    def pop(self):
+        """
+        Remove the last ply.
+
+        :returns: the removed record, can be re-inserted with `append()`.
+        """
+        rec = self.record(len(self) - 1)
+        for col in self._columns:
+            col.pop()
+        self.dirty_from = min(self.dirty_from, len(self))
+        return rec
+
+    def record(self, i):
+        """
+        Export ply `i` as dictionary in the format used by the `game_stats` message.
+        """
+        ply = self.ply[i]
+        rec = {'ply': ply,
+               'move_number': ply // 2 + 1,
+               'player': self.players[i]}
+        if ply % 2 == 0:
+            rec['color'] = 'WHITE'
+            rec['halfmove_number'] = (ply // 2 + 1) * 2
+        else:
+            rec['color'] = 'BLACK'
+            rec['halfmove_number'] = (ply // 2 + 1) * 2 + 1
+        if self.mate[i] != 0:
+            rec['score'] = f"#{self.mate[i]}"
+        elif not math.isnan(self.score[i]):
+            rec['score'] = self.score[i]
+        for name, col in (('depth', self.depth), ('seldepth', self.seldepth),
+                          ('nps', self.nps), ('tbhits', self.tbhits)):
+            if col[i] != -1:
+                rec[name] = col[i]
+        if not math.isnan(self.time_used[i]):
+            rec['time'] = self.time_used[i]
+        return rec
+
+    def records(self, start=0):
+        return [self.record(i) for i in range(start, len(self))]
+
+    def delta(self):
+        """
+        Get all changes since the last call of `delta()`.
+
+        :returns: tuple (start, records): receivers truncate their list to `start`
+                  entries and append `records`.
+        """
+        start = self.dirty_from
+        self.dirty_from = len(self)
+        return start, self.records(start)
+
+    def columns(self, stride=1):
+        """
+        Export the series column-wise (e.g. as chart data sets).
+
+        :param stride: only export every stride-th ply, the last ply is always included.
+        :returns: dictionary of column name: list, missing values are None.
+        """
+        idx = list(range(0, len(self), stride))
+        if len(self) > 0 and idx[-1] != len(self) - 1:
+            idx.append(len(self) - 1)
+
+        def _col(col, missing):
+            return [None if _is_missing(col[i], missing) else col[i] for i in idx]
+
+        return {'ply': [self.ply[i] for i in idx],
+                'score': _col(self.score, math.nan),
+                'mate': [self.mate[i] for i in idx],
+                'depth': _col(self.depth, -1),
+                'seldepth': _col(self.seldepth, -1),
+                'nps': _col(self.nps, -1),
+                'tbhits': _col(self.tbhits, -1),
+                'time': _col(self.time_used, math.nan),
+                'player': [self.players[i] for i in idx]}
+
+    def downsample(self, max_points):
+        """
+        Column export with at most (about) `max_points` plies, for graphs of long games.
+        """
+        if max_points < 1:
+            max_points = 1
+        stride = max(1, math.ceil(len(self) / max_points))
+        return self.columns(stride)
+
+
+def _is_missing(val, missing):
+    if isinstance(missing, float) and math.isnan(missing):
+        return math.isnan(val)
+    return val == missing
@@ -0,0 +1,118 @@
+''' PGN of the current game, maintained move by move '''
+import chess
+
+
+class IncrementalPGN:
+    """
+    Move list and PGN text of a game that is updated with the changes between two board
+    positions instead of being regenerated from the complete move stack.
+
+    `update()` compares the new board with the last one and returns a delta: receivers
+    truncate their move list to `start` plies and append the new SAN moves, like the
+    deltas of `game_stats.GameStats`. Each update increments the sequence number `seq`, so
+    receivers can detect lost deltas and request a full resync (`full()`).
+    """
+
+    SEVEN_TAG_ROSTER = ['Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result']
+
+    def __init__(self):
+        self.seq = 0
+        self._clear()
+
+    def _clear(self):
+        self.board = chess.Board()
+        self.root_fen = self.board.fen()
+        self.first_ply = 0
+        self.san = []
+        self.tokens = []
+        self.headers = {'Event': '?', 'Site': '?', 'Date': '????.??.??', 'Round': '?',
+                        'White': '?', 'Black': '?', 'Result': '*'}
+        self._text = None
+
+    def reset(self):
+        """
+        Discard the game, e.g. after an invalid position. The sequence number is not reset
+        but incremented, so that receivers accept the empty move list of `full()` as the
+        next delta.
+        """
+        self._clear()
+        self.seq += 1
+
+    def __len__(self):
+        return len(self.san)
+
+    def update(self, board, white=None, black=None):
+        """
+        Synchronize with the move stack of `board`.
+
+        :param board: `chess.Board` of the current game
+        :param white: name of white player, None: unchanged
+        :param black: name of black player, None: unchanged
+        :returns: tuple (start, san): receivers truncate their move list to `start` plies
+                  and append the list of SAN moves `san`.
+        """
+        self.seq += 1
+        self._text = None
+        if white is not None:
+            self.headers['White'] = white
+        if black is not None:
+            self.headers['Black'] = black
+        new = board.move_stack
+        root = board.root()
+        if root.fen() != self.root_fen:
+            self.board = root
+            self.root_fen = root.fen()
+            self.first_ply = root.ply()
+            start = 0
+        else:
+            old = self.board.move_stack
+            start = min(len(old), len(new))
+            if old[:start] != new[:start]:
+                start = next(i for i in range(start) if old[i] != new[i])
+            for _ in range(len(old) - start):
+                self.board.pop()
+        del self.san[start:]
+        del self.tokens[start:]
+        for move in new[start:]:
+            self._append(self.board.san(move))
+            self.board.push(move)
+        self.headers['Result'] = self.board.result()
+        return start, self.san[start:]
+
+    def _append(self, san):
+        ply = self.first_ply + len(self.san)
+        if ply % 2 == 0:
+            self.tokens.append(f"{ply // 2 + 1}. {san}")
+        elif len(self.san) == 0:
+            self.tokens.append(f"{ply // 2 + 1}... {san}")
+        else:
+            self.tokens.append(san)
+        self.san.append(san)
+
+    def full(self):
+        """
+        :returns: tuple (start, san) that replaces the complete move list, i.e. start 0.
+        """
+        return 0, list(self.san)
+
+    def pgn(self):
+        """
+        PGN text of the game, generated from the move tokens and cached until the next
+        update.
+        """
+        if self._text is not None:
+            return self._text
+        lines = [f'[{tag} "{self.headers[tag]}"]' for tag in self.SEVEN_TAG_ROSTER]
+        if self.root_fen != chess.STARTING_FEN:
+            lines += ['[SetUp "1"]', f'[FEN "{self.root_fen}"]']
+        lines.append('')
+        line = ''
+        for token in self.tokens + [self.headers['Result']]:
+            if len(line) + 1 + len(token) > 79 and line != '':
+                lines.append(line)
+                line = token
+            else:
+                line = token if line == '' else line + ' ' + token
+        lines.append(line)
+        self._text = '\n'.join(lines) + '\n'
+        return self._text
@@ -0,0 +1,155 @@
+"""
+End-to-end latency tracing of moves, from the hardware board through the dispatcher and the
+engines back to the board's leds.
+
+Each component marks the time a move passes one of the `STAGES` with `mark(move_id, stage)`.
+The move id is the number of half-moves played before the move (`chess.Board.ply()`), so
+marks of different threads and agents are correlated without passing ids around. The latency
+of a stage is the time since the previous mark of the same move. A move that is not started on
+the board (`transport_receive`) is measured from `dispatcher_move` of the previous move, e.g.
+`uci_go` of the engine's reply from the dispatcher handling the human move.
+"""
+import collections
+import threading
+import time
+
+STAGES = ['transport_receive', 'decode', 'check_move', 'dispatcher_move', 'uci_go',
+          'bestmove', 'led_write']
+
+
+class LatencyTracer:
+    """
+    Collects stage marks per move id and summarizes them as per-stage percentiles.
+    """
+
+    def __init__(self, max_moves=1000):
+        """
+        :param max_moves: number of most recent moves kept
+        """
+        self.mutex = threading.Lock()
+        self.max_moves = max_moves
+        self.moves = collections.OrderedDict()
+        self.history = {}
+
+    def mark(self, move_id, stage, t=None):
+        """
+        Record that move `move_id` has passed `stage`.
+
+        :param move_id: half-move index of the move
+        :param stage: one of `STAGES`
+        :param t: `time.perf_counter()` timestamp, default: now.
+        """
+        if t is None:
+            t = time.perf_counter()
+        with self.mutex:
+            marks = self.moves.get(move_id)
+            if marks is not None and any(m[0] == stage for m in marks):
+                # Move has been taken back and is played again
+                marks = None
+            if marks is None:
+                marks = []
+                self.moves[move_id] = marks
+                if len(self.moves) > self.max_moves:
+                    self.moves.popitem(last=False)
+            marks.append((stage, t))
+
+    def new_game(self):
+        """
+        Move ids restart with a new game: keep the latencies of the current game and
+        start with an empty set of moves.
+        """
+        with self.mutex:
+            for stage, lat in self._stage_latencies().items():
+                self.history.setdefault(stage, collections.deque(maxlen=self.max_moves)).extend(lat)
+            self.moves.clear()
+
+    def clear(self):
+        with self.mutex:
+            self.moves.clear()
+            self.history = {}
+
+    def stage_latencies(self):
+        """
+        :returns: dictionary stage: list of latencies in seconds
+        """
+        with self.mutex:
+            lat = self._stage_latencies()
+            for stage, hist in self.history.items():
+                lat.setdefault(stage, []).extend(hist)
+        return lat
+
+    def _stage_latencies(self):
+        # Latencies of the moves of the current game, called with mutex held.
+        lat = {stage: [] for stage in STAGES}
+        for move_id, marks in self.moves.items():
+            marks = sorted(marks, key=lambda m: m[1])
+            last = None
+            if marks[0][0] != 'transport_receive':
+                # Started by the previous move (e.g. engine reply), not by a human
+                last = self._commit_time(self.moves.get(move_id - 1))
+            for stage, t in marks:
+                # transport_receive is the start of a move made on the board
+                if last is not None and stage != 'transport_receive':
+                    lat.setdefault(stage, []).append(t - last)
+                last = t
+        return lat
+
+    def _commit_time(self, marks):
+        # Time a move was made by the dispatcher, or the last mark available.
+        if marks is None:
+            return None
+        for stage, t in marks:
+            if stage == 'dispatcher_move':
+                return t
+        return max(t for _, t in marks)
+
+    def summary(self):
+        """
+        Per-stage latency percentiles.
+
+        :returns: dictionary stage: {'count', 'median_ms', 'p95_ms', 'max_ms'} for all
+                  stages with marks.
+        """
+        summary = {}
+        for stage, lat in self.stage_latencies().items():
+            if len(lat) == 0:
+                continue
+            lat.sort()
+            summary[stage] = {'count': len(lat),
+                              'median_ms': lat[len(lat) // 2] * 1000.0,
+                              'p95_ms': lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000.0,
+                              'max_ms': lat[-1] * 1000.0}
+        return summary
+
+    def log_summary(self, log):
+        """
+        Write the per-stage summary to logger `log`.
+        """
+        for stage, s in self.summary().items():
+            log.info(f"Latency {stage:<18} n={s['count']:<5} median {s['median_ms']:8.2f} ms, "
+                     f"p95 {s['p95_ms']:8.2f} ms, max {s['max_ms']:8.2f} ms")
+
+
+tracer = LatencyTracer()
+
+
+def mark(move_id, stage, t=None):
+    """
+    Record a stage of move `move_id` with the global tracer, see `LatencyTracer.mark()`.
+    """
+    tracer.mark(move_id, stage, t)
+
+
+def fen_ply(fen):
+    """
+    Half-move index of the side to move in a FEN, i.e. the move id of the next move.
+
+    :returns: ply number, None for an invalid FEN.
+    """
+    fields = fen.split(' ')
+    if len(fields) < 6:
+        return None
+    try:
+        return (int(fields[5]) - 1) * 2 + (1 if fields[1] == 'b' else 0)
+    except ValueError:
+        return None
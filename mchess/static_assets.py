@@ -0,0 +1,212 @@
+''' In-memory cache of precompressed static files for the web agent '''
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+
+from aiohttp import web
+try:
+    import brotli
+    brotli_support = True
+except ImportError:
+    brotli_support = False
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                      'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+
+
+class StaticAsset:
+    """
+    One file of the web client: content, precompressed variants and validators.
+    """
+
+    def __init__(self, path, st, data, gzip_level, brotli_quality):
+        self.path = path
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.checked = time.monotonic()
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.etag = hashlib.sha1(data).hexdigest()[:20]
+        self.bodies = {'identity': data}
+        if self.content_type.startswith(COMPRESSIBLE_TYPES) and len(data) > 256:
+            gz = gzip.compress(data, gzip_level, mtime=0)
+            if len(gz) < len(data) * 0.9:
+                self.bodies['gzip'] = gz
+            if brotli_support is True:
+                br = brotli.compress(data, quality=brotli_quality)
+                if len(br) < len(data) * 0.9:
+                    self.bodies['br'] = br
+
+    def tag(self, encoding):
+        # Strong ETag per representation
+        if encoding == 'identity':
+            return f'"{self.etag}"'
+        return f'"{self.etag}-{encoding}"'
+
+
+class StaticAssets:
+    """
+    Serves the files below `root` from memory. Files are read and compressed (gzip, and
+    brotli if the `brotli` module is installed) once, when preloaded or first requested,
+    and reloaded when their modification time changes. Responses carry strong ETags and
+    `Cache-Control`, conditional requests with a matching `If-None-Match` are answered with
+    `304 Not Modified`.
+    """
+
+    def __init__(self, root, check_interval=1.0, gzip_level=9, brotli_quality=11):
+        """
+        :param root: directory with the static files
+        :param check_interval: minimum time (s) between two checks of a file's mtime
+        """
+        self.log = logging.getLogger("StaticAssets")
+        self.root = os.path.abspath(root)
+        self.check_interval = check_interval
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.assets = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.loads = 0
+        self.bytes_sent = 0
+
+    def resolve(self, rel_path):
+        """
+        :returns: absolute path of `rel_path` below root, None for paths outside of root.
+        """
+        path = os.path.normpath(os.path.join(self.root, rel_path.lstrip('/')))
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+        return path
+
+    def preload(self, rel_paths):
+        """
+        Load and compress files before they are requested, missing files are ignored.
+        """
+        t0 = time.perf_counter()
+        for rel_path in rel_paths:
+            path = self.resolve(rel_path)
+            if path is not None and os.path.isfile(path):
+                self.load(path)
+        self.log.info(f"Preloaded {len(self.assets)} static files in "
+                      f"{(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    def load(self, path):
+        """
+        Read and compress a file.
+
+        :returns: `StaticAsset`, or None if the file does not exist.
+        """
+        try:
+            st = os.stat(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.assets.pop(path, None)
+            return None
+        asset = StaticAsset(path, st, data, self.gzip_level, self.brotli_quality)
+        self.assets[path] = asset
+        self.loads += 1
+        self.log.debug(f"Loaded {path}: {', '.join(f'{enc} {len(body)}' for enc, body in asset.bodies.items())}")
+        return asset
+
+    def current(self, path):
+        """
+        Cached asset for `path`, if it is still up to date.
+
+        :returns: tuple (asset, False), or (None, True) if the file needs to be (re)loaded.
+        """
+        asset = self.assets.get(path)
+        if asset is None:
+            return None, True
+        now = time.monotonic()
+        if now - asset.checked < self.check_interval:
+            return asset, False
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.assets.pop(path, None)
+            return None, True
+        if st.st_mtime_ns != asset.mtime or st.st_size != asset.size:
+            return None, True
+        asset.checked = now
+        return asset, False
+
+    async def response(self, request, rel_path, cache_control='no-cache'):
+        """
+        Response for a request of file `rel_path`.
+
+        :param cache_control: value of the `Cache-Control` header
+        :returns: `aiohttp.web.Response`
+        """
+        self.requests += 1
+        path = self.resolve(rel_path)
+        if path is None:
+            raise web.HTTPNotFound()
+        asset, reload = self.current(path)
+        if reload is True:
+            if not os.path.isfile(path):
+                raise web.HTTPNotFound()
+            # Compression of large files must not block the websockets
+            asset = await asyncio.get_running_loop().run_in_executor(None, self.load, path)
+            if asset is None:
+                raise web.HTTPNotFound()
+        encoding = self.encoding(request.headers.get('Accept-Encoding', ''), asset)
+        headers = {'ETag': asset.tag(encoding), 'Cache-Control': cache_control,
+                   'Vary': 'Accept-Encoding'}
+        if self.matches(request.headers.get('If-None-Match'), asset):
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        body = asset.bodies[encoding]
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type=asset.content_type, headers=headers)
+
+    def encoding(self, accept_encoding, asset):
+        """
+        Best available encoding of `asset` accepted by the client: br, gzip or identity.
+        """
+        accepted = set()
+        for part in accept_encoding.split(','):
+            fields = part.strip().split(';')
+            q = 1.0
+            for field in fields[1:]:
+                field = field.strip()
+                if field.startswith('q='):
+                    try:
+                        q = float(field[2:])
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                accepted.add(fields[0].strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in asset.bodies:
+                return encoding
+        return 'identity'
+
+    def matches(self, if_none_match, asset):
+        if if_none_match is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        tags = [asset.tag(encoding) for encoding in asset.bodies]
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag in tags:
+                return True
+        return False
+
+    def stats(self):
+        """
+        :returns: dictionary with number of requests, 304 responses, file loads, bytes sent
+                  and bytes held in memory.
+        """
+        return {'requests': self.requests, 'not_modified': self.not_modified,
+                'loads': self.loads, 'bytes_sent': self.bytes_sent,
+                'cached_bytes': sum(len(body) for asset in self.assets.values()
+                                    for body in asset.bodies.values())}
@@ -9,6 +9,9 @@ import io
 import chess
 import chess.pgn
 
+from game_stats import GameStats
+import latency_trace as lt
+
 
 class TurquoiseDispatcher:
     ''' Main dispatcher and event state machine '''
@@ -48,7 +51,8 @@ class TurquoiseDispatcher:
         self.board.reset()
         self.undo_stack = []
         self.undo_stats_stack = []
-        self.stats = []
+        self.stats = GameStats()
+        self.turn_start_time = time.time()
 
         self.mode = None
 
@@ -366,10 +370,11 @@ class TurquoiseDispatcher:
                 agent.engine_list(mesg)
 
     def update_stats(self):
+        start, delta = self.stats.delta()
         for agent in self.agents_all:
             dispm = getattr(agent, "game_stats", None)
             if callable(dispm):
-                agent.game_stats(self.stats)
+                agent.game_stats(delta, start=start)
 
     def update_display_info(self, mesg, max_board_preview_hmoves=6):
         st_msg = copy.deepcopy(mesg)
@@ -503,6 +508,7 @@ class TurquoiseDispatcher:
                         self.log.info("Start uci_agent2")
                         self.uci_agent2.go(self.board, mtime=-1, analysis=True)
 
+                self.turn_start_time = time.time()
                 self.state = self.State.BUSY
                 self.log.info("BUSY")
 
@@ -557,6 +563,7 @@ class TurquoiseDispatcher:
         # leds off
         if self.chesslink_agent:
             self.chesslink_agent.cl_brd.set_led_off()
+        lt.tracer.log_summary(self.log)
         time.sleep(1)
         for agent in self.agents_all:
             fquit = getattr(agent, "quit", None)
@@ -571,7 +578,8 @@ class TurquoiseDispatcher:
         self.board.reset()
         self.undo_stack = []
         self.undo_stats_stack = []
-        self.stats = []
+        self.stats.clear()
+        lt.tracer.new_game()
         self.update_stats()
         self.update_display_board()
         self.state = self.State.IDLE
@@ -587,7 +595,7 @@ class TurquoiseDispatcher:
                     self.log.debug(f"Importing position from {agent.name}, by"
                                    " {msg['actor']}, FEN: {fen}")
                     self.stop(silent=True)
-                    self.stats = []
+                    self.stats.clear()
                     self.undo_stack = []
                     self.undo_stats_stack = []
                     if self.analysis_active is True:
@@ -600,7 +608,7 @@ class TurquoiseDispatcher:
 
     def import_fen(self, msg):
         self.stop()
-        self.stats = []
+        self.stats.clear()
         self.undo_stack = []
         self.undo_stats_stack = []
         if self.analysis_active is True:
@@ -616,7 +624,7 @@ class TurquoiseDispatcher:
 
     def import_pgn(self, msg):
         self.stop()
-        self.stats = []
+        self.stats.clear()
         self.undo_stack = []
         self.undo_stats_stack = []
         if self.analysis_active is True:
@@ -653,29 +661,20 @@ class TurquoiseDispatcher:
         self.undo_stack = []
         self.undo_stats_stack = []
 
-        stat = {}
-        if 'score' in msg:
-            stat['score'] = msg['score']
-        if 'depth' in msg:
-            stat['depth'] = msg['depth']
-        if 'seldepth' in msg:
-            stat['seldepth'] = msg['seldepth']
-        if 'nps' in msg:
-            stat['nps'] = msg['nps']
-        if 'tbhits' in msg:
-            stat['tbhits'] = msg['tbhits']
-        stat['move_number'] = self.board.fullmove_number
+        stat = {'ply': (self.board.fullmove_number - 1) * 2}
         if self.board.turn == chess.WHITE:
-            stat['color'] = 'WHITE'
-            stat['halfmove_number'] = self.board.fullmove_number * 2
             stat['player'] = self.player_w_name
         else:
-            stat['color'] = 'BLACK'
-            stat['halfmove_number'] = self.board.fullmove_number * 2 + 1
+            stat['ply'] += 1
             stat['player'] = self.player_b_name
+        for key in ('score', 'depth', 'seldepth', 'nps', 'tbhits'):
+            if key in msg:
+                stat[key] = msg[key]
+        stat['time'] = time.time() - self.turn_start_time
         self.stats.append(stat)
         self.update_stats()
 
+        move_id = self.board.ply()
         self.board.push(chess.Move.from_uci(msg['uci']))
         if self.board.is_game_over() is True:
             msg['result'] = self.board.result()
@@ -686,6 +685,7 @@ class TurquoiseDispatcher:
         self.update_display_board()
         if 'ponder' in msg:
             self.ponder_move = msg['ponder']
+        lt.mark(move_id, 'dispatcher_move')
         self.state = self.State.IDLE
 
     def move_back(self, msg):
@@ -22,7 +22,10 @@ var engines = {};
 var FenRef = {};
 var StatHeader = {};
 var ValidMoves = [];
-var GameStats = {};
+var GameStats = [];
+var PgnMoves = [];
+var PgnSeq = null;
+var CompactSchema = null;
 var id = null;
 
 var oldFen = null;
@@ -40,7 +43,8 @@ var cmds = {
     'engine_list': engine_list,
     'move': set_move,
     'valid_moves': set_valid_moves,
-    'game_stats': set_game_stats
+    'game_stats': set_game_stats,
+    'compact_info_schema': set_compact_schema
 };
 
 var mchessSocket;
@@ -49,6 +53,12 @@ function wsConnect(address) {
     mchessSocket = new WebSocket(address);
     console.log(`Socket: ${mchessSocket}`);
     mchessSocket.onopen = function (event) {
+        // Request compact encoding of current_move_info messages, see compact_info.py
+        mchessSocket.send(JSON.stringify({
+            'cmd': 'encoding',
+            'compact_info': 1,
+            'actor': 'WebAgent'
+        }));
         document.getElementById("connect-state").style.color = "#58A4B0";
         document.getElementById("connect-text").innerText = "connected";
         document.getElementById("");
@@ -151,6 +161,8 @@ function wsConnect(address) {
         mchessSocket = null;
         console.log(`Socket close: ${mchessSocket}`);
         ValidMoves = [];
+        PgnSeq = null;
+        CompactSchema = null;
         setTimeout(function () {
             wsConnect(address);
         }, 1000);
@@ -163,6 +175,10 @@ function wsConnect(address) {
             console.log('JSON error: ' + err.message);
             return;
         }
+        if (Array.isArray(msg)) {
+            msg = decode_compact_info(msg);
+            if (msg == null) return;
+        }
         // console.log("got message: ")
         // console.log(msg)
         if (!msg.hasOwnProperty("cmd")) {
@@ -181,6 +197,66 @@ function wsConnect(address) {
     };
 }
 
+function set_compact_schema(msg) {
+    CompactSchema = msg;
+}
+
+function unpack_variant(packed) {
+    // UCI moves are 4 characters, promotions 5: a piece letter not followed by a rank.
+    var moves = [];
+    var i = 0;
+    while (i < packed.length) {
+        var n = 4;
+        if (i + 4 < packed.length && "qrbn".includes(packed[i + 4]) &&
+            (i + 5 == packed.length || !"12345678".includes(packed[i + 5]))) {
+            n = 5;
+        }
+        moves.push(packed.substring(i, i + n));
+        i += n;
+    }
+    return moves;
+}
+
+function unpack_san_variant(packed) {
+    var moveNumber = packed[0];
+    var moves = packed[2] == "" ? [] : packed[2].split(" ");
+    var sanVariant = [];
+    var i = 0;
+    if (packed[1] == 1) {
+        sanVariant.push([moveNumber, ".."].concat(moves.slice(0, 1)));
+        moveNumber += 1;
+        i = 1;
+    }
+    for (; i < moves.length; i += 2) {
+        sanVariant.push([moveNumber].concat(moves.slice(i, i + 2)));
+        moveNumber += 1;
+    }
+    return sanVariant;
+}
+
+function decode_compact_info(packed) {
+    if (CompactSchema == null || packed[0] != "i") {
+        console.log("Compact message without schema ignored");
+        return null;
+    }
+    var msg = {
+        'cmd': 'current_move_info'
+    };
+    var fields = CompactSchema.fields;
+    for (var i = 0; i < fields.length; i++) {
+        var value = packed[i + 1];
+        if (value == null) continue;
+        if (fields[i] == "actor") value = CompactSchema.actors[value];
+        else if (fields[i] == "variant") value = unpack_variant(value);
+        else if (fields[i] == "san_variant") value = unpack_san_variant(value);
+        msg[fields[i]] = value;
+    }
+    if (packed.length > fields.length + 1) {
+        Object.assign(msg, packed[packed.length - 1]);
+    }
+    return msg;
+}
+
 function agent_state(msg) {
     console.log('agent_state msg: ' + msg.actor + ' ' + msg.state + ' ' + msg.message);
     if (msg.actor == 'ChessLinkAgent') {
@@ -233,10 +309,46 @@ function availablePlayers() {
     document.getElementById("blackplayer").innerHTML = bHtml;
 }
 
+function pgn_delta(delta) {
+    // Moves are sent as deltas: truncate to 'start' plies, then append.
+    // A delta that does not follow the last one requests the complete move list.
+    if (!delta.full && (PgnSeq == null || delta.seq != PgnSeq + 1)) {
+        if (PgnSeq == null || delta.seq > PgnSeq) {
+            console.log(`Move list delta ${delta.seq} out of sequence (${PgnSeq}), requesting resync`);
+            mchessSocket.send(JSON.stringify({
+                'cmd': 'pgn_resync',
+                'actor': 'WebAgent'
+            }));
+        }
+        return;
+    }
+    if (delta.full && PgnSeq != null && delta.seq < PgnSeq) {
+        return;
+    }
+    PgnSeq = delta.seq;
+    PgnMoves.splice(delta.start, PgnMoves.length - delta.start, ...delta.moves);
+    var pgn = "";
+    for (var i = 0; i < PgnMoves.length; i++) {
+        var ply = delta.first_ply + i;
+        if (ply % 2 == 0) {
+            pgn += " <span class=\"movenrb\"> " + (ply / 2 + 1) + ".</span>&nbsp;";
+        } else if (i == 0) {
+            pgn += " <span class=\"movenrb\"> " + ((ply - 1) / 2 + 1) + "...</span>&nbsp;";
+        } else {
+            pgn += " ";
+        }
+        pgn += PgnMoves[i];
+    }
+    pgn += " " + delta.result;
+    document.getElementById("mainmoves").innerHTML = pgn;
+}
+
 function display_board(msg) {
-    if (msg.hasOwnProperty("fen") && msg.hasOwnProperty("attribs") && msg.hasOwnProperty("pgn")) {
+    if (msg.hasOwnProperty("pgn_delta")) {
+        pgn_delta(msg.pgn_delta);
+    }
+    if (msg.hasOwnProperty("fen") && msg.hasOwnProperty("attribs")) {
         console.log("got board position.");
-        console.log(msg.pgn);
         console.log(msg.fen);
         if (msg.fen == oldFen) {
             console.log("position did not change, ignoring FEN update");
@@ -266,16 +378,6 @@ function display_board(msg) {
             mainBoard.setPosition(msg.fen);
         }
         availablePlayers();
-        var pi = msg.pgn.search("\n\n");
-        var pgn = msg.pgn;
-        if (pi != -1) {
-            pgn = msg.pgn.substring(pi);
-        }
-        // pgn = pgn.replace(" *", "");
-        pgn = pgn.replace(" ", "&nbsp;");
-        var regex = /([0-9]+\.)/g;
-        pgn = pgn.replace(regex, " <span class=\"movenrb\"> $1</span>");
-        document.getElementById("mainmoves").innerHTML = pgn;
 
         if (miniBoard1 == null) {
             miniBoard1 = new Chessboard(document.getElementById("miniboard1"), {
@@ -462,7 +564,13 @@ function set_valid_moves(msg) {
 
 function set_game_stats(stats_msg) {
     console.log("Received stats msg");
-    var stats = stats_msg.stats;
+    // Stats are sent as deltas: truncate to 'start' plies, then append.
+    var start = 0;
+    if (stats_msg.hasOwnProperty("start")) {
+        start = stats_msg.start;
+    }
+    GameStats.splice(start, GameStats.length - start, ...stats_msg.stats);
+    var stats = GameStats;
     var lbls = [];
     var dsb = [];
     var dsw = [];